@@ -1,9 +1,17 @@
+import json
+import os
 import openai
 import requests
+from utils.content_filter import BlocklistMatcher
+
+DEFAULT_BLOCKLIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'blocklist.txt')
 
 class AIChatAssistant:
-    def __init__(self, api_key):
+    def __init__(self, api_key, api_base=None, blocklist=None):
         openai.api_key = api_key
+        if api_base:
+            openai.api_base = api_base
+        self.blocklist = blocklist or BlocklistMatcher(DEFAULT_BLOCKLIST_PATH)
         
     def moderate_content(self, text):
         """
@@ -20,30 +28,50 @@ class AIChatAssistant:
                 "reason": self._get_moderation_reason(result["categories"])
             }
         except Exception as e:
+            print(f'Moderation failed, using the blocklist: {e}')
             # Fallback to simple content check if API fails
-            return self._simple_content_check(text)
+            return self.fallback_verdict(text)
     
-    def _simple_content_check(self, text):
+    def moderate_batch(self, texts):
         """
-        Simple content check as fallback
+        Moderate several texts with a single moderation API call
         """
-        inappropriate_words = ['naked', 'nude', 'explicit', 'xxx', 'porn', 'nude', 'naked']
-        text_lower = text.lower()
-        
-        for word in inappropriate_words:
-            if word in text_lower:
-                return {
-                    "flagged": True,
-                    "categories": {"sexual": True},
-                    "category_scores": {"sexual": 0.9},
-                    "reason": "Contains inappropriate content"
-                }
+        try:
+            response = openai.Moderation.create(input=list(texts))
+            
+            verdicts = []
+            for result in response["results"]:
+                verdicts.append({
+                    "flagged": result["flagged"],
+                    "categories": result["categories"],
+                    "category_scores": result["category_scores"],
+                    "reason": self._get_moderation_reason(result["categories"])
+                })
+            return verdicts
+        except Exception as e:
+            print(f'Batch moderation failed, using the blocklist: {e}')
+            # Fallback to simple content check if API fails
+            return [self.fallback_verdict(text) for text in texts]
+    
+    def fallback_verdict(self, text):
+        """
+        Blocklist-only verdict for when the moderation API cannot answer; marked with "fallback"
+        """
+        if self.blocklist.find(text) is not None:
+            return {
+                "flagged": True,
+                "categories": {"sexual": True},
+                "category_scores": {"sexual": 0.9},
+                "reason": "Contains inappropriate content",
+                "fallback": True
+            }
         
         return {
             "flagged": False,
             "categories": {},
             "category_scores": {},
-            "reason": ""
+            "reason": "",
+            "fallback": True
         }
     
     def _get_moderation_reason(self, categories):
@@ -59,37 +87,68 @@ class AIChatAssistant:
             return f"Content flagged for: {', '.join(reasons)}"
         return ""
     
+    def _format_conversation(self, conversation_history):
+        messages = []
+        for msg in conversation_history:
+            role = "user" if msg["role"] == "user" else "assistant"
+            messages.append({"role": role, "content": msg["content"]})
+        return messages
+    
+    def _fallback_response(self):
+        # Fallback responses if AI fails
+        fallback_responses = [
+            "I'm sorry, I didn't understand that.",
+            "Could you please rephrase that?",
+            "I'm having trouble processing your request right now.",
+            "Let's talk about something else.",
+            "That's interesting! Tell me more."
+        ]
+        
+        import random
+        return random.choice(fallback_responses)
+    
     def generate_response(self, conversation_history):
         """
         Generate AI response based on conversation history
         """
         try:
-            # Format conversation for OpenAI
-            messages = []
-            for msg in conversation_history:
-                role = "user" if msg["role"] == "user" else "assistant"
-                messages.append({"role": role, "content": msg["content"]})
-            
             response = openai.ChatCompletion.create(
                 model="gpt-3.5-turbo",
-                messages=messages,
+                messages=self._format_conversation(conversation_history),
                 max_tokens=150,
                 temperature=0.7
             )
             
             return response.choices[0].message['content'].strip()
         except Exception as e:
-            # Fallback responses if AI fails
-            fallback_responses = [
-                "I'm sorry, I didn't understand that.",
-                "Could you please rephrase that?",
-                "I'm having trouble processing your request right now.",
-                "Let's talk about something else.",
-                "That's interesting! Tell me more."
-            ]
+            print(f'AI response failed: {e}')
+            return self._fallback_response()
+    
+    def stream_response(self, conversation_history):
+        """
+        Generate AI response token by token, yielding text deltas as they arrive
+        """
+        emitted = False
+        try:
+            response = openai.ChatCompletion.create(
+                model="gpt-3.5-turbo",
+                messages=self._format_conversation(conversation_history),
+                max_tokens=150,
+                temperature=0.7,
+                stream=True
+            )
             
-            import random
-            return random.choice(fallback_responses)
+            for chunk in response:
+                delta = chunk["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    emitted = True
+                    yield delta
+        except Exception as e:
+            print(f'AI stream failed: {e}')
+        
+        # Only fall back if nothing has been sent yet
+        if not emitted:
+            yield self._fallback_response()
     
     def translate_message(self, text, target_language):
         """
@@ -107,4 +166,48 @@ class AIChatAssistant:
             
             return response.choices[0].text.strip()
         except Exception as e:
+            print(f'Translation failed: {e}')
             return text  # Return original text if translation fails
+    
+    def _complete_json(self, prompt):
+        response = openai.ChatCompletion.create(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.3
+        )
+        return json.loads(response.choices[0].message['content'])
+    
+    def translate_to_languages(self, text, target_languages):
+        """
+        Translate one message into several languages with a single AI call
+        """
+        try:
+            prompt = (
+                "Translate the text below into each of these languages: "
+                f"{', '.join(target_languages)}. Reply with only a JSON object "
+                "mapping each language exactly as given to its translation.\n\n"
+                f"{text}"
+            )
+            translations = self._complete_json(prompt)
+            return [str(translations.get(language, text)).strip() for language in target_languages]
+        except Exception as e:
+            print(f'Translation failed: {e}')
+            return [text for _ in target_languages]  # Return original text if translation fails
+    
+    def translate_texts(self, texts, target_language):
+        """
+        Translate several messages into one language with a single AI call
+        """
+        try:
+            prompt = (
+                f"Translate each string in the JSON array below to {target_language}. "
+                "Reply with only a JSON array of the translations in the same order.\n\n"
+                f"{json.dumps(texts, ensure_ascii=False)}"
+            )
+            translations = self._complete_json(prompt)
+            if not isinstance(translations, list) or len(translations) != len(texts):
+                return list(texts)
+            return [str(translation).strip() for translation in translations]
+        except Exception as e:
+            print(f'Batch translation failed: {e}')
+            return list(texts)  # Return original text if translation fails
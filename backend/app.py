@@ -1,43 +1,543 @@
-from flask import Flask, request, jsonify, send_file
+import eventlet
+
+# Worker processes started with spawn (media previews) re-import this script as __mp_main__.
+# They only run the job functions sent to them, so they skip the server setup (see init_services)
+if __name__ != '__mp_main__':
+    eventlet.monkey_patch()
+
+from flask import Flask, request, jsonify, session
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
 from datetime import datetime, timedelta
+import atexit
+import calendar
+import click
 import json
 import os
-from models import db, User, Message, ChatRoom, UserChatRoom
-from utils.authentication import hash_password, verify_password
-from utils.payment_processor import process_payment
-from utils.file_upload import save_uploaded_file
-from ai_integration import AIChatAssistant
+import time
+import uuid
+from models import db, User, Message, ChatRoom, UserChatRoom, RoomMessage, ReadReceipt, StoredFile, UserFile, DerivedFile, Payment, CreditBalance, conversation_key
+from sqlalchemy import case
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
+from utils.authentication import configure_password_hasher, authenticate_socket, socket_identity, socket_auth_required
+from utils.rate_limit import RateLimiter
+from utils.credits import CreditLedger, InsufficientCredits
+from utils.payment_processor import configure_stripe, create_payment_intent, find_payment_intent, record_customer, settle_payment, parse_webhook, FINAL_STATUSES
+from utils.media import media_response, signed_media_query, valid_media_signature
+from utils.file_upload import ContentStore, ChunkedUploads, OffsetMismatch, allowed_file, content_type_for, save_uploaded_file, add_file_reference, release_file_reference
+from utils.conversations import get_conversation_summaries, get_message_page, get_message_delta, get_recent_messages, get_conversation_partners, get_read_watermark, clamp_page_size, DEFAULT_PAGE_SIZE
+from utils.context_cache import ConversationContextCache
+from utils.rooms import RoomMembershipCache, room_channel
+from utils.presence import PresenceTracker, MemoryPresenceStore, RedisPresenceStore
+from utils.lru_cache import TTLCache
+from utils.content_filter import BlocklistMatcher
+from utils.metrics import metrics
+from utils.message_queue import ClusterEvents, socketio_queue_options
+from utils.ids import configure_worker, max_id_before
+from utils.read_receipts import ReadReceiptTracker
+from utils.delivery import DeliveryQueue
+from utils.write_behind import MessageWriter, row_for
+from utils.serialization import JSONResponseProvider, RowSerializer, socketio_options
+from utils.database import configure_database, install_pragmas, sqlite_pragmas, read_replica, check_database, pool_stats
+from utils.query_plans import capture_selects, full_scans
+from ai_integration import AIChatAssistant, DEFAULT_BLOCKLIST_PATH
+from moderation import ModerationPipeline
+from translation import TranslationService, SQLiteTranslationStore
+from search import MessageSearchIndex, highlight, query_words
+from jobs import JobQueue, MemoryBackend, RedisBackend, QueueFull
+from media_processing import process_media, media_kind
+from migrations import MIGRATIONS, applied_migrations, migrate, ensure_message_partitions
 
 app = Flask(__name__)
-app.config.from_pyfile('config.py')
+app.config.from_object('config.Config')
+app.json = JSONResponseProvider(app)
+# Behind nginx, remote_addr would be the proxy's; take the client's from the trusted hops' X-Forwarded-For
+if app.config.get('TRUSTED_PROXY_HOPS'):
+    app.wsgi_app = ProxyFix(
+        app.wsgi_app,
+        x_for=app.config['TRUSTED_PROXY_HOPS'],
+        x_proto=app.config['TRUSTED_PROXY_HOPS']
+    )
 
-# Initialize extensions
+# Initialize extensions; engines are tuned for the database in use
+database_profile = configure_database(app)
 db.init_app(app)
+if database_profile == 'sqlite':
+    with app.app_context():
+        install_pragmas(db, sqlite_pragmas(
+            mmap_size=app.config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+            busy_timeout=app.config.get('SQLITE_BUSY_TIMEOUT', 5000)
+        ))
 CORS(app)
 jwt = JWTManager(app)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+# Bound to the app, and to the message queue if any, by init_services
+socketio = SocketIO()
+
+# bcrypt runs on native threads; logins are throttled per address and per account
+password_hasher = configure_password_hasher(
+    rounds=app.config.get('BCRYPT_ROUNDS', 12),
+    workers=app.config.get('PASSWORD_HASH_WORKERS', 4)
+)
+login_limits = {
+    'ip': RateLimiter(
+        app.config.get('LOGIN_LIMIT_PER_IP', 30),
+        app.config.get('LOGIN_LIMIT_WINDOW', 60),
+        redis_url=app.config.get('LOGIN_RATE_LIMIT_REDIS_URL'),
+        prefix='login:ip'
+    ),
+    'email': RateLimiter(
+        app.config.get('LOGIN_LIMIT_PER_EMAIL', 10),
+        app.config.get('LOGIN_LIMIT_WINDOW', 60),
+        redis_url=app.config.get('LOGIN_RATE_LIMIT_REDIS_URL'),
+        prefix='login:email'
+    )
+}
+
+def throttled(**keys):
+    """
+    Record an attempt under each limiter and return a 429 response if any is exhausted
+    """
+    retry_after = max(login_limits[name].hit(key) for name, key in keys.items())
+    if not retry_after:
+        return None
+    
+    response = jsonify({"error": "Too many attempts, try again later"})
+    response.headers['Retry-After'] = str(int(retry_after) + 1)
+    return response, 429
 
 # Initialize AI assistant
-ai_assistant = AIChatAssistant(app.config['OPENAI_API_KEY'])
+blocklist = BlocklistMatcher(
+    app.config.get('BLOCKLIST_PATH', DEFAULT_BLOCKLIST_PATH),
+    reload_interval=app.config.get('BLOCKLIST_RELOAD_INTERVAL', 30)
+)
+ai_assistant = AIChatAssistant(app.config['OPENAI_API_KEY'], app.config.get('OPENAI_API_BASE'), blocklist)
+
+# Moderation runs in batches on a background worker
+moderation = ModerationPipeline(
+    ai_assistant,
+    batch_size=app.config.get('MODERATION_BATCH_SIZE', 32),
+    max_wait=app.config.get('MODERATION_MAX_WAIT', 0.05),
+    cache_size=app.config.get('MODERATION_CACHE_SIZE', 10000),
+    cache_ttl=app.config.get('MODERATION_CACHE_TTL', 3600),
+    timeout=app.config.get('MODERATION_TIMEOUT', 5)
+)
 
 @app.route('/')
 def index():
     return jsonify({"status": "Chat API is running", "version": "1.0.0"})
 
+# Translations are cached by content hash and batched upstream
+translator = TranslationService(
+    ai_assistant,
+    cache_size=app.config.get('TRANSLATION_CACHE_SIZE', 50000),
+    store=SQLiteTranslationStore(app.config['TRANSLATION_DB_PATH']) if app.config.get('TRANSLATION_DB_PATH') else None
+)
+
+# Recent messages per conversation, kept in memory for AI prompts
+context_cache = ConversationContextCache(
+    max_conversations=app.config.get('AI_CONTEXT_MAX_CONVERSATIONS', 10000),
+    max_messages=app.config.get('AI_CONTEXT_MAX_MESSAGES', 50),
+    token_budget=app.config.get('AI_CONTEXT_TOKEN_BUDGET', 1000),
+    ttl=app.config.get('AI_CONTEXT_TTL', 60)
+)
+
+# Chat room settings and members, so room messages skip membership queries
+room_cache = RoomMembershipCache(
+    max_rooms=app.config.get('ROOM_CACHE_SIZE', 1000),
+    ttl=app.config.get('ROOM_CACHE_TTL', 300)
+)
+
+# Joins and leaves reach the room cache and sockets of every process
+cluster_events = ClusterEvents(app.config.get('SOCKETIO_MESSAGE_QUEUE'))
+
+def room_member_joined(room_id, user_id):
+    room_cache.add_member(room_id, user_id)
+
+def room_member_left(room_id, user_id):
+    """
+    Forget a departed member and take their sockets in this process out of the room's broadcasts
+    """
+    room_cache.remove_member(room_id, user_id)
+    if socketio.server is None:
+        return
+    for sid, _ in list(socketio.server.manager.get_participants('/', f"user_{user_id}")):
+        socketio.server.leave_room(sid, room_channel(room_id), namespace='/')
+
+cluster_events.on('room_member_joined', room_member_joined)
+cluster_events.on('room_member_left', room_member_left)
+cluster_events.on('context_invalidated', lambda user_ids: context_cache.invalidate(*user_ids))
+
+# Presence lives in memory (or Redis); contacts and the users table are updated in batches
+contacts_cache = TTLCache(max_size=10000, ttl=60)
+
+def get_cached_partners(user_id):
+    partners = contacts_cache.get(user_id)
+    if partners is None:
+        partners = get_conversation_partners(user_id)
+        contacts_cache.set(user_id, partners)
+    return partners
+
+def broadcast_presence(changes):
+    """
+    Send each contact one event listing the presence changes it cares about
+    """
+    updates = {}
+    with app.app_context():
+        for user_id, (online, at) in changes.items():
+            for contact_id in get_cached_partners(user_id):
+                if contact_id != user_id:
+                    updates.setdefault(contact_id, []).append({
+                        'user_id': user_id,
+                        'online': online,
+                        'last_seen': at.isoformat()
+                    })
+    
+    for contact_id, contact_updates in updates.items():
+        socketio.emit('presence', {'updates': contact_updates}, room=f"user_{contact_id}")
+
+def persist_presence(changes):
+    """
+    Write is_online/last_seen for all changed users in one batch
+    """
+    with app.app_context():
+        db.session.bulk_update_mappings(User, [
+            {'id': user_id, 'is_online': online, 'last_seen': at}
+            for user_id, (online, at) in changes.items()
+        ])
+        db.session.commit()
+
+if app.config.get('PRESENCE_REDIS_URL'):
+    presence_store = RedisPresenceStore(app.config['PRESENCE_REDIS_URL'])
+else:
+    presence_store = MemoryPresenceStore()
+presence = PresenceTracker(
+    presence_store,
+    ttl=app.config.get('PRESENCE_TTL', 90),
+    flush_interval=app.config.get('PRESENCE_FLUSH_INTERVAL', 5),
+    broadcast=broadcast_presence,
+    persist=persist_presence
+)
+
+# Read state is a watermark per conversation, advanced in memory and written in batches
+def load_read_watermark(user_id, contact_id):
+    with app.app_context():
+        return get_read_watermark(user_id, contact_id)
+
+def persist_read_receipts(watermarks):
+    """
+    Upsert the advanced watermarks in one statement, never moving one back
+    """
+    with app.app_context():
+        now = datetime.utcnow()
+        rows = [
+            {'user_id': user_id, 'contact_id': contact_id, 'last_read_id': message_id, 'updated_at': now}
+            for (user_id, contact_id), message_id in watermarks.items()
+        ]
+        receipts = ReadReceipt.__table__
+        # Another process may have moved a watermark further already, or inserted it first
+        if db.engine.dialect.name == 'mysql':
+            statement = mysql_insert(receipts).values(rows)
+            advanced = statement.inserted.last_read_id > receipts.c.last_read_id
+            # MySQL assigns left to right, so updated_at is compared against the old watermark
+            statement = statement.on_duplicate_key_update([
+                ('updated_at', case((advanced, statement.inserted.updated_at), else_=receipts.c.updated_at)),
+                ('last_read_id', db.func.greatest(receipts.c.last_read_id, statement.inserted.last_read_id))
+            ])
+        else:
+            dialect_insert = postgresql_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+            statement = dialect_insert(receipts).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=[receipts.c.user_id, receipts.c.contact_id],
+                set_={'last_read_id': statement.excluded.last_read_id, 'updated_at': statement.excluded.updated_at},
+                where=statement.excluded.last_read_id > receipts.c.last_read_id
+            )
+        db.session.execute(statement)
+        db.session.commit()
+
+def broadcast_read_receipts(watermarks):
+    """
+    Tell each sender how far the reader has got
+    """
+    for (user_id, contact_id), message_id in watermarks.items():
+        socketio.emit('read_up_to', {
+            'reader_id': user_id,
+            'message_id': message_id
+        }, room=f"user_{contact_id}")
+
+read_receipts = ReadReceiptTracker(
+    load_read_watermark,
+    flush_interval=app.config.get('READ_RECEIPT_FLUSH_INTERVAL', 1),
+    cache_size=app.config.get('READ_RECEIPT_CACHE_SIZE', 100000),
+    cache_ttl=app.config.get('READ_RECEIPT_CACHE_TTL', 300),
+    persist=persist_read_receipts,
+    notify=broadcast_read_receipts
+)
+
+# Direct messages wait here for a delivery ack, so reconnecting clients get them with their catch-up
+delivery_queue = DeliveryQueue(
+    max_users=app.config.get('DELIVERY_QUEUE_USERS', 100000),
+    max_per_user=app.config.get('DELIVERY_QUEUE_PER_USER', 500),
+    ttl=app.config.get('DELIVERY_QUEUE_TTL', 3600)
+)
+
+# AI work runs on a bounded worker pool instead of the socket handlers
+if app.config.get('JOB_QUEUE_REDIS_URL'):
+    job_backend = RedisBackend(app.config['JOB_QUEUE_REDIS_URL'], max_size=app.config.get('JOB_QUEUE_SIZE', 1000))
+else:
+    job_backend = MemoryBackend(max_size=app.config.get('JOB_QUEUE_SIZE', 1000))
+job_queue = JobQueue(
+    job_backend,
+    workers=app.config.get('JOB_WORKERS', 4),
+    per_user_limit=app.config.get('JOB_PER_USER_LIMIT', 2),
+    timeout=app.config.get('JOB_TIMEOUT', 60),
+    executor=app.config.get('JOB_EXECUTOR', 'thread')
+)
+
+# Messages get their id up front and are written in bulk transactions
+if app.config.get('MESSAGE_ID_WORKER') is not None:
+    configure_worker(app.config['MESSAGE_ID_WORKER'])
+elif app.config.get('SOCKETIO_MESSAGE_QUEUE'):
+    # Several processes share the tables; pid-derived worker ids could collide and repeat ids
+    raise RuntimeError("MESSAGE_ID_WORKER must be set to a distinct id per process when SOCKETIO_MESSAGE_QUEUE is set")
+
+def report_failed_write(model, row, error):
+    """
+    Tell the sender that a message already delivered could not be saved
+    """
+    print(f"Could not save {model.__tablename__} {row['id']}: {error}")
+    if model is Message:
+        context_cache.invalidate(row['sender_id'], row['receiver_id'])
+    socketio.emit('message_failed', {
+        'id': row['id'],
+        'message': 'Message could not be saved'
+    }, room=f"user_{row['sender_id']}")
+
+# Direct messages are indexed for search as their batch commits
+def search_db_path():
+    # Generated data stays out of the source tree: the instance folder unless configured
+    if app.config.get('SEARCH_DB_PATH'):
+        return app.config['SEARCH_DB_PATH']
+    os.makedirs(app.instance_path, exist_ok=True)
+    return os.path.join(app.instance_path, 'search.db')
+
+search_index = None  # opened by init_services
+
+def index_written_messages(model, rows):
+    if model is Message:
+        search_index.add_many(
+            (row['id'], row['sender_id'], row['receiver_id'], row['content'])
+            for row in rows
+        )
+
+message_writer = MessageWriter(
+    app,
+    db,
+    batch_size=app.config.get('MESSAGE_WRITE_BATCH_SIZE', 200),
+    flush_interval=app.config.get('MESSAGE_WRITE_INTERVAL', 0.02),
+    durability=app.config.get('MESSAGE_DURABILITY', 'write_behind'),
+    on_failure=report_failed_write,
+    on_written=index_written_messages
+)
+atexit.register(message_writer.flush)
+
+def save_message(model, **fields):
+    """
+    Queue a new message for writing and return it with the future of the write.
+    
+    With group_commit durability this waits until the batch holding the
+    message is committed; otherwise the message is returned right away.
+    """
+    message = model(**fields)
+    row = row_for(message)
+    for key, value in row.items():
+        setattr(message, key, value)
+    
+    written = message_writer.submit(model, row)
+    if message_writer.waits_for_commit:
+        written.result()
+    return message, written
+
+# Uploads are streamed to disk and stored once per distinct content
+content_store = ContentStore(
+    app.config.get('UPLOAD_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+)
+chunked_uploads = ChunkedUploads(
+    content_store,
+    max_size=app.config.get('MAX_UPLOAD_SIZE', 1024 * 1024 * 1024),
+    expiry=app.config.get('UPLOAD_EXPIRY', 24 * 3600)
+)
+
+def file_data(user_file):
+    return {
+        "id": user_file.id,
+        "filename": user_file.filename,
+        "content_type": user_file.content_type,
+        "size": user_file.stored_file.size,
+        "sha256": user_file.sha256,
+        "file_path": content_store.relative_path(user_file.sha256),
+        "url": f"/api/media/{user_file.sha256}",
+        "media": media_data(user_file.stored_file.media),
+        "created_at": user_file.created_at.isoformat()
+    }
+
+def can_access_media(user_id, owner_ids):
+    """
+    Uploaders, people they chat with and people sharing a room with them may fetch a file
+    """
+    if user_id in owner_ids or owner_ids & get_cached_partners(user_id):
+        return True
+    
+    mine = db.aliased(UserChatRoom)
+    theirs = db.aliased(UserChatRoom)
+    shared_room = db.session.query(mine.chat_room_id).join(
+        theirs, theirs.chat_room_id == mine.chat_room_id
+    ).filter(mine.user_id == user_id, theirs.user_id.in_(owner_ids)).first()
+    return shared_room is not None
+
+# Thumbnails and waveforms are built in worker processes after upload
+media_jobs = JobQueue(
+    MemoryBackend(max_size=app.config.get('MEDIA_QUEUE_SIZE', 1000)),
+    workers=app.config.get('MEDIA_WORKERS', 2),
+    timeout=app.config.get('MEDIA_TIMEOUT', 120),
+    executor='process'
+)
+
+def media_data(media):
+    """
+    Preview metadata with URLs for the stored thumbnails
+    """
+    if not media:
+        return media
+    media = dict(media)
+    media['thumbnails'] = [
+        dict(thumbnail, url=f"/api/media/{thumbnail['sha256']}")
+        for thumbnail in media.get('thumbnails', [])
+    ]
+    return media
+
+# Every message payload, over HTTP or Socket.IO, has this shape
+message_serializer = RowSerializer({
+    "id": Message.id,
+    "sender_id": Message.sender_id,
+    "receiver_id": Message.receiver_id,
+    "content": Message.content,
+    "message_type": Message.message_type,
+    "timestamp": Message.timestamp,
+    "is_ai_generated": Message.is_ai_generated,
+    "file_id": Message.file_id,
+    "media": Message.media
+}, transforms={"media": media_data})
+
+room_message_serializer = RowSerializer({
+    "id": RoomMessage.id,
+    "room_id": RoomMessage.chat_room_id,
+    "sender_id": RoomMessage.sender_id,
+    "content": RoomMessage.content,
+    "message_type": RoomMessage.message_type,
+    "timestamp": RoomMessage.timestamp
+})
+
+def get_room_message_page(room_id, limit, before_id=None):
+    """
+    Rows of one page of a room's history, newest first, with one extra row when there is more
+    """
+    query = db.session.query(*room_message_serializer.columns).filter(RoomMessage.chat_room_id == room_id)
+    if before_id is not None:
+        query = query.filter(RoomMessage.id < before_id)
+    return query.order_by(RoomMessage.id.desc()).limit(limit + 1).all()
+
+def queue_media_processing(user_file):
+    """
+    Build previews for a new upload, once per distinct content
+    """
+    stored = user_file.stored_file
+    if stored.media is not None or media_kind(user_file.content_type) is None:
+        return
+    
+    try:
+        media_jobs.submit('process_media', {
+            'sha256': stored.sha256,
+            'root': content_store.root,
+            'content_type': user_file.content_type,
+            'sizes': app.config.get('MEDIA_THUMBNAIL_SIZES')
+        })
+    except QueueFull as e:
+        # Left unprocessed; the next upload of the same content tries again
+        print(f'Media processing skipped for {stored.sha256}: {e}')
+        return
+    
+    stored.media = {'status': 'pending', 'kind': media_kind(user_file.content_type)}
+    db.session.commit()
+
+def deliver_media(job, preview, error):
+    """
+    Save finished previews and attach them to the messages carrying the file
+    """
+    sha256 = job.payload['sha256']
+    if error is not None:
+        print(f'Media processing failed for {sha256}: {error}')
+        preview = {'status': 'failed', 'kind': media_kind(job.payload['content_type'])}
+    
+    # Messages sent moments ago may still be in the write buffer
+    message_writer.flush()
+    
+    with app.app_context():
+        known = {sha for (sha,) in db.session.query(DerivedFile.sha256).filter_by(source_sha256=sha256)}
+        for thumbnail in preview.get('thumbnails', []):
+            if thumbnail['sha256'] not in known:
+                known.add(thumbnail['sha256'])
+                db.session.add(DerivedFile(
+                    sha256=thumbnail['sha256'],
+                    source_sha256=sha256,
+                    content_type=thumbnail['content_type']
+                ))
+        
+        StoredFile.query.filter_by(sha256=sha256).update({StoredFile.media: preview}, synchronize_session=False)
+        file_ids = db.session.query(UserFile.id).filter(UserFile.sha256 == sha256)
+        Message.query.filter(Message.file_id.in_(file_ids)).update({Message.media: preview}, synchronize_session=False)
+        db.session.commit()
+        
+        messages = db.session.query(Message.id, Message.sender_id, Message.receiver_id).filter(Message.file_id.in_(file_ids)).all()
+    
+    for message_id, sender_id, receiver_id in messages:
+        for room in (f"chat_{sender_id}_{receiver_id}", f"chat_{receiver_id}_{sender_id}"):
+            socketio.emit('message_media', {'id': message_id, 'media': media_data(preview)}, room=room)
+
+media_jobs.register('process_media', process_media, deliver_media)
+
+@app.route('/api/metrics', methods=['GET'])
+@jwt_required()
+def get_metrics():
+    # Queue, cache and pool internals are for operators only
+    if get_jwt_identity() not in app.config.get('ADMIN_USER_IDS', ()):
+        return jsonify({"error": "Forbidden"}), 403
+    
+    snapshot = metrics.snapshot()
+    snapshot['database'] = {name or 'primary': pool_stats(engine) for name, engine in db.engines.items()}
+    return jsonify(snapshot), 200
+
 @app.route('/api/register', methods=['POST'])
 def register():
     try:
         data = request.get_json()
         
+        # Hashing is expensive, so sign-ups count against the address like logins
+        limited = throttled(ip=request.remote_addr)
+        if limited:
+            return limited
+        
         # Check if user already exists
         if User.query.filter_by(email=data['email']).first():
             return jsonify({"error": "User already exists"}), 400
         
         # Create new user
-        hashed_password = hash_password(data['password'])
+        hashed_password = password_hasher.hash(data['password'])
         new_user = User(
             username=data['username'],
             email=data['email'],
@@ -47,6 +547,8 @@ def register():
         )
         
         db.session.add(new_user)
+        db.session.flush()
+        db.session.add(CreditBalance(user_id=new_user.id, balance=0))
         db.session.commit()
         
         # Create access token
@@ -65,11 +567,21 @@ def register():
 def login():
     try:
         data = request.get_json()
+        
+        limited = throttled(ip=request.remote_addr, email=data['email'].strip().lower())
+        if limited:
+            return limited
+        
         user = User.query.filter_by(email=data['email']).first()
         
-        if not user or not verify_password(data['password'], user.password_hash):
+        if not user or not password_hasher.verify(data['password'], user.password_hash):
             return jsonify({"error": "Invalid credentials"}), 401
         
+        # Upgrade hashes made with an older work factor while we have the password
+        if password_hasher.needs_rehash(user.password_hash):
+            user.password_hash = password_hasher.hash(data['password'])
+            db.session.commit()
+        
         # Create access token
         access_token = create_access_token(identity=user.id)
         
@@ -85,6 +597,7 @@ def login():
 
 @app.route('/api/user/<int:user_id>', methods=['GET'])
 @jwt_required()
+@read_replica
 def get_user(user_id):
     try:
         current_user_id = get_jwt_identity()
@@ -98,7 +611,7 @@ def get_user(user_id):
             "email": user.email,
             "phone_number": user.phone_number,
             "country": user.country,
-            "credits": user.credits,
+            "credits": credit_ledger.balance(user.id),
             "created_at": user.created_at.isoformat()
         }), 200
         
@@ -107,70 +620,218 @@ def get_user(user_id):
 
 @app.route('/api/contacts', methods=['GET'])
 @jwt_required()
+@read_replica
 def get_contacts():
     try:
         current_user_id = get_jwt_identity()
         
-        # Get all users except the current user
-        contacts = User.query.filter(User.id != current_user_id).all()
-        
-        contacts_data = []
-        for contact in contacts:
-            # Get the last message between current user and this contact
-            last_message = Message.query.filter(
-                ((Message.sender_id == current_user_id) & (Message.receiver_id == contact.id)) |
-                ((Message.sender_id == contact.id) & (Message.receiver_id == current_user_id))
-            ).order_by(Message.timestamp.desc()).first()
-            
-            contacts_data.append({
-                "id": contact.id,
-                "username": contact.username,
-                "avatar": contact.avatar,
-                "last_message": last_message.content if last_message else "No messages yet",
-                "last_message_time": last_message.timestamp.isoformat() if last_message else None,
-                "unread_count": Message.query.filter_by(
-                    sender_id=contact.id, 
-                    receiver_id=current_user_id,
-                    read=False
-                ).count()
-            })
+        # Only users we have talked to, with last message and unread count
+        contacts_data, next_cursor = get_conversation_summaries(
+            current_user_id,
+            limit=request.args.get('limit'),
+            before_id=request.args.get('before_id', type=int)
+        )
         
-        return jsonify(contacts_data), 200
+        response = jsonify(contacts_data)
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = str(next_cursor)
+        return response, 200
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/messages/<int:contact_id>', methods=['GET'])
 @jwt_required()
+@read_replica
 def get_messages(contact_id):
     try:
         current_user_id = get_jwt_identity()
         
-        # Get messages between current user and the contact
-        messages = Message.query.filter(
-            ((Message.sender_id == current_user_id) & (Message.receiver_id == contact_id)) |
-            ((Message.sender_id == contact_id) & (Message.receiver_id == current_user_id))
-        ).order_by(Message.timestamp.asc()).all()
+        # Get one page of messages between current user and the contact, as plain rows
+        messages, next_cursor = get_message_page(
+            current_user_id,
+            contact_id,
+            limit=request.args.get('limit'),
+            before_id=request.args.get('before_id', type=int),
+            after_id=request.args.get('after_id', type=int),
+            columns=message_serializer.columns
+        )
+        
+        # Mark messages as read by moving the watermark past the newest one received
+        received = [msg.id for msg in messages if msg.receiver_id == current_user_id]
+        if received:
+            read_receipts.mark_read(current_user_id, contact_id, max(received))
+        
+        # A message is read once the receiver's watermark reaches it
+        read_up_to = {
+            current_user_id: read_receipts.watermark(current_user_id, contact_id),
+            contact_id: read_receipts.watermark(contact_id, current_user_id)
+        }
+        
+        messages_data = message_serializer.rows(messages)
+        for message_data in messages_data:
+            message_data["read"] = message_data["id"] <= read_up_to[message_data["receiver_id"]]
+        
+        response = jsonify(messages_data)
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = str(next_cursor)
+        return response, 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/search', methods=['GET'])
+@jwt_required()
+def search_messages():
+    try:
+        current_user_id = get_jwt_identity()
+        order = request.args.get('order', 'relevance')
+        if order not in ('relevance', 'recent'):
+            return jsonify({"error": "order must be relevance or recent"}), 400
         
-        # Mark messages as read
-        Message.query.filter_by(sender_id=contact_id, receiver_id=current_user_id, read=False).update(
-            {Message.read: True}, synchronize_session=False
+        # Only ever the caller's own conversations, optionally just one of them
+        query = request.args.get('q', '')
+        hits, next_cursor = search_index.search(
+            query,
+            current_user_id,
+            contact_id=request.args.get('contact_id', type=int),
+            limit=clamp_page_size(request.args.get('limit')),
+            cursor=request.args.get('cursor'),
+            order=order
         )
+        
+        words = query_words(query)
+        rows = db.session.query(*message_serializer.columns).filter(Message.id.in_([hit[0] for hit in hits]))
+        messages = {row.id: row for row in rows}
+        results = []
+        for message_id, score in hits:
+            row = messages.get(message_id)
+            if row is None:
+                continue
+            message_data = message_serializer.row(row)
+            message_data["highlight"] = highlight(row.content, words)
+            results.append(message_data)
+        
+        response = jsonify(results)
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
+        
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/presence', methods=['GET'])
+@jwt_required()
+def get_presence():
+    try:
+        user_ids = [int(user_id) for user_id in request.args.get('user_ids', '').split(',') if user_id]
+        online = presence.online(user_ids[:200])
+        return jsonify({str(user_id): user_id in online for user_id in user_ids[:200]}), 200
+        
+    except ValueError:
+        return jsonify({"error": "user_ids must be a comma separated list of ids"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/rooms', methods=['GET'])
+@jwt_required()
+def get_chat_rooms():
+    try:
+        current_user_id = get_jwt_identity()
+        
+        # Public rooms plus private rooms the user belongs to
+        member_of = db.session.query(UserChatRoom.chat_room_id).filter(UserChatRoom.user_id == current_user_id)
+        rooms = ChatRoom.query.filter(
+            (ChatRoom.is_private == False) | ChatRoom.id.in_(member_of)
+        ).order_by(ChatRoom.name).all()
+        
+        joined = {room_id for (room_id,) in member_of}
+        return jsonify([{
+            "id": room.id,
+            "name": room.name,
+            "description": room.description,
+            "is_private": room.is_private,
+            "credit_cost": room.credit_cost,
+            "joined": room.id in joined
+        } for room in rooms]), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/rooms/<int:room_id>/join', methods=['POST'])
+@jwt_required()
+def join_chat_room(room_id):
+    try:
+        current_user_id = get_jwt_identity()
+        
+        room = room_cache.get(room_id)
+        if room is None:
+            return jsonify({"error": "Room not found"}), 404
+        if current_user_id in room.members:
+            return jsonify({"message": "Already a member", "room_id": room_id}), 200
+        if room.is_private:
+            return jsonify({"error": "Room is private"}), 403
+        
+        # Charge the joining fee atomically, in the same transaction as the membership
+        if room.credit_cost:
+            try:
+                credit_ledger.post(current_user_id, -room.credit_cost, 'room_join', f'room:{room_id}')
+            except InsufficientCredits:
+                db.session.rollback()
+                return jsonify({"error": "Not enough credits"}), 402
+        
+        db.session.add(UserChatRoom(user_id=current_user_id, chat_room_id=room_id))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Joined concurrently; the fee was rolled back with the duplicate row
+            db.session.rollback()
+            room_cache.add_member(room_id, current_user_id)
+            return jsonify({"message": "Already a member", "room_id": room_id}), 200
+        
+        cluster_events.publish('room_member_joined', room_id=room_id, user_id=current_user_id)
+        return jsonify({"message": "Joined room", "room_id": room_id, "credits_spent": room.credit_cost}), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/rooms/<int:room_id>/leave', methods=['POST'])
+@jwt_required()
+def leave_chat_room(room_id):
+    try:
+        current_user_id = get_jwt_identity()
+        
+        UserChatRoom.query.filter_by(user_id=current_user_id, chat_room_id=room_id).delete()
         db.session.commit()
+        cluster_events.publish('room_member_left', room_id=room_id, user_id=current_user_id)
         
-        messages_data = []
-        for msg in messages:
-            messages_data.append({
-                "id": msg.id,
-                "sender_id": msg.sender_id,
-                "receiver_id": msg.receiver_id,
-                "content": msg.content,
-                "message_type": msg.message_type,
-                "timestamp": msg.timestamp.isoformat(),
-                "read": msg.read
-            })
+        return jsonify({"message": "Left room", "room_id": room_id}), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/rooms/<int:room_id>/messages', methods=['GET'])
+@jwt_required()
+def get_room_messages(room_id):
+    try:
+        current_user_id = get_jwt_identity()
+        if not room_cache.is_member(room_id, current_user_id):
+            return jsonify({"error": "Unauthorized"}), 403
+        
+        limit = clamp_page_size(request.args.get('limit'))
+        before_id = request.args.get('before_id', type=int)
+        
+        rows = get_room_message_page(room_id, limit, before_id)
         
-        return jsonify(messages_data), 200
+        messages = list(reversed(rows[:limit]))
+        messages_data = room_message_serializer.rows(messages)
+        
+        response = jsonify(messages_data)
+        if len(rows) > limit:
+            response.headers['X-Next-Cursor'] = str(messages[0].id)
+        return response, 200
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -189,16 +850,452 @@ def upload_file():
             return jsonify({"error": "No file selected"}), 400
             
         # Save the file
-        file_path = save_uploaded_file(file, current_user_id)
+        user_file = save_uploaded_file(file, current_user_id, content_store)
+        queue_media_processing(user_file)
         
         return jsonify({
             "message": "File uploaded successfully",
-            "file_path": file_path
+            "file_path": content_store.relative_path(user_file.sha256),
+            "file": file_data(user_file)
         }), 200
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/uploads', methods=['POST'])
+@jwt_required()
+def create_upload():
+    try:
+        current_user_id = get_jwt_identity()
+        data = request.get_json()
+        
+        if not allowed_file(data['filename']):
+            return jsonify({"error": "Invalid file type"}), 400
+        
+        upload = chunked_uploads.create(current_user_id, data['filename'], int(data['size']))
+        return jsonify({
+            "upload_id": upload['upload_id'],
+            "offset": upload['offset'],
+            "size": upload['size'],
+            "chunk_size": app.config.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)
+        }), 201
+        
+    except KeyError as e:
+        return jsonify({"error": f"Missing field: {e.args[0]}"}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@jwt_required()
+def get_upload(upload_id):
+    try:
+        upload = chunked_uploads.status(upload_id, get_jwt_identity())
+        return jsonify({"upload_id": upload_id, "offset": upload['offset'], "size": upload['size']}), 200
+        
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+@jwt_required()
+def append_upload(upload_id):
+    try:
+        current_user_id = get_jwt_identity()
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset is None:
+            return jsonify({"error": "Upload-Offset header is required"}), 400
+        
+        # The body is read straight from the socket, one block at a time
+        upload = chunked_uploads.append(upload_id, current_user_id, offset, request.stream)
+        if 'sha256' not in upload:
+            return jsonify({"upload_id": upload_id, "offset": upload['offset'], "size": upload['size']}), 200
+        
+        user_file = add_file_reference(
+            current_user_id,
+            upload['sha256'],
+            upload['size'],
+            upload['filename'],
+            content_type_for(upload['filename'])
+        )
+        queue_media_processing(user_file)
+        return jsonify({
+            "upload_id": upload_id,
+            "offset": upload['offset'],
+            "size": upload['size'],
+            "file": file_data(user_file)
+        }), 201
+        
+    except OffsetMismatch as e:
+        return jsonify({"error": str(e), "offset": e.offset}), 409
+    except RequestEntityTooLarge:
+        return jsonify({"error": f"Chunks may be at most {app.config.get('MAX_CONTENT_LENGTH')} bytes"}), 413
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def find_media(sha256):
+    """
+    (uploader ids, content type, filename) of stored content, or None when nobody uploaded it
+    """
+    uploads = UserFile.query.filter_by(sha256=sha256).with_entities(UserFile.user_id, UserFile.filename).all()
+    content_type = content_type_for(uploads[0].filename) if uploads else None
+    filename = uploads[0].filename if uploads else None
+    
+    # Previews are visible to whoever may see the file they were made from
+    derived = DerivedFile.query.filter_by(sha256=sha256).all()
+    if derived:
+        content_type = content_type or derived[0].content_type
+        uploads += UserFile.query.filter(
+            UserFile.sha256.in_([preview.source_sha256 for preview in derived])
+        ).with_entities(UserFile.user_id, UserFile.filename).all()
+    
+    if not uploads:
+        return None
+    return {user_id for user_id, _ in uploads}, content_type, filename
+
+@app.route('/api/media/<sha256>', methods=['GET'])
+@jwt_required(optional=True)
+def get_media(sha256):
+    try:
+        current_user_id = get_jwt_identity()
+        # Players that cannot set headers use a URL from /api/media/<sha256>/signed-url
+        signed = current_user_id is None and valid_media_signature(
+            app.config['SECRET_KEY'], sha256, request.args.get('expires'), request.args.get('signature')
+        )
+        if current_user_id is None and not signed:
+            return jsonify({"error": "Missing or expired media signature"}), 401
+        
+        media = find_media(sha256)
+        if media is None or not (signed or can_access_media(current_user_id, media[0])):
+            return jsonify({"error": "File not found"}), 404
+        
+        _, content_type, filename = media
+        return media_response(
+            content_store,
+            sha256,
+            content_type=content_type,
+            filename=filename,
+            accel_redirect=app.config.get('MEDIA_ACCEL_REDIRECT')
+        )
+        
+    except FileNotFoundError:
+        return jsonify({"error": "File not found"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/media/<sha256>/signed-url', methods=['GET'])
+@jwt_required()
+def get_signed_media_url(sha256):
+    try:
+        media = find_media(sha256)
+        if media is None or not can_access_media(get_jwt_identity(), media[0]):
+            return jsonify({"error": "File not found"}), 404
+        
+        ttl = app.config.get('MEDIA_URL_TTL', 300)
+        query = signed_media_query(app.config['SECRET_KEY'], sha256, ttl)
+        return jsonify({
+            "url": f"/api/media/{sha256}?expires={query['expires']}&signature={query['signature']}",
+            "expires_in": ttl
+        }), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/files/<int:file_id>', methods=['DELETE'])
+@jwt_required()
+def delete_file(file_id):
+    try:
+        user_file = UserFile.query.get(file_id)
+        if user_file is None or user_file.user_id != get_jwt_identity():
+            return jsonify({"error": "File not found"}), 404
+        
+        release_file_reference(user_file, content_store)
+        return jsonify({"message": "File deleted", "id": file_id}), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/translate', methods=['POST'])
+@jwt_required()
+def translate():
+    try:
+        data = request.get_json()
+        max_batch = app.config.get('TRANSLATION_MAX_BATCH', 50)
+        
+        # One text into several languages
+        if 'text' in data:
+            languages = data.get('languages') or [data['language']]
+            if len(languages) > max_batch:
+                return jsonify({"error": f"At most {max_batch} languages per request"}), 400
+            
+            translations = translator.translate_to_languages(data['text'], languages)
+            return jsonify({"translations": dict(zip(languages, translations))}), 200
+        
+        # Several texts into one language
+        texts = data['texts']
+        if len(texts) > max_batch:
+            return jsonify({"error": f"At most {max_batch} texts per request"}), 400
+        
+        translations = translator.translate_texts(texts, data['language'])
+        return jsonify({"language": data['language'], "translations": translations}), 200
+        
+    except KeyError as e:
+        return jsonify({"error": f"Missing field: {e.args[0]}"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Credits are an append-only ledger with a cached balance per user
+credit_ledger = CreditLedger(
+    app,
+    cache_size=app.config.get('CREDIT_BALANCE_CACHE_SIZE', 100000),
+    cache_ttl=app.config.get('CREDIT_BALANCE_CACHE_TTL', 30),
+    reconcile_interval=app.config.get('CREDIT_RECONCILE_INTERVAL', 3600)
+)
+
+def report_database():
+    """
+    Print the self-check of every database bind; returns False if one is unreachable or misconfigured
+    """
+    healthy = True
+    for name, report in check_database(db).items():
+        print(f"Database {name}: {report['dialect']}+{report['driver']} {report['url']}")
+        if 'error' in report:
+            print(f"  unreachable: {report['error']}")
+            healthy = False
+            continue
+        pool = ', '.join(f'{key} {value}' for key, value in report.items() if key in ('size', 'checked_in', 'checked_out', 'overflow'))
+        print(f"  {report['latency_ms']}ms to connect and query, {report['pool']}{': ' + pool if pool else ''}")
+        if report.get('pragmas'):
+            print('  ' + ', '.join(f'{key}={value}' for key, value in report['pragmas'].items()))
+        for warning in report['warnings']:
+            print(f"  warning: {warning}")
+            healthy = False
+    return healthy
+
+@app.cli.command('check-database')
+def check_database_command():
+    """
+    Connect to the primary and replica and report pool and driver settings
+    """
+    if not report_database():
+        raise SystemExit(1)
+
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help='List migrations without applying any')
+def migrate_command(status):
+    """
+    Apply the schema migrations this database has not had yet
+    """
+    if status:
+        applied = applied_migrations(db.engine)
+        for version, description, _ in MIGRATIONS:
+            state = f'applied {applied[version]:%Y-%m-%d %H:%M}' if version in applied else 'pending'
+            print(f'{version:>3} {description} ({state})')
+        return
+    done = migrate(db.engine)
+    for version, description in done:
+        print(f'Applied {version}: {description}')
+    print(f'Schema is at version {max(version for version, _, _ in MIGRATIONS)}, {len(done)} migrations applied')
+
+@app.cli.command('partition-messages')
+@click.option('--months', default=3, show_default=True, help='Months ahead to create partitions for')
+@click.option('--convert', is_flag=True, help='Partition a MySQL messages table that is not partitioned yet')
+def partition_messages(months, convert):
+    """
+    Create the monthly message partitions ahead of time; run it monthly
+    """
+    try:
+        created = ensure_message_partitions(db.engine, months_ahead=months, convert=convert)
+    except RuntimeError as e:
+        print(e)
+        raise SystemExit(1)
+    print(f"Created {', '.join(created)}" if created else 'All partitions already exist')
+
+def hot_queries():
+    """
+    The reads behind chat lists, histories, sync and balances, as (name, function running them)
+    """
+    user_id, contact_id, room_id, cursor = 1, 2, 1, 1 << 52
+    columns = message_serializer.columns
+    return [
+        ('conversation list', lambda: get_conversation_summaries(user_id)),
+        ('conversation list, older page', lambda: get_conversation_summaries(user_id, before_id=cursor)),
+        ('message history', lambda: get_message_page(user_id, contact_id, columns=columns)),
+        ('message history, older page', lambda: get_message_page(user_id, contact_id, before_id=cursor, columns=columns)),
+        ('message history, newer page', lambda: get_message_page(user_id, contact_id, after_id=0, columns=columns)),
+        ('reconnect sync', lambda: get_message_delta(user_id, {contact_id: 0}, columns, since=0)),
+        ('AI reply context', lambda: get_recent_messages(user_id, contact_id, 10)),
+        ('conversation partners', lambda: get_conversation_partners(user_id)),
+        ('read watermark', lambda: get_read_watermark(user_id, contact_id)),
+        ('room history', lambda: get_room_message_page(room_id, DEFAULT_PAGE_SIZE, before_id=cursor)),
+        ('credit balance', lambda: credit_ledger.balance(user_id)),
+        ('credit transactions', lambda: credit_ledger.transactions(user_id, DEFAULT_PAGE_SIZE, before_id=cursor))
+    ]
+
+@app.cli.command('check-query-plans')
+@click.option('--verbose', is_flag=True, help='Print every plan')
+def check_query_plans(verbose):
+    """
+    EXPLAIN every hot query and fail if one reads a table without an index
+    """
+    tables = set(db.metadata.tables)
+    failed = 0
+    for name, run in hot_queries():
+        with capture_selects(db.engine) as statements:
+            run()
+        db.session.rollback()
+        
+        scans = set()
+        plans = []
+        with db.engine.connect() as connection:
+            for statement, parameters in statements:
+                table_scans, plan = full_scans(connection, statement, parameters, tables)
+                scans.update(table_scans)
+                plans.append(plan)
+        
+        if scans:
+            failed += 1
+        print(f"{name:<32} {'full scan of ' + ', '.join(sorted(scans)) if scans else 'ok'}")
+        if verbose or scans:
+            for plan in plans:
+                for line in plan:
+                    print(f'    {line}')
+    if failed:
+        raise SystemExit(1)
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """
+    Index messages written before search existed, or after the index file was lost
+    """
+    # Re-adding a message replaces it, so running this next to live indexing is safe
+    last_id = 0
+    total = 0
+    while True:
+        rows = db.session.query(Message.id, Message.sender_id, Message.receiver_id, Message.content).filter(
+            Message.id > last_id
+        ).order_by(Message.id).limit(5000).all()
+        if not rows:
+            break
+        search_index.add_many(rows)
+        last_id = rows[-1][0]
+        total += len(rows)
+    print(f'{total} messages indexed')
+
+@app.cli.command('reconcile-credits')
+def reconcile_credits():
+    """
+    Check every balance against the ledger and repair the ones that drifted
+    """
+    mismatches = credit_ledger.reconcile(full=True)
+    for user_id, balance, total in mismatches:
+        print(f'User {user_id}: balance was {balance}, ledger says {total}')
+    print(f'{len(mismatches)} balances repaired')
+
+# Stripe is called from a worker pool; payments are confirmed by its result or the webhook
+configure_stripe(app.config.get('STRIPE_SECRET_KEY'), app.config.get('STRIPE_API_BASE'))
+payment_jobs = JobQueue(
+    MemoryBackend(max_size=app.config.get('JOB_QUEUE_SIZE', 1000)),
+    workers=app.config.get('PAYMENT_WORKERS', 4),
+    timeout=app.config.get('PAYMENT_TIMEOUT', 60)
+)
+
+def payment_data(payment):
+    return {
+        "id": payment.id,
+        "status": payment.status,
+        "amount": payment.amount,
+        "currency": payment.currency,
+        "credits": payment.credits,
+        "error": payment.error,
+        "created_at": payment.created_at.isoformat(),
+        "updated_at": payment.updated_at.isoformat()
+    }
+
+def notify_payment(payment_id, extra=None):
+    """
+    Tell the buyer's connections how a payment ended, with their new balance
+    """
+    payment = Payment.query.get(payment_id)
+    data = payment_data(payment)
+    data['balance'] = credit_ledger.balance(payment.user_id)
+    data.update(extra or {})
+    socketio.emit('payment_updated', data, room=f"user_{payment.user_id}")
+
+def deliver_payment(job, result, error):
+    """
+    Record the PaymentIntent outcome; successes and failures settle the payment
+    """
+    payment_id = job.payload['payment_id']
+    if error is not None:
+        # The intent may still have gone through; the webhook or sweep_payments settles it then
+        print(f'Payment {payment_id} could not be confirmed: {error}')
+        return
+    
+    with app.app_context():
+        if result.get('customer_id'):
+            record_customer(job.user_id, result['customer_id'])
+        
+        status = result['status']
+        if status not in FINAL_STATUSES:
+            # processing, or waiting for the customer; the webhook has the last word
+            status = 'requires_action' if status == 'requires_action' else 'pending'
+        settle_payment(
+            credit_ledger, payment_id, status, result.get('intent_id'), result.get('error'),
+            amount_received=result.get('amount_received'), currency=result.get('currency')
+        )
+        notify_payment(payment_id, {"client_secret": result.get('client_secret')})
+
+payment_jobs.register('create_payment_intent', create_payment_intent, deliver_payment)
+payment_jobs.register('find_payment_intent', find_payment_intent, deliver_payment)
+
+def sweep_payments():
+    """
+    Look up at Stripe the payments left pending for PAYMENT_SWEEP_AGE seconds
+    """
+    now = datetime.utcnow()
+    with app.app_context():
+        stale = Payment.query.filter(
+            Payment.status == 'pending',
+            Payment.updated_at < now - timedelta(seconds=app.config.get('PAYMENT_SWEEP_AGE', 600))
+        ).order_by(Payment.id).limit(100).all()
+        for payment in stale:
+            payment_jobs.submit('find_payment_intent', {
+                'payment_id': payment.id,
+                'user_id': payment.user_id,
+                'customer_id': db.session.query(User.stripe_customer_id).filter_by(id=payment.user_id).scalar(),
+                'intent_id': payment.stripe_payment_intent_id,
+                'created': calendar.timegm(payment.created_at.utctimetuple())
+            })
+            # Not looked up again before the next PAYMENT_SWEEP_AGE has passed
+            payment.updated_at = now
+        db.session.commit()
+
+def run_payment_sweeper():
+    while True:
+        time.sleep(app.config.get('PAYMENT_SWEEP_INTERVAL', 300))
+        try:
+            sweep_payments()
+        except Exception as e:
+            print(f'Payment sweep failed: {e}')
+
+def credit_packages(packages):
+    """
+    Check the configured packages; their credits and price are set here, never by the client
+    """
+    for package_id, package in packages.items():
+        if package['credits'] <= 0 or package['amount'] <= 0:
+            raise RuntimeError(f"Credit package {package_id} must have positive credits and amount")
+    return packages
+
+CREDIT_PACKAGES = credit_packages(app.config.get('CREDIT_PACKAGES', {}))
+
 @app.route('/api/payment/process', methods=['POST'])
 @jwt_required()
 def process_payment_route():
@@ -206,60 +1303,296 @@ def process_payment_route():
         current_user_id = get_jwt_identity()
         data = request.get_json()
         
-        # Process payment
-        result = process_payment(
+        # Retried requests carry the same key and get the same payment back
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key') or uuid.uuid4().hex
+        if len(idempotency_key) > 64:
+            return jsonify({"error": "Idempotency key too long"}), 400
+        
+        payment = Payment.query.filter_by(user_id=current_user_id, idempotency_key=idempotency_key).first()
+        if payment is not None:
+            return jsonify(payment_data(payment)), 200 if payment.status in FINAL_STATUSES else 202
+        
+        package = CREDIT_PACKAGES.get(data['package_id'])
+        if package is None:
+            return jsonify({"error": "Unknown credit package"}), 400
+        
+        payment = Payment(
             user_id=current_user_id,
-            amount=data['amount'],
-            currency=data['currency'],
-            payment_method=data['payment_method'],
-            card_token=data.get('card_token')
+            idempotency_key=idempotency_key,
+            amount=package['amount'],
+            currency=package['currency'].upper(),
+            credits=package['credits']
         )
-        
-        if result['success']:
-            # Add credits to user
-            user = User.query.get(current_user_id)
-            user.credits += data['credits']
+        db.session.add(payment)
+        try:
             db.session.commit()
-            
-            return jsonify({
-                "message": "Payment processed successfully",
-                "credits_added": data['credits'],
-                "new_balance": user.credits
-            }), 200
-        else:
-            return jsonify({"error": result['message']}), 400
-            
+        except IntegrityError:
+            # The same request arrived twice at once
+            db.session.rollback()
+            payment = Payment.query.filter_by(user_id=current_user_id, idempotency_key=idempotency_key).first()
+            return jsonify(payment_data(payment)), 200 if payment.status in FINAL_STATUSES else 202
+        
+        customer_id = db.session.query(User.stripe_customer_id).filter_by(id=current_user_id).scalar()
+        try:
+            payment_jobs.submit('create_payment_intent', {
+                'payment_id': payment.id,
+                'user_id': current_user_id,
+                'customer_id': customer_id,
+                'amount': payment.amount,
+                'currency': payment.currency,
+                'payment_method': data.get('payment_method'),
+                'card_token': data.get('card_token')
+            }, user_id=current_user_id)
+        except QueueFull as e:
+            settle_payment(credit_ledger, payment.id, 'failed', error=str(e))
+            return jsonify({"error": str(e)}), 429
+        
+        return jsonify(payment_data(payment)), 202
+        
+    except KeyError as e:
+        return jsonify({"error": f"Missing field: {e.args[0]}"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/payment/<int:payment_id>', methods=['GET'])
+@jwt_required()
+def get_payment(payment_id):
+    try:
+        current_user_id = get_jwt_identity()
+        payment = Payment.query.filter_by(id=payment_id, user_id=current_user_id).first()
+        if payment is None:
+            return jsonify({"error": "Payment not found"}), 404
+        
+        return jsonify(payment_data(payment)), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/credits', methods=['GET'])
+@jwt_required()
+def get_credit_transactions():
+    try:
+        current_user_id = get_jwt_identity()
+        transactions, next_cursor = credit_ledger.transactions(
+            current_user_id,
+            limit=clamp_page_size(request.args.get('limit')),
+            before_id=request.args.get('before_id', type=int)
+        )
+        
+        response = jsonify({
+            "balance": credit_ledger.balance(current_user_id),
+            "transactions": [{
+                "id": transaction.id,
+                "amount": transaction.amount,
+                "balance_after": transaction.balance_after,
+                "reason": transaction.reason,
+                "reference": transaction.reference,
+                "created_at": transaction.created_at.isoformat()
+            } for transaction in transactions]
+        })
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = str(next_cursor)
+        return response, 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/payment/webhook', methods=['POST'])
+def stripe_webhook():
+    try:
+        event = parse_webhook(
+            request.get_data(),
+            request.headers.get('Stripe-Signature'),
+            app.config.get('STRIPE_WEBHOOK_SECRET'),
+            allow_unsigned=app.config.get('STRIPE_WEBHOOK_ALLOW_UNSIGNED', False)
+        )
+    except ValueError as e:
+        return jsonify({"error": f"Invalid webhook: {e}"}), 400
+    
+    try:
+        outcomes = {
+            'payment_intent.succeeded': 'succeeded',
+            'payment_intent.payment_failed': 'failed',
+            'payment_intent.canceled': 'failed'
+        }
+        if event['type'] not in outcomes:
+            return jsonify({"received": True}), 200
+        
+        intent = event['data']['object']
+        payment_id = (intent.get('metadata') or {}).get('payment_id')
+        if payment_id is None:
+            payment_id = db.session.query(Payment.id).filter_by(stripe_payment_intent_id=intent['id']).scalar()
+        if payment_id is None:
+            return jsonify({"received": True}), 200
+        
+        error = (intent.get('last_payment_error') or {}).get('message')
+        settled = settle_payment(
+            credit_ledger, int(payment_id), outcomes[event['type']], intent['id'], error,
+            amount_received=intent.get('amount_received'), currency=intent.get('currency')
+        )
+        if settled:
+            notify_payment(int(payment_id))
+        
+        return jsonify({"received": True}), 200
+        
     except Exception as e:
+        # Stripe retries deliveries that fail
         return jsonify({"error": str(e)}), 500
 
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
     print('Client connected')
+    
+    # Verify the token once; later events use the identity cached in the session
+    try:
+        user_id = authenticate_socket(auth)
+        if user_id is not None:
+            join_room(f"user_{user_id}")
+            presence.connect(user_id, request.sid)
+    except Exception as e:
+        print(f'Invalid socket token: {e}')
+    
     emit('connected', {'data': 'Connected to chat server'})
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print('Client disconnected')
+    if socket_identity() is not None:
+        presence.disconnect(socket_identity(), request.sid)
+
+@socketio.on('refresh_token')
+def handle_refresh_token(data):
+    try:
+        was_authenticated = socket_identity() is not None
+        user_id = authenticate_socket({'token': data['token']})
+        if user_id is None:
+            emit('unauthorized', {'message': 'Invalid token'})
+            return
+        
+        if not was_authenticated:
+            join_room(f"user_{user_id}")
+            presence.connect(user_id, request.sid)
+        emit('token_refreshed', {'expires_at': session.get('token_exp')})
+    except Exception as e:
+        emit('unauthorized', {'message': str(e)})
+
+@socketio.on('heartbeat')
+def handle_heartbeat(data=None):
+    if socket_identity() is not None:
+        presence.heartbeat(socket_identity(), request.sid)
 
 @socketio.on('join_chat')
-@jwt_required()
+@socket_auth_required
 def handle_join_chat(data):
     try:
-        user_id = get_jwt_identity()
+        user_id = socket_identity()
         room = f"chat_{data['contact_id']}_{user_id}" if 'contact_id' in data else f"user_{user_id}"
         join_room(room)
         emit('joined_room', {'room': room})
     except Exception as e:
         emit('error', {'message': str(e)})
 
-@socketio.on('send_message')
-@jwt_required()
-def handle_send_message(data):
+@socketio.on('mark_read')
+@socket_auth_required
+def handle_mark_read(data):
+    try:
+        user_id = socket_identity()
+        
+        # Ids are time ordered, so nothing newer than now can have been delivered yet
+        message_id = min(int(data['message_id']), max_id_before(int(time.time() * 1000) + 2))
+        read_receipts.mark_read(user_id, int(data['contact_id']), message_id)
+    except Exception as e:
+        emit('error', {'message': str(e)})
+
+@socketio.on('sync')
+@socket_auth_required
+def handle_sync(data=None):
+    """
+    Catch a (re)connecting client up on every conversation in one batch.
+    
+    The client sends `conversations`, the newest message id it holds per
+    contact, and `since`, the `since` of its last complete sync. The reply
+    holds what is newer, from the database and the delivery queue; with
+    `has_more` the client asks again with the returned `since`.
+    """
+    try:
+        user_id = socket_identity()
+        data = data or {}
+        marks = dict(
+            (int(contact_id), int(mark))
+            for contact_id, mark in list((data.get('conversations') or {}).items())[:app.config.get('SYNC_MAX_CONVERSATIONS', 1000)]
+        )
+        since = int(data['since']) if data.get('since') is not None else None
+        limit = app.config.get('SYNC_BATCH_SIZE', 500)
+        
+        rows, has_more = get_message_delta(user_id, marks, message_serializer.columns, since=since, limit=limit)
+        messages = message_serializer.rows(rows)
+        
+        # Queued messages may not be written yet; past a full page they come with the next one
+        seen = {message['id'] for message in messages}
+        last_id = messages[-1]['id'] if messages else None
+        for message in delivery_queue.pending(user_id):
+            partner_id = message['sender_id'] if message['receiver_id'] == user_id else message['receiver_id']
+            mark = marks.get(partner_id, since)
+            if message['id'] in seen or (mark is not None and message['id'] <= mark):
+                continue
+            if has_more and message['id'] > last_id:
+                continue
+            messages.append(dict(message))
+        messages.sort(key=lambda message: message['id'])
+        
+        watermarks = {}
+        for message in messages:
+            key = (message['receiver_id'], message['sender_id'])
+            if key not in watermarks:
+                watermarks[key] = read_receipts.watermark(*key)
+            message['read'] = message['id'] <= watermarks[key]
+            message.pop('client_id', None)
+        
+        newest = messages[-1]['id'] if messages else None
+        emit('sync', {
+            'messages': messages,
+            'has_more': has_more,
+            'since': max(filter(None, (since, newest)), default=None)
+        })
+    except Exception as e:
+        emit('error', {'message': str(e)})
+
+@socketio.on('ack_messages')
+@socket_auth_required
+def handle_ack_messages(data):
+    try:
+        delivery_queue.ack(socket_identity(), [int(message_id) for message_id in data['ids']])
+    except Exception as e:
+        emit('error', {'message': str(e)})
+
+@socketio.on('join_chat_room')
+@socket_auth_required
+def handle_join_chat_room(data):
+    try:
+        user_id = socket_identity()
+        room_id = int(data['room_id'])
+        if not room_cache.is_member(room_id, user_id):
+            emit('error', {'message': 'Not a member of this room'})
+            return
+        
+        room = room_channel(room_id)
+        join_room(room)
+        emit('joined_room', {'room': room})
+    except Exception as e:
+        emit('error', {'message': str(e)})
+
+@socketio.on('send_room_message')
+@socket_auth_required
+def handle_send_room_message(data):
     try:
-        user_id = get_jwt_identity()
+        user_id = socket_identity()
+        room_id = int(data['room_id'])
+        if not room_cache.is_member(room_id, user_id):
+            emit('error', {'message': 'Not a member of this room'})
+            return
         
-        # AI content moderation
-        moderation_result = ai_assistant.moderate_content(data['content'])
+        moderation_result = moderation.moderate(data['content'])
         if moderation_result['flagged']:
             emit('message_blocked', {
                 'message': 'Message contains inappropriate content',
@@ -267,83 +1600,291 @@ def handle_send_message(data):
             })
             return
         
-        # Create new message
-        new_message = Message(
+        room_message, _ = save_message(
+            RoomMessage,
+            chat_room_id=room_id,
             sender_id=user_id,
-            receiver_id=data['receiver_id'],
             content=data['content'],
             message_type=data.get('type', 'text')
         )
         
-        db.session.add(new_message)
-        db.session.commit()
+        # One broadcast reaches every member connected to the room
+        emit('new_room_message', room_message_serializer.obj(room_message), room=room_channel(room_id))
+    except Exception as e:
+        emit('error', {'message': str(e)})
+
+def retract_if_flagged(future, written, message_id, user_ids, rooms):
+    """
+    Delete an optimistically delivered message once moderation flags it
+    """
+    try:
+        moderation_result = future.result()
+    except Exception:
+        return
+    
+    if not moderation_result['flagged']:
+        return
+    
+    # Drop it from the write buffer, or wait for its batch so the delete sticks
+    if not message_writer.discard(Message, message_id):
+        try:
+            written.result(timeout=30)
+        except Exception:
+            pass
+        with app.app_context():
+            Message.query.filter_by(id=message_id).delete()
+            db.session.commit()
+        search_index.remove(message_id)
+    # Other processes may have loaded it into their AI context too
+    cluster_events.publish('context_invalidated', user_ids=list(user_ids))
+    for user_id in user_ids:
+        delivery_queue.remove(user_id, message_id)
+    
+    for room in rooms:
+        socketio.emit('message_retracted', {
+            'id': message_id,
+            'reason': moderation_result['reason']
+        }, room=room)
+
+def stream_ai_response(conversation, stream_id, sender_id, receiver_id, rooms):
+    """
+    Emit an AI reply to the rooms chunk by chunk and return the full text
+    """
+    started = time.monotonic()
+    chunks = []
+    
+    for delta in ai_assistant.stream_response(conversation):
+        if not chunks:
+            metrics.observe('ai_time_to_first_token', time.monotonic() - started)
         
-        # Prepare message data for emission
-        message_data = {
-            'id': new_message.id,
-            'sender_id': new_message.sender_id,
-            'receiver_id': new_message.receiver_id,
-            'content': new_message.content,
-            'message_type': new_message.message_type,
-            'timestamp': new_message.timestamp.isoformat(),
-            'read': new_message.read
+        chunk_data = {
+            'stream_id': stream_id,
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'index': len(chunks),
+            'delta': delta
         }
+        chunks.append(delta)
+        
+        for room in rooms:
+            socketio.emit('ai_message_chunk', chunk_data, room=room)
+    
+    metrics.observe('ai_response_duration', time.monotonic() - started)
+    return ''.join(chunks).strip()
+
+def run_ai_reply(payload):
+    """
+    Job: generate the AI reply text, streaming it when a stream id is set
+    """
+    if payload.get('stream_id'):
+        return stream_ai_response(
+            payload['conversation'],
+            payload['stream_id'],
+            payload['sender_id'],
+            payload['receiver_id'],
+            payload['rooms']
+        )
+    return ai_assistant.generate_response(payload['conversation'])
+
+def load_recent_messages(user_id, contact_id, limit):
+    """
+    Last `limit` messages between two users, oldest first, including ones still in the write buffer
+    """
+    low_id, high_id = conversation_key(user_id, contact_id)
+    # Read the buffer first: a row committed meanwhile is then found by the query instead
+    buffered = message_writer.pending(Message, lambda row: row['user_low_id'] == low_id and row['user_high_id'] == high_id)
+    messages = {message.id: message for message in get_recent_messages(user_id, contact_id, limit)}
+    for row in buffered:
+        messages.setdefault(row['id'], Message(**row))
+    return [messages[message_id] for message_id in sorted(messages)][-limit:]
+
+def deliver_ai_reply(job, ai_response, error):
+    """
+    Persist a finished AI reply and emit it to the chat rooms
+    """
+    if error is not None:
+        for room in job.rooms:
+            socketio.emit('ai_error', {'message': str(error)}, room=room)
+        return
+    
+    with app.app_context():
+        # Create AI message
+        ai_message, _ = save_message(
+            Message,
+            sender_id=job.payload['sender_id'],
+            receiver_id=job.payload['receiver_id'],
+            content=ai_response,
+            message_type='text',
+            is_ai_generated=True
+        )
+        context_cache.append(ai_message)
+        
+        # Prepare AI message data
+        ai_message_data = message_serializer.obj(ai_message)
+        ai_message_data['read'] = ai_message.read
+        if job.payload.get('stream_id'):
+            ai_message_data['stream_id'] = job.payload['stream_id']
+    
+    # Emit AI response, and keep it for the receiver until a device acks it
+    delivery_queue.push(ai_message.receiver_id, ai_message_data)
+    socketio.emit('new_message', ai_message_data, to=job.rooms + [f"user_{ai_message.receiver_id}"])
+
+job_queue.register('ai_reply', run_ai_reply, deliver_ai_reply)
+
+def run_translation(payload):
+    """
+    Job: translate a message into the requested languages
+    """
+    return translator.translate_to_languages(payload['content'], payload['languages'])
+
+def deliver_translation(job, translations, error):
+    """
+    Send finished translations back to the requesting connection
+    """
+    if error is not None:
+        for room in job.rooms:
+            socketio.emit('error', {'message': str(error)}, room=room)
+        return
+    
+    for room in job.rooms:
+        socketio.emit('message_translated', {
+            'message_id': job.payload['message_id'],
+            'translations': dict(zip(job.payload['languages'], translations))
+        }, room=room)
+
+job_queue.register('translate', run_translation, deliver_translation)
+
+@socketio.on('translate_message')
+@socket_auth_required
+def handle_translate_message(data):
+    try:
+        user_id = socket_identity()
+        languages = data.get('languages') or [data['language']]
+        
+        message = Message.query.get(data['message_id'])
+        if message is None or user_id not in (message.sender_id, message.receiver_id):
+            emit('error', {'message': 'Message not found'})
+            return
+        
+        job_queue.submit('translate', {
+            'message_id': message.id,
+            'content': message.content,
+            'languages': languages[:app.config.get('TRANSLATION_MAX_BATCH', 50)]
+        }, user_id=user_id, rooms=[request.sid])
+    except QueueFull as e:
+        emit('ai_busy', {'message': str(e)})
+    except Exception as e:
+        emit('error', {'message': str(e)})
+
+@socketio.on('send_message')
+@socket_auth_required
+def handle_send_message(data):
+    try:
+        user_id = socket_identity()
+        optimistic = app.config.get('MODERATION_MODE') == 'optimistic'
+        
+        # AI content moderation, unless the message is delivered first and checked afterwards
+        if not optimistic:
+            moderation_result = moderation.moderate(data['content'])
+            if moderation_result['flagged']:
+                emit('message_blocked', {
+                    'message': 'Message contains inappropriate content',
+                    'reason': moderation_result['reason']
+                })
+                return
+        
+        # Attached uploads carry their previews, or a pending marker until they are built
+        attachment = None
+        if data.get('file_id') is not None:
+            attachment = UserFile.query.get(data['file_id'])
+            if attachment is None or attachment.user_id != user_id:
+                emit('error', {'message': 'File not found'})
+                return
+        
+        # Create new message; it is written to the database in the next batch
+        new_message, written = save_message(
+            Message,
+            sender_id=user_id,
+            receiver_id=data['receiver_id'],
+            content=data['content'],
+            message_type=data.get('type', 'text'),
+            file_id=attachment.id if attachment else None,
+            media=attachment.stored_file.media if attachment else None
+        )
+        context_cache.append(new_message)
+        
+        # Prepare message data for emission
+        message_data = message_serializer.obj(new_message)
+        message_data['read'] = new_message.read
+        if data.get('client_id'):
+            # Lets the sender match the delivered message to its local copy
+            message_data['client_id'] = data['client_id']
         
-        # Emit to both users
+        # Emit to both users, wherever they are in the app; each connection gets it once
         room1 = f"chat_{user_id}_{data['receiver_id']}"
         room2 = f"chat_{data['receiver_id']}_{user_id}"
-        emit('new_message', message_data, room=room1)
-        emit('new_message', message_data, room=room2)
+        delivery_queue.push(data['receiver_id'], message_data)
+        emit('new_message', message_data, to=[room1, room2, f"user_{data['receiver_id']}", f"user_{user_id}"])
+        
+        if optimistic:
+            message_id = new_message.id
+            moderation.submit(data['content']).add_done_callback(
+                lambda future: retract_if_flagged(future, written, message_id, (user_id, data['receiver_id']), [room1, room2])
+            )
         
         # Generate AI response if enabled
         if data.get('ai_response', False):
             # Get conversation history
-            messages = Message.query.filter(
-                ((Message.sender_id == user_id) & (Message.receiver_id == data['receiver_id'])) |
-                ((Message.sender_id == data['receiver_id']) & (Message.receiver_id == user_id))
-            ).order_by(Message.timestamp.desc()).limit(10).all()
-            
-            # Format conversation for AI
-            conversation = []
-            for msg in reversed(messages):
-                role = "user" if msg.sender_id == user_id else "assistant"
-                conversation.append({"role": role, "content": msg.content})
-            
-            # Generate AI response
-            ai_response = ai_assistant.generate_response(conversation)
-            
-            # Create AI message
-            ai_message = Message(
-                sender_id=data['receiver_id'],  # Simulating the other user
-                receiver_id=user_id,
-                content=ai_response,
-                message_type='text',
-                is_ai_generated=True
+            conversation = context_cache.get_context(
+                user_id,
+                data['receiver_id'],
+                lambda limit: load_recent_messages(user_id, data['receiver_id'], limit)
             )
             
-            db.session.add(ai_message)
-            db.session.commit()
-            
-            # Prepare AI message data
-            ai_message_data = {
-                'id': ai_message.id,
-                'sender_id': ai_message.sender_id,
-                'receiver_id': ai_message.receiver_id,
-                'content': ai_message.content,
-                'message_type': ai_message.message_type,
-                'timestamp': ai_message.timestamp.isoformat(),
-                'read': ai_message.read,
-                'is_ai_generated': ai_message.is_ai_generated
-            }
+            # Chunks can only be emitted from threads of this process
+            stream = app.config.get('AI_STREAM_RESPONSES', True) and app.config.get('JOB_EXECUTOR', 'thread') == 'thread'
             
-            # Emit AI response
-            emit('new_message', ai_message_data, room=room1)
-            emit('new_message', ai_message_data, room=room2)
+            try:
+                job_queue.submit('ai_reply', {
+                    'conversation': conversation,
+                    'sender_id': data['receiver_id'],  # Simulating the other user
+                    'receiver_id': user_id,
+                    'stream_id': uuid.uuid4().hex if stream else None,
+                    'rooms': [room1, room2]
+                }, user_id=user_id, rooms=[room1, room2])
+            except QueueFull as e:
+                emit('ai_busy', {'message': str(e)})
             
     except Exception as e:
         emit('error', {'message': str(e)})
 
+def init_services():
+    """
+    Connect Socket.IO, open the search index and start the credit reconciler, cluster events and payment sweeper
+    """
+    global search_index
+    socketio.init_app(
+        app,
+        cors_allowed_origins="*",
+        async_mode='eventlet',
+        **socketio_queue_options(app.config.get('SOCKETIO_MESSAGE_QUEUE')),
+        **socketio_options(app.config.get('SOCKETIO_SERIALIZER', 'json'))
+    )
+    search_index = MessageSearchIndex(search_db_path())
+    credit_ledger.start()
+    cluster_events.start()
+    if app.config.get('PAYMENT_SWEEP_INTERVAL', 300):
+        socketio.start_background_task(run_payment_sweeper)
+
+if __name__ != '__mp_main__':
+    init_services()
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
-    socketio.run(app, debug=app.config['DEBUG'], host=app.config['HOST'], port=app.config['PORT'])
+        for version, description in migrate(db.engine):
+            print(f'Applied migration {version}: {description}')
+        report_database()
+    try:
+        socketio.run(app, debug=app.config['DEBUG'], host=app.config['HOST'], port=app.config['PORT'])
+    finally:
+        media_jobs.stop()
@@ -0,0 +1,59 @@
+"""
+Throughput of the blocklist matcher against blocklists of growing size.
+
+Usage: python benchmarks/bench_content_filter.py [messages]
+"""
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.content_filter import BlocklistMatcher
+
+SIZES = [10, 100, 1000, 10000, 100000]
+
+def random_word(rng, low=4, high=10):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(low, high)))
+
+def make_messages(rng, count, words=12):
+    return [' '.join(random_word(rng, 2, 8) for _ in range(words)) for _ in range(count)]
+
+def naive_check(terms, text):
+    text_lower = text.lower()
+    for word in terms:
+        if word in text_lower:
+            return word
+    return None
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = random.Random(42)
+    messages = make_messages(rng, count)
+
+    print(f"{'terms':>8} {'compile s':>10} {'matcher msg/s':>14} {'naive msg/s':>12}")
+    for size in SIZES:
+        terms = [random_word(rng) for _ in range(size)]
+
+        started = time.perf_counter()
+        matcher = BlocklistMatcher(terms=terms)
+        compile_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for text in messages:
+            matcher.find(text)
+        matcher_rate = count / (time.perf_counter() - started)
+
+        # The old substring scan gets slow quickly, so sample fewer messages
+        sample = messages[:max(100, count // max(1, size // 10))]
+        started = time.perf_counter()
+        for text in sample:
+            naive_check(terms, text)
+        naive_rate = len(sample) / (time.perf_counter() - started)
+
+        print(f"{size:>8} {compile_time:>10.2f} {matcher_rate:>14.0f} {naive_rate:>12.0f}")
+
+if __name__ == '__main__':
+    main()
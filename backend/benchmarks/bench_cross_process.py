@@ -0,0 +1,106 @@
+"""
+Cross-process room delivery through the local message queue.
+
+Starts a LocalBroker and N Socket.IO server processes sharing it, connects
+one real client to each server and joins them all to one room. Every
+client then asks its own server to emit M messages to the room, so each
+client must receive N * M messages, most of them emitted by other
+processes. Prints delivered counts and aggregate deliveries per second.
+
+Needs the Socket.IO client extras: pip install "python-socketio[client]"
+
+Usage: python benchmarks/bench_cross_process.py [messages_per_worker]
+"""
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROCESS_COUNTS = [1, 2, 4, 8]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def serve(url, port):
+    import logging
+    import socketio
+    from werkzeug.serving import make_server
+    from utils.message_queue import LocalQueueManager
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    sio = socketio.Server(async_mode='threading', client_manager=LocalQueueManager(url))
+
+    @sio.on('join')
+    def handle_join(sid, room):
+        sio.enter_room(sid, room)
+
+    @sio.on('blast')
+    def handle_blast(sid, data):
+        for sequence in range(data['messages']):
+            sio.emit('new_room_message', {'worker': port, 'sequence': sequence}, room=data['room'])
+
+    make_server('127.0.0.1', port, socketio.WSGIApp(sio), threaded=True).serve_forever()
+
+def run(url, workers, messages):
+    import socketio
+
+    ctx = multiprocessing.get_context('spawn')
+    ports = [free_port() for _ in range(workers)]
+    servers = [ctx.Process(target=serve, args=(url, port), daemon=True) for port in ports]
+    for server in servers:
+        server.start()
+
+    expected = workers * messages
+    clients = []
+    for port in ports:
+        client = socketio.Client()
+        client.received = 0
+        client.done = threading.Event()
+
+        def on_message(data, client=client):
+            client.received += 1
+            if client.received >= expected:
+                client.done.set()
+
+        client.on('new_room_message', on_message)
+        client.connect(f'http://127.0.0.1:{port}', transports=['websocket'], retry=True, wait_timeout=10)
+        client.call('join', 'room_1')
+        clients.append(client)
+
+    # Let every server's queue listener subscribe before publishing
+    time.sleep(0.5)
+
+    started = time.perf_counter()
+    for client in clients:
+        client.emit('blast', {'room': 'room_1', 'messages': messages})
+    for client in clients:
+        client.done.wait(timeout=60)
+    elapsed = time.perf_counter() - started
+
+    delivered = sum(client.received for client in clients)
+    for client in clients:
+        client.disconnect()
+    for server in servers:
+        server.terminate()
+    return delivered, expected * workers, elapsed
+
+def main():
+    from utils.message_queue import LocalBroker
+
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    url = LocalBroker(port=0).start()
+
+    print(f"{'workers':>8} {'delivered':>13} {'seconds':>8} {'deliveries/s':>13}")
+    for workers in PROCESS_COUNTS:
+        delivered, expected, elapsed = run(url, workers, messages)
+        status = '' if delivered == expected else '  INCOMPLETE'
+        print(f"{workers:>8} {delivered:>6}/{expected:<6} {elapsed:>8.2f} {delivered / elapsed:>13.0f}{status}")
+
+if __name__ == '__main__':
+    main()
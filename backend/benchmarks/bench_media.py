@@ -0,0 +1,85 @@
+"""
+Media download throughput and memory against a naive whole-file read.
+
+Serves one stored file through the app's media response and through a
+handler that reads the file into memory, consuming each body the way a
+WSGI server would. Prints time per request, bytes sent, MB/s and the
+peak Python memory allocated, for full downloads and for 1MB range
+requests (the naive handler ignores Range and sends the whole file).
+
+Usage: python benchmarks/bench_media.py [file_mb]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, Response
+from utils.file_upload import ContentStore
+from utils.media import media_response
+
+ROUNDS = 5
+
+def build_app(store, sha256):
+    app = Flask(__name__)
+
+    @app.route('/naive')
+    def naive():
+        with open(store.path_for(sha256), 'rb') as f:
+            return Response(f.read(), mimetype='video/mp4')
+
+    @app.route('/media')
+    def media():
+        return media_response(store, sha256, 'video/mp4')
+
+    return app
+
+def consume(client, path, headers=None):
+    response = client.get(path, headers=headers, buffered=False)
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    response.close()
+    return size
+
+def measure(client, path, headers=None):
+    consume(client, path, headers)
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = 0
+    for _ in range(ROUNDS):
+        size += consume(client, path, headers)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed / ROUNDS, size / ROUNDS, peak / 1024 / 1024
+
+def main():
+    file_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+
+    with tempfile.TemporaryDirectory() as root:
+        store = ContentStore(root)
+        source = os.path.join(root, 'source')
+        with open(source, 'wb') as f:
+            f.write(os.urandom(file_mb * 1024 * 1024))
+        with open(source, 'rb') as f:
+            sha256, _ = store.write_stream(f)
+
+        client = build_app(store, sha256).test_client()
+        one_mb = {'Range': 'bytes=1048576-2097151'}
+
+        print(f"{'mode':>12} {'ms/request':>11} {'MB sent':>8} {'MB/s':>7} {'peak MB':>8}")
+        for label, path, headers in [
+            ('naive full', '/naive', None),
+            ('media full', '/media', None),
+            ('naive 1MB', '/naive', one_mb),
+            ('media 1MB', '/media', one_mb),
+        ]:
+            seconds, size, peak = measure(client, path, headers)
+            print(f"{label:>12} {seconds * 1000:>11.1f} {size / 1024 / 1024:>8.1f} {size / seconds / 1024 / 1024:>7.0f} {peak:>8.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Fan-out latency of one room message against room size.
+
+Compares a single Socket.IO room broadcast with one emit per member, using
+in-process test clients so only the server-side fan-out cost is measured.
+
+Usage: python benchmarks/bench_room_fanout.py [max_members]
+"""
+import sys
+import time
+from flask import Flask
+from flask_socketio import SocketIO, join_room
+
+SIZES = [10, 100, 1000, 10000]
+ROUNDS = 5
+
+def build_server():
+    app = Flask(__name__)
+    socketio = SocketIO(app, async_mode='threading')
+
+    @socketio.on('join')
+    def handle_join(room):
+        join_room(room)
+
+    return app, socketio
+
+def main():
+    max_members = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    payload = {'id': 1, 'room_id': 1, 'sender_id': 1, 'content': 'x' * 80, 'message_type': 'text'}
+
+    print(f"{'members':>8} {'broadcast ms':>13} {'per-member ms':>14}")
+    for size in [size for size in SIZES if size <= max_members]:
+        app, socketio = build_server()
+        clients = [socketio.test_client(app) for _ in range(size)]
+        for client in clients:
+            client.emit('join', 'room_1')
+            client.get_received()
+        sids = [client.eio_sid for client in clients]
+        sids = [socketio.server.manager.sid_from_eio_sid(sid, '/') for sid in sids]
+
+        broadcast = []
+        per_member = []
+        for _ in range(ROUNDS):
+            started = time.perf_counter()
+            socketio.emit('new_room_message', payload, room='room_1')
+            broadcast.append(time.perf_counter() - started)
+            for client in clients:
+                client.get_received()
+
+            started = time.perf_counter()
+            for sid in sids:
+                socketio.emit('new_room_message', payload, room=sid)
+            per_member.append(time.perf_counter() - started)
+            for client in clients:
+                client.get_received()
+
+        print(f"{size:>8} {min(broadcast) * 1000:>13.1f} {min(per_member) * 1000:>14.1f}")
+
+        for client in clients:
+            client.disconnect()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Message search over synthetic messages: FTS5 index against LIKE.
+
+Builds MessageSearchIndex with N messages of Zipf-distributed words
+between random pairs of users, in batches the size the message writer
+uses, and a plain messages table indexed by sender and receiver. User 0
+is a heavy user who takes part in 5% of all messages. Then times
+searches for common and rare words, by random users and by the heavy
+user, through the index and as
+`(sender_id = ? OR receiver_id = ?) AND content LIKE '%word%'`.
+
+The default is the 10M messages the index is sized for; that takes a
+while and a few GB of disk, so pass a smaller count for a quick run.
+
+Usage: python benchmarks/bench_search.py [messages] [users]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import MessageSearchIndex
+
+VOCABULARY = 50000
+WORDS_PER_MESSAGE = (3, 20)
+BATCH = 200
+QUERIES = 200
+HEAVY_USER_SHARE = 0.05
+
+def word(rank):
+    return f'w{rank}'
+
+def synthetic_messages(count, users, rng):
+    # Zipf-like: word rank r is drawn with probability ~ 1/r
+    weights = [1 / rank for rank in range(1, VOCABULARY + 1)]
+    cumulative = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+
+    for message_id in range(1, count + 1):
+        sender, receiver = rng.randrange(users), rng.randrange(users)
+        if rng.random() < HEAVY_USER_SHARE:
+            sender = 0
+        ranks = rng.choices(range(1, VOCABULARY + 1), cum_weights=cumulative, k=rng.randint(*WORDS_PER_MESSAGE))
+        yield message_id, sender, receiver, ' '.join(word(rank) for rank in ranks)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def timed(fn, queries):
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        fn(*query)
+        latencies.append(time.perf_counter() - started)
+    return percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    rng = random.Random(42)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = MessageSearchIndex(os.path.join(tmp, 'search.db'))
+        plain = sqlite3.connect(os.path.join(tmp, 'plain.db'))
+        plain.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, sender_id INT, receiver_id INT, content TEXT)')
+        plain.execute('CREATE INDEX idx_sender ON messages (sender_id)')
+        plain.execute('CREATE INDEX idx_receiver ON messages (receiver_id)')
+
+        index_seconds = 0
+        batch = []
+        for message in synthetic_messages(count, users, rng):
+            batch.append(message)
+            if len(batch) == BATCH:
+                started = time.perf_counter()
+                index.add_many(batch)
+                index_seconds += time.perf_counter() - started
+                plain.executemany('INSERT INTO messages VALUES (?, ?, ?, ?)', batch)
+                batch = []
+        if batch:
+            index.add_many(batch)
+            plain.executemany('INSERT INTO messages VALUES (?, ?, ?, ?)', batch)
+        plain.commit()
+
+        size = os.path.getsize(os.path.join(tmp, 'search.db')) / 1024 / 1024
+        print(f"{count} messages, {users} users: indexed {count / index_seconds:.0f} messages/s, index {size:.0f}MB")
+
+        def like(term, user_id):
+            plain.execute(
+                'SELECT id FROM messages WHERE (sender_id = ? OR receiver_id = ?) AND content LIKE ? '
+                'ORDER BY id DESC LIMIT 20', (user_id, user_id, f'%{term}%')
+            ).fetchall()
+
+        print(f"{'query':>22} {'p50 ms':>8} {'p99 ms':>8}")
+        cases = [
+            (f'{kind} word, {who}', ranks, pick_user)
+            for kind, ranks in (('common', range(1, 20)), ('rare', range(10000, 50000)))
+            for who, pick_user in (('any user', lambda: rng.randrange(1, users)), ('heavy user', lambda: 0))
+        ]
+        for label, ranks, pick_user in cases:
+            queries = [(word(rng.choice(ranks)), pick_user()) for _ in range(QUERIES)]
+            print(label)
+            for order in ('relevance', 'recent'):
+                p50, p99 = timed(lambda term, user_id: index.search(term, user_id, order=order), queries)
+                print(f"{'index ' + order:>22} {p50:>8.2f} {p99:>8.2f}")
+            p50, p99 = timed(like, queries)
+            print(f"{'LIKE':>22} {p50:>8.2f} {p99:>8.2f}")
+
+if __name__ == '__main__':
+    main()
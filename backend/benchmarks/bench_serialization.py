@@ -0,0 +1,168 @@
+"""
+Message history encoding: ORM objects against column tuples.
+
+Fills a SQLite file with N messages between two users, every tenth with
+media metadata, then serves pages of the largest history page size both
+ways: the old path (load Message objects, build each dict by hand with
+isoformat(), encode with Flask's default JSON provider) and the new one
+(select message_serializer-style columns, zip them into dicts, encode
+with utils.serialization, i.e. orjson when installed). Prints rows per
+second for fetching plus encoding, and for encoding alone.
+
+Usage: python benchmarks/bench_serialization.py [messages] [rounds]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import insert
+from models import db, User, Message
+from utils.conversations import MAX_PAGE_SIZE
+from utils.serialization import RowSerializer, dump_bytes, orjson
+from utils.write_behind import row_for
+
+MEDIA = {
+    'kind': 'image',
+    'width': 1920,
+    'height': 1080,
+    'thumbnails': [{'sha256': 'a' * 64, 'width': size, 'height': size} for size in (160, 480, 1080)]
+}
+
+def media_data(media):
+    # Same work as app.media_data
+    if not media:
+        return media
+    media = dict(media)
+    media['thumbnails'] = [
+        dict(thumbnail, url=f"/api/media/{thumbnail['sha256']}")
+        for thumbnail in media.get('thumbnails', [])
+    ]
+    return media
+
+serializer = RowSerializer({
+    "id": Message.id,
+    "sender_id": Message.sender_id,
+    "receiver_id": Message.receiver_id,
+    "content": Message.content,
+    "message_type": Message.message_type,
+    "timestamp": Message.timestamp,
+    "is_ai_generated": Message.is_ai_generated,
+    "file_id": Message.file_id,
+    "media": Message.media
+}, transforms={"media": media_data})
+
+def build_app(path, count):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([
+            User(id=user_id, username=f'user{user_id}', email=f'user{user_id}@example.com', password_hash='x')
+            for user_id in (1, 2)
+        ])
+        rows = []
+        for sequence in range(count):
+            message = Message(
+                id=sequence + 1,
+                sender_id=1 + sequence % 2,
+                receiver_id=2 - sequence % 2,
+                content=f'message {sequence} ' + 'x' * 60,
+                media=MEDIA if sequence % 10 == 0 else None
+            )
+            rows.append(row_for(message))
+        db.session.execute(insert(Message), rows)
+        db.session.commit()
+    return app
+
+def page_starts(count, rounds):
+    # Walk the history from the newest page back, wrapping around
+    pages = max(1, count // MAX_PAGE_SIZE)
+    return [count + 1 - (page % pages) * MAX_PAGE_SIZE for page in range(rounds)]
+
+def orm_page(before_id):
+    return Message.query.filter(Message.between(1, 2), Message.id < before_id).order_by(
+        Message.id.desc()
+    ).limit(MAX_PAGE_SIZE).all()
+
+def orm_dicts(messages):
+    return [{
+        "id": msg.id,
+        "sender_id": msg.sender_id,
+        "receiver_id": msg.receiver_id,
+        "content": msg.content,
+        "message_type": msg.message_type,
+        "timestamp": msg.timestamp.isoformat(),
+        "read": msg.id <= 0,
+        "file_id": msg.file_id,
+        "media": media_data(msg.media)
+    } for msg in messages]
+
+def tuple_page(before_id):
+    return db.session.query(*serializer.columns).filter(Message.between(1, 2), Message.id < before_id).order_by(
+        Message.id.desc()
+    ).limit(MAX_PAGE_SIZE).all()
+
+def tuple_dicts(rows):
+    messages_data = serializer.rows(rows)
+    for message_data in messages_data:
+        message_data["read"] = message_data["id"] <= 0
+    return messages_data
+
+def timed(fn, starts):
+    rows = 0
+    started = time.perf_counter()
+    for before_id in starts:
+        rows += fn(before_id)
+    return rows / (time.perf_counter() - started)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = build_app(os.path.join(tmp, 'messages.db'), count)
+        default_json = DefaultJSONProvider(app)
+        starts = page_starts(count, rounds)
+
+        with app.app_context():
+            def orm_path(before_id):
+                body = default_json.dumps(orm_dicts(orm_page(before_id))).encode()
+                db.session.expunge_all()
+                return body.count(b'"id"')
+
+            def tuple_path(before_id):
+                return dump_bytes(tuple_dicts(tuple_page(before_id))).count(b'"id"')
+
+            # Encoding alone, on pages fetched up front
+            orm_pages = {before_id: orm_page(before_id) for before_id in set(starts)}
+            tuple_pages = {before_id: tuple_page(before_id) for before_id in set(starts)}
+
+            def orm_encode(before_id):
+                messages_data = orm_dicts(orm_pages[before_id])
+                default_json.dumps(messages_data)
+                return len(messages_data)
+
+            def tuple_encode(before_id):
+                messages_data = tuple_dicts(tuple_pages[before_id])
+                dump_bytes(messages_data)
+                return len(messages_data)
+
+            print(f"{count} messages, pages of {MAX_PAGE_SIZE}, JSON backend: {'orjson' if orjson else 'json'}")
+            print(f"{'path':>28} {'rows/s':>10}")
+            for label, fn in (
+                ('ORM + isoformat + jsonify', orm_path),
+                ('columns + RowSerializer', tuple_path),
+                ('encode only, ORM dicts', orm_encode),
+                ('encode only, RowSerializer', tuple_encode)
+            ):
+                fn(starts[0])  # warm up
+                print(f"{label:>28} {timed(fn, starts):>10.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Socket event throughput with per-event JWT verification versus the
+identity cached on the connection at connect time.
+
+Usage: python benchmarks/bench_socket_auth.py [events]
+"""
+import os
+import sys
+import time
+from flask import Flask
+from flask_socketio import SocketIO, emit
+from flask_jwt_extended import JWTManager, create_access_token, get_jwt_identity, jwt_required
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.authentication import authenticate_socket, socket_auth_required, socket_identity
+
+def build_server():
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'bench'
+    app.config['JWT_SECRET_KEY'] = 'bench-jwt-secret-key-of-sufficient-length'
+    JWTManager(app)
+    socketio = SocketIO(app, async_mode='threading')
+
+    @socketio.on('connect')
+    def handle_connect(auth=None):
+        authenticate_socket(auth)
+
+    @socketio.on('per_event_jwt')
+    @jwt_required()
+    def handle_per_event_jwt(data):
+        emit('ack', get_jwt_identity())
+
+    @socketio.on('cached_session')
+    @socket_auth_required
+    def handle_cached_session(data):
+        emit('ack', socket_identity())
+
+    return app, socketio
+
+def measure(client, event, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        client.emit(event, {'content': 'hello'})
+    elapsed = time.perf_counter() - started
+    acks = [packet for packet in client.get_received() if packet['name'] == 'ack']
+    assert len(acks) == count, f"{event}: expected {count} acks, got {len(acks)}"
+    return count / elapsed
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    app, socketio = build_server()
+
+    with app.app_context():
+        token = create_access_token(identity=1)
+
+    client = socketio.test_client(app, auth={'token': token}, headers={'Authorization': f'Bearer {token}'})
+    client.get_received()
+
+    measure(client, 'per_event_jwt', 100)
+    measure(client, 'cached_session', 100)
+
+    before = measure(client, 'per_event_jwt', count)
+    after = measure(client, 'cached_session', count)
+    print(f"{'handler':>16} {'events/s':>10}")
+    print(f"{'per-event JWT':>16} {before:>10.0f}")
+    print(f"{'cached session':>16} {after:>10.0f}")
+    print(f"{'speedup':>16} {after / before:>10.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Reconnect catch-up: one sync delta against re-fetching every chat.
+
+Fills a SQLite file with a user's history, N messages over C
+conversations, then adds a few new messages and times a reconnect both
+ways: one get_message_delta call with the client's per-conversation
+marks, and one first page of /api/messages (get_message_page) per
+conversation as clients did before. Repeats with 10x the history to
+show the delta cost follows the new messages, not the history.
+
+Usage: python benchmarks/bench_sync.py [messages] [conversations] [new]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import insert
+from models import db, User, Message
+from utils.conversations import get_message_delta, get_message_page
+from utils.ids import next_id
+from utils.serialization import RowSerializer
+from utils.write_behind import row_for
+
+USER_ID = 1
+ROUNDS = 20
+
+serializer = RowSerializer({
+    "id": Message.id,
+    "sender_id": Message.sender_id,
+    "receiver_id": Message.receiver_id,
+    "content": Message.content,
+    "timestamp": Message.timestamp
+})
+
+def build_app(path, count, conversations, rng):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([
+            User(id=user_id, username=f'user{user_id}', email=f'user{user_id}@example.com', password_hash='x')
+            for user_id in range(1, conversations + 2)
+        ])
+        rows = []
+        for sequence in range(count):
+            contact_id = rng.randrange(2, conversations + 2)
+            sender_id, receiver_id = (USER_ID, contact_id) if sequence % 2 else (contact_id, USER_ID)
+            rows.append(row_for(Message(id=next_id(), sender_id=sender_id, receiver_id=receiver_id, content='x' * 60)))
+            if len(rows) == 10000:
+                db.session.execute(insert(Message), rows)
+                rows = []
+        if rows:
+            db.session.execute(insert(Message), rows)
+        db.session.commit()
+    return app
+
+def client_marks(conversations):
+    # What a client that was up to date holds: the newest id of each conversation
+    marks = {}
+    for contact_id in range(2, conversations + 2):
+        mark = db.session.query(db.func.max(Message.id)).filter(Message.between(USER_ID, contact_id)).scalar()
+        if mark is not None:
+            marks[contact_id] = mark
+    return marks
+
+def add_new_messages(new, conversations, rng):
+    rows = [
+        row_for(Message(id=next_id(), sender_id=rng.randrange(2, conversations + 2), receiver_id=USER_ID, content='new'))
+        for _ in range(new)
+    ]
+    db.session.execute(insert(Message), rows)
+    db.session.commit()
+
+def timed(fn):
+    fn()  # warm up
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn()
+    return (time.perf_counter() - started) / ROUNDS * 1000
+
+def run(path, count, conversations, new):
+    rng = random.Random(42)
+    app = build_app(path, count, conversations, rng)
+    with app.app_context():
+        marks = client_marks(conversations)
+        since = max(marks.values())
+        add_new_messages(new, conversations, rng)
+
+        def sync():
+            rows, _ = get_message_delta(USER_ID, marks, serializer.columns, since=since)
+            assert len(rows) == new
+            serializer.rows(rows)
+
+        def refetch():
+            for contact_id in marks:
+                rows, _ = get_message_page(USER_ID, contact_id, columns=serializer.columns)
+                serializer.rows(rows)
+
+        print(f"{count:>10} {conversations:>13} {new:>4} {timed(sync):>8.2f} {timed(refetch):>10.2f}")
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    conversations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    new = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    print(f"{'history':>10} {'conversations':>13} {'new':>4} {'sync ms':>8} {'refetch ms':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        run(os.path.join(tmp, 'small.db'), count, conversations, new)
+        run(os.path.join(tmp, 'large.db'), count * 10, conversations, new)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Message insert throughput against write batch size.
+
+Writes N messages to a fresh SQLite file, first one commit per message as
+send_message used to, then through MessageWriter with different batch
+sizes. Prints messages written per second.
+
+Usage: python benchmarks/bench_write_behind.py [messages]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db, User, Message
+from utils.write_behind import MessageWriter, row_for
+
+BATCH_SIZES = [1, 10, 100, 1000]
+
+def build_app(path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([
+            User(id=user_id, username=f'user{user_id}', email=f'user{user_id}@example.com', password_hash='x')
+            for user_id in (1, 2)
+        ])
+        db.session.commit()
+    return app
+
+def new_message(sequence):
+    return Message(sender_id=1 + sequence % 2, receiver_id=2 - sequence % 2, content='x' * 80)
+
+def per_message_commit(app, count):
+    started = time.perf_counter()
+    with app.app_context():
+        for sequence in range(count):
+            db.session.add(new_message(sequence))
+            db.session.commit()
+    return time.perf_counter() - started
+
+def write_behind(app, count, batch_size):
+    writer = MessageWriter(app, db, batch_size=batch_size, flush_interval=0.02)
+    started = time.perf_counter()
+    futures = [writer.submit(Message, row_for(new_message(sequence))) for sequence in range(count)]
+    for future in futures:
+        future.result()
+    return time.perf_counter() - started
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    print(f"{'mode':>18} {'seconds':>8} {'messages/s':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        app = build_app(os.path.join(tmp, 'baseline.db'))
+        elapsed = per_message_commit(app, count)
+        print(f"{'commit per message':>18} {elapsed:>8.2f} {count / elapsed:>11.0f}")
+
+        for batch_size in BATCH_SIZES:
+            app = build_app(os.path.join(tmp, f'batch_{batch_size}.db'))
+            elapsed = write_behind(app, count, batch_size)
+            print(f"{f'batch {batch_size}':>18} {elapsed:>8.2f} {count / elapsed:>11.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -8,27 +8,142 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key-here'
     DEBUG = os.environ.get('DEBUG') or True
     HOST = os.environ.get('HOST') or '0.0.0.0'
-    PORT = os.environ.get('PORT') or 5000
+    PORT = int(os.environ.get('PORT') or 5000)
+    
+    # Socket.IO message queue for multi-process deployments, e.g.
+    # redis://localhost:6379/0 or local://127.0.0.1:6390 (see utils/message_queue.py)
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    # json, or msgpack (needs the msgpack package, and socket.io-msgpack-parser on clients)
+    SOCKETIO_SERIALIZER = os.environ.get('SOCKETIO_SERIALIZER') or 'json'
     
     # Database config
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Engine tuning (see utils/database.py); the profile follows DATABASE_URL unless set.
+    # Under eventlet use green drivers: mysql+pymysql://, or postgresql:// with psycogreen
+    DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE')  # sqlite, mysql, postgresql
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')  # read-only views read from here when set
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 10)  # connections kept per process
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 20)  # extra connections under bursts
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT') or 10)  # seconds a greenlet waits for a connection
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE') or 1800)  # seconds, below the server's idle timeout
+    DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE') or 1000)  # compiled statements per engine
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)  # bytes
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)  # milliseconds
     
     # JWT config
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'jwt-secret-key'
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=24)
+    ADMIN_USER_IDS = {int(user_id) for user_id in (os.environ.get('ADMIN_USER_IDS') or '').split(',') if user_id}  # may read /api/metrics
+    
+    # Password hashing and login throttling
+    BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS') or 12)  # existing hashes are upgraded on login
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 4)  # concurrent hashes per process
+    LOGIN_RATE_LIMIT_REDIS_URL = os.environ.get('LOGIN_RATE_LIMIT_REDIS_URL')  # per-process counters when unset
+    LOGIN_LIMIT_PER_IP = int(os.environ.get('LOGIN_LIMIT_PER_IP') or 30)  # attempts per window
+    LOGIN_LIMIT_PER_EMAIL = int(os.environ.get('LOGIN_LIMIT_PER_EMAIL') or 10)  # attempts per window
+    LOGIN_LIMIT_WINDOW = int(os.environ.get('LOGIN_LIMIT_WINDOW') or 60)  # seconds
+    # Proxies in front of the app that append to X-Forwarded-For, e.g. 1 behind nginx. Keep 0 when clients
+    # connect directly, or they could pick the address the per-IP limit counts
+    TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS') or 0)
     
     # OpenAI config
     OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY') or 'your-openai-api-key'
+    OPENAI_API_BASE = os.environ.get('OPENAI_API_BASE')  # e.g. a local stub server
+    AI_CONTEXT_TOKEN_BUDGET = int(os.environ.get('AI_CONTEXT_TOKEN_BUDGET') or 1000)
+    AI_CONTEXT_MAX_MESSAGES = int(os.environ.get('AI_CONTEXT_MAX_MESSAGES') or 50)
+    AI_CONTEXT_MAX_CONVERSATIONS = int(os.environ.get('AI_CONTEXT_MAX_CONVERSATIONS') or 10000)
+    AI_CONTEXT_TTL = int(os.environ.get('AI_CONTEXT_TTL') or 60)  # seconds before a conversation is reloaded with other processes' messages
+    AI_STREAM_RESPONSES = os.environ.get('AI_STREAM_RESPONSES', 'true').lower() == 'true'
+    
+    # Moderation config
+    MODERATION_MODE = os.environ.get('MODERATION_MODE') or 'blocking'  # blocking, optimistic
+    MODERATION_BATCH_SIZE = int(os.environ.get('MODERATION_BATCH_SIZE') or 32)
+    MODERATION_MAX_WAIT = float(os.environ.get('MODERATION_MAX_WAIT') or 0.05)  # seconds
+    MODERATION_CACHE_SIZE = int(os.environ.get('MODERATION_CACHE_SIZE') or 10000)
+    MODERATION_CACHE_TTL = int(os.environ.get('MODERATION_CACHE_TTL') or 3600)  # seconds
+    MODERATION_TIMEOUT = float(os.environ.get('MODERATION_TIMEOUT') or 5)  # seconds a message waits before the blocklist decides alone
+    BLOCKLIST_PATH = os.environ.get('BLOCKLIST_PATH') or os.path.join(basedir, 'data', 'blocklist.txt')
+    BLOCKLIST_RELOAD_INTERVAL = int(os.environ.get('BLOCKLIST_RELOAD_INTERVAL') or 30)  # seconds
+    
+    # Translation config
+    TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE') or 50000)
+    TRANSLATION_DB_PATH = os.environ.get('TRANSLATION_DB_PATH')  # e.g. os.path.join(basedir, 'translations.db')
+    TRANSLATION_MAX_BATCH = int(os.environ.get('TRANSLATION_MAX_BATCH') or 50)
+    
+    # Chat room config
+    ROOM_CACHE_SIZE = int(os.environ.get('ROOM_CACHE_SIZE') or 1000)
+    ROOM_CACHE_TTL = int(os.environ.get('ROOM_CACHE_TTL') or 300)  # seconds
+    
+    # Presence config
+    PRESENCE_REDIS_URL = os.environ.get('PRESENCE_REDIS_URL')  # in-process store when unset
+    PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL') or 90)  # seconds without heartbeat
+    PRESENCE_FLUSH_INTERVAL = int(os.environ.get('PRESENCE_FLUSH_INTERVAL') or 5)  # seconds
+    
+    # Message persistence config
+    MESSAGE_DURABILITY = os.environ.get('MESSAGE_DURABILITY') or 'write_behind'  # write_behind, group_commit
+    MESSAGE_WRITE_BATCH_SIZE = int(os.environ.get('MESSAGE_WRITE_BATCH_SIZE') or 200)
+    MESSAGE_WRITE_INTERVAL = float(os.environ.get('MESSAGE_WRITE_INTERVAL') or 0.02)  # seconds
+    MESSAGE_ID_WORKER = int(os.environ['MESSAGE_ID_WORKER']) if os.environ.get('MESSAGE_ID_WORKER') else None  # 0-31, distinct per process; required with SOCKETIO_MESSAGE_QUEUE
+    
+    # Message search config
+    SEARCH_DB_PATH = os.environ.get('SEARCH_DB_PATH')  # SQLite FTS5 index, instance/search.db when unset
+    
+    # Read receipt config
+    READ_RECEIPT_FLUSH_INTERVAL = float(os.environ.get('READ_RECEIPT_FLUSH_INTERVAL') or 1)  # seconds
+    READ_RECEIPT_CACHE_SIZE = int(os.environ.get('READ_RECEIPT_CACHE_SIZE') or 100000)
+    READ_RECEIPT_CACHE_TTL = int(os.environ.get('READ_RECEIPT_CACHE_TTL') or 300)  # seconds
+    
+    # Reconnect catch-up and the queue of messages awaiting a delivery ack
+    SYNC_BATCH_SIZE = int(os.environ.get('SYNC_BATCH_SIZE') or 500)  # messages per sync response
+    SYNC_MAX_CONVERSATIONS = int(os.environ.get('SYNC_MAX_CONVERSATIONS') or 1000)  # marks read per sync request
+    DELIVERY_QUEUE_USERS = int(os.environ.get('DELIVERY_QUEUE_USERS') or 100000)
+    DELIVERY_QUEUE_PER_USER = int(os.environ.get('DELIVERY_QUEUE_PER_USER') or 500)
+    DELIVERY_QUEUE_TTL = int(os.environ.get('DELIVERY_QUEUE_TTL') or 3600)  # seconds
+    
+    # Background job config (AI replies, translation)
+    JOB_QUEUE_REDIS_URL = os.environ.get('JOB_QUEUE_REDIS_URL')  # in-process queue when unset
+    JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE') or 1000)
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 4)
+    JOB_EXECUTOR = os.environ.get('JOB_EXECUTOR') or 'thread'  # thread, process
+    JOB_PER_USER_LIMIT = int(os.environ.get('JOB_PER_USER_LIMIT') or 2)
+    JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT') or 60)  # seconds
     
     # Payment config
     STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY') or 'your-stripe-secret-key'
     STRIPE_PUBLISHABLE_KEY = os.environ.get('STRIPE_PUBLISHABLE_KEY') or 'your-stripe-publishable-key'
+    STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')  # webhooks are refused when unset
+    STRIPE_WEBHOOK_ALLOW_UNSIGNED = os.environ.get('STRIPE_WEBHOOK_ALLOW_UNSIGNED', 'false').lower() == 'true'  # development with stripe-mock only
+    STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE')  # e.g. http://localhost:12111 for stripe-mock
+    PAYMENT_WORKERS = int(os.environ.get('PAYMENT_WORKERS') or 4)  # concurrent Stripe calls
+    PAYMENT_TIMEOUT = int(os.environ.get('PAYMENT_TIMEOUT') or 60)  # seconds
+    PAYMENT_SWEEP_INTERVAL = int(os.environ.get('PAYMENT_SWEEP_INTERVAL') or 300)  # seconds between looking up stuck payments, 0 to disable
+    PAYMENT_SWEEP_AGE = int(os.environ.get('PAYMENT_SWEEP_AGE') or 600)  # seconds a payment stays pending before it is looked up
+    # What each package costs, in the smallest currency unit; clients only pick a package_id
+    CREDIT_PACKAGES = {
+        'credits_5': {'credits': 5, 'amount': 499, 'currency': 'USD'},
+        'credits_15': {'credits': 15, 'amount': 1299, 'currency': 'USD'},
+        'credits_30': {'credits': 30, 'amount': 2499, 'currency': 'USD'}
+    }
+    
+    # Credit ledger config
+    CREDIT_BALANCE_CACHE_SIZE = int(os.environ.get('CREDIT_BALANCE_CACHE_SIZE') or 100000)
+    CREDIT_BALANCE_CACHE_TTL = int(os.environ.get('CREDIT_BALANCE_CACHE_TTL') or 30)  # seconds other processes may serve a stale balance
+    CREDIT_RECONCILE_INTERVAL = int(os.environ.get('CREDIT_RECONCILE_INTERVAL') or 3600)  # seconds, 0 to disable
     
     # File upload config
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max request body (a form upload or one chunk)
     UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
+    MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE') or 1024 * 1024 * 1024)  # 1GB per file, sent in chunks
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE') or 8 * 1024 * 1024)  # suggested chunk size
+    UPLOAD_EXPIRY = int(os.environ.get('UPLOAD_EXPIRY') or 24 * 3600)  # seconds before unfinished uploads are removed
+    MEDIA_ACCEL_REDIRECT = os.environ.get('MEDIA_ACCEL_REDIRECT')  # e.g. /protected-media/ to let nginx send files
+    MEDIA_URL_TTL = int(os.environ.get('MEDIA_URL_TTL') or 300)  # seconds a signed media URL stays valid
+    MEDIA_WORKERS = int(os.environ.get('MEDIA_WORKERS') or 2)  # processes building previews
+    MEDIA_QUEUE_SIZE = int(os.environ.get('MEDIA_QUEUE_SIZE') or 1000)
+    MEDIA_TIMEOUT = int(os.environ.get('MEDIA_TIMEOUT') or 120)  # seconds per file
+    MEDIA_THUMBNAIL_SIZES = [int(size) for size in (os.environ.get('MEDIA_THUMBNAIL_SIZES') or '160,480,1080').split(',')]
     ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'mp3', 'wav', 'mp4'}
     
     # CORS config
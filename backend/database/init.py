@@ -12,7 +12,7 @@ CREATE TABLE IF NOT EXISTS users (
     phone_number VARCHAR(20),
     country CHAR(2) DEFAULT 'US',
     avatar VARCHAR(200),
-    credits INT DEFAULT 0,
+    stripe_customer_id VARCHAR(255),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     is_online BOOLEAN DEFAULT FALSE,
     last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -22,7 +22,7 @@ CREATE TABLE IF NOT EXISTS users (
 
 -- Messages table
 CREATE TABLE IF NOT EXISTS messages (
-    id INT AUTO_INCREMENT PRIMARY KEY,
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,  -- assigned by the app (utils/ids.py)
     sender_id INT NOT NULL,
     receiver_id INT NOT NULL,
     content TEXT NOT NULL,
@@ -30,11 +30,100 @@ CREATE TABLE IF NOT EXISTS messages (
     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     read BOOLEAN DEFAULT FALSE,
     is_ai_generated BOOLEAN DEFAULT FALSE,
+    file_id INT,
+    media JSON,
+    user_low_id INT NOT NULL,
+    user_high_id INT NOT NULL,
     FOREIGN KEY (sender_id) REFERENCES users(id),
     FOREIGN KEY (receiver_id) REFERENCES users(id),
-    INDEX idx_sender (sender_id),
-    INDEX idx_receiver (receiver_id),
-    INDEX idx_timestamp (timestamp)
+    INDEX idx_messages_sender (sender_id, id),
+    INDEX idx_messages_receiver (receiver_id, id),
+    INDEX idx_conversation (user_low_id, user_high_id, id),
+    INDEX idx_conversation_high (user_high_id, user_low_id, id),
+    INDEX idx_messages_file (file_id)
+);
+
+-- Read receipts table: one watermark per reader and conversation
+CREATE TABLE IF NOT EXISTS read_receipts (
+    user_id INT NOT NULL,
+    contact_id INT NOT NULL,
+    last_read_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, contact_id),
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    FOREIGN KEY (contact_id) REFERENCES users(id)
+);
+
+-- Uploaded content, one row per distinct sha256
+CREATE TABLE IF NOT EXISTS stored_files (
+    sha256 CHAR(64) PRIMARY KEY,
+    size BIGINT NOT NULL,
+    ref_count INT NOT NULL DEFAULT 0,
+    media JSON,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Previews made from stored files, themselves stored by content
+CREATE TABLE IF NOT EXISTS derived_files (
+    sha256 CHAR(64) NOT NULL,
+    source_sha256 CHAR(64) NOT NULL,
+    content_type VARCHAR(100),
+    PRIMARY KEY (sha256, source_sha256),
+    FOREIGN KEY (source_sha256) REFERENCES stored_files(sha256),
+    INDEX idx_derived_files_source (source_sha256)
+);
+
+-- Uploads by users, each referencing stored content
+CREATE TABLE IF NOT EXISTS user_files (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    sha256 CHAR(64) NOT NULL,
+    filename VARCHAR(255) NOT NULL,
+    content_type VARCHAR(100),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    FOREIGN KEY (sha256) REFERENCES stored_files(sha256),
+    INDEX idx_user_files_user (user_id),
+    INDEX idx_user_files_sha256 (sha256)
+);
+
+-- Credit balances, kept in step with the ledger below
+CREATE TABLE IF NOT EXISTS credit_balances (
+    user_id INT PRIMARY KEY,
+    balance INT NOT NULL DEFAULT 0,
+    last_transaction_id BIGINT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+);
+
+-- Credit ledger, append-only
+CREATE TABLE IF NOT EXISTS credit_transactions (
+    id BIGINT PRIMARY KEY,  -- assigned by the app (utils/ids.py)
+    user_id INT NOT NULL,
+    amount INT NOT NULL,
+    balance_after INT NOT NULL,
+    reason VARCHAR(30) NOT NULL,
+    reference VARCHAR(64),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    INDEX idx_credit_transactions_user (user_id, id)
+);
+
+-- Payments, one per client idempotency key and confirmed by Stripe webhooks
+CREATE TABLE IF NOT EXISTS payments (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    idempotency_key VARCHAR(64) NOT NULL,
+    amount INT NOT NULL,
+    currency CHAR(3) NOT NULL,
+    credits INT NOT NULL,
+    status VARCHAR(20) DEFAULT 'pending',
+    stripe_payment_intent_id VARCHAR(255) UNIQUE,
+    error VARCHAR(255),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    UNIQUE KEY unique_payment_key (user_id, idempotency_key)
 );
 
 -- Chat rooms table
@@ -62,17 +151,56 @@ CREATE TABLE IF NOT EXISTS user_chat_rooms (
     UNIQUE KEY unique_user_chat (user_id, chat_room_id)
 );
 
+-- Chat room messages table
+CREATE TABLE IF NOT EXISTS room_messages (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,  -- assigned by the app (utils/ids.py)
+    chat_room_id INT NOT NULL,
+    sender_id INT NOT NULL,
+    content TEXT NOT NULL,
+    message_type VARCHAR(20) DEFAULT 'text',
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    is_ai_generated BOOLEAN DEFAULT FALSE,
+    FOREIGN KEY (chat_room_id) REFERENCES chat_rooms(id),
+    FOREIGN KEY (sender_id) REFERENCES users(id),
+    INDEX idx_room_messages (chat_room_id, id)
+);
+
+-- Schema versions applied, see migrations.py; this file creates the latest one
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INT PRIMARY KEY,
+    description VARCHAR(200) NOT NULL,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT IGNORE INTO schema_migrations (version, description) VALUES
+(1, 'Create tables added since the first schema'),
+(2, 'Add conversation key, attachment and Stripe customer columns'),
+(3, 'Widen message ids to 64 bits for time-sortable ids'),
+(4, 'Create the composite indexes of the conversation, sync, room and ledger queries'),
+(5, 'Drop single-column message indexes the composite ones replace'),
+(6, 'Move users.credits into the credit ledger');
+
 -- Insert sample data
-INSERT INTO users (username, email, password_hash, phone_number, country, credits) VALUES
-('john_doe', 'john@example.com', '$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW', '+1234567890', 'US', 100),
-('jane_smith', 'jane@example.com', '$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW', '+0987654321', 'UK', 50),
-('alice_johnson', 'alice@example.com', '$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW', '+1122334455', 'CA', 75);
-
-INSERT INTO messages (sender_id, receiver_id, content, message_type, timestamp) VALUES
-(1, 2, 'Hey Jane, how are you?', 'text', NOW() - INTERVAL 10 MINUTE),
-(2, 1, 'Hi John! I''m good, thanks for asking. How about you?', 'text', NOW() - INTERVAL 9 MINUTE),
-(1, 2, 'I''m doing great! Just working on this new chat app.', 'text', NOW() - INTERVAL 8 MINUTE),
-(3, 1, 'Hello John, this is Alice!', 'text', NOW() - INTERVAL 5 MINUTE);
+INSERT INTO users (username, email, password_hash, phone_number, country) VALUES
+('john_doe', 'john@example.com', '$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW', '+1234567890', 'US'),
+('jane_smith', 'jane@example.com', '$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW', '+0987654321', 'UK'),
+('alice_johnson', 'alice@example.com', '$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW', '+1122334455', 'CA');
+
+INSERT INTO credit_transactions (id, user_id, amount, balance_after, reason) VALUES
+(1, 1, 100, 100, 'opening_balance'),
+(2, 2, 50, 50, 'opening_balance'),
+(3, 3, 75, 75, 'opening_balance');
+
+INSERT INTO credit_balances (user_id, balance, last_transaction_id) VALUES
+(1, 100, 1),
+(2, 50, 2),
+(3, 75, 3);
+
+INSERT INTO messages (sender_id, receiver_id, user_low_id, user_high_id, content, message_type, timestamp) VALUES
+(1, 2, 1, 2, 'Hey Jane, how are you?', 'text', NOW() - INTERVAL 10 MINUTE),
+(2, 1, 1, 2, 'Hi John! I''m good, thanks for asking. How about you?', 'text', NOW() - INTERVAL 9 MINUTE),
+(1, 2, 1, 2, 'I''m doing great! Just working on this new chat app.', 'text', NOW() - INTERVAL 8 MINUTE),
+(3, 1, 1, 3, 'Hello John, this is Alice!', 'text', NOW() - INTERVAL 5 MINUTE);
 
 INSERT INTO chat_rooms (name, description, is_private, created_by, credit_cost) VALUES
 ('General Chat', 'A place for general discussion', FALSE, 1, 0),
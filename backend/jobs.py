@@ -0,0 +1,229 @@
+import json
+import multiprocessing
+import queue
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from utils.metrics import metrics
+
+class QueueFull(Exception):
+    """
+    Raised when a job is refused because the queue or the user is at capacity
+    """
+    pass
+
+class Job:
+    def __init__(self, name, payload, user_id=None, rooms=None, job_id=None, enqueued_at=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.name = name
+        self.payload = payload
+        self.user_id = user_id
+        self.rooms = rooms or []
+        self.enqueued_at = enqueued_at or time.time()
+
+    def to_json(self):
+        return json.dumps({
+            "id": self.id,
+            "name": self.name,
+            "payload": self.payload,
+            "user_id": self.user_id,
+            "rooms": self.rooms,
+            "enqueued_at": self.enqueued_at
+        })
+
+    @classmethod
+    def from_json(cls, raw):
+        data = json.loads(raw)
+        return cls(data['name'], data['payload'], data['user_id'], data['rooms'], data['id'], data['enqueued_at'])
+
+class MemoryBackend:
+    """
+    Bounded in-process job queue
+    """
+    def __init__(self, max_size=1000):
+        self._queue = queue.Queue(maxsize=max_size)
+        self._in_flight = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def push(self, job):
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFull("Job queue is full")
+
+    def pop(self, timeout=1):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def acquire(self, user_id, limit):
+        with self._lock:
+            if self._in_flight[user_id] >= limit:
+                return False
+            self._in_flight[user_id] += 1
+            return True
+
+    def release(self, user_id):
+        with self._lock:
+            self._in_flight[user_id] -= 1
+            if self._in_flight[user_id] <= 0:
+                del self._in_flight[user_id]
+
+class RedisBackend:
+    """
+    Bounded job queue stored in a Redis list, shared by every worker process
+    """
+    def __init__(self, url, key='chat:jobs', max_size=1000):
+        if redis is None:
+            raise RuntimeError("The redis package is required for the Redis job backend")
+        self.client = redis.Redis.from_url(url)
+        self.key = key
+        self.max_size = max_size
+
+    def push(self, job):
+        if self.client.llen(self.key) >= self.max_size:
+            raise QueueFull("Job queue is full")
+        self.client.lpush(self.key, job.to_json())
+
+    def pop(self, timeout=1):
+        item = self.client.brpop(self.key, timeout=max(1, int(timeout)))
+        return Job.from_json(item[1]) if item else None
+
+    def depth(self):
+        return self.client.llen(self.key)
+
+    def acquire(self, user_id, limit):
+        counter = f'{self.key}:user:{user_id}'
+        pipe = self.client.pipeline()
+        pipe.incr(counter)
+        # Safety net so a crashed worker cannot pin a user at the limit forever
+        pipe.expire(counter, 3600)
+        count = pipe.execute()[0]
+        if count > limit:
+            self.client.decr(counter)
+            return False
+        return True
+
+    def release(self, user_id):
+        self.client.decr(f'{self.key}:user:{user_id}')
+
+class JobQueue:
+    """
+    Runs registered jobs on a worker pool, away from the socket handlers.
+
+    Each job name maps to a function taking the JSON-serializable payload
+    and an optional `on_done(job, result, error)` callback, which runs in
+    this process once the job finishes, fails or times out, and is where
+    results get delivered to Socket.IO rooms. Submitting more than
+    `per_user_limit` unfinished jobs for one user, or filling the queue,
+    raises QueueFull so callers can push back on the client.
+    """
+    def __init__(self, backend=None, workers=4, per_user_limit=2, timeout=30, executor='thread'):
+        self.backend = backend or MemoryBackend()
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.timeout = timeout
+        self.executor_type = executor
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._threads = []
+        self._running = False
+
+    def register(self, name, fn, on_done=None):
+        self._handlers[name] = (fn, on_done)
+
+    def submit(self, name, payload, user_id=None, rooms=None):
+        """
+        Queue a job and return its id
+        """
+        if name not in self._handlers:
+            raise ValueError(f"Unknown job: {name}")
+
+        if user_id is not None and not self.backend.acquire(user_id, self.per_user_limit):
+            raise QueueFull("Too many pending jobs for this user")
+
+        job = Job(name, payload, user_id, rooms)
+        try:
+            self.backend.push(job)
+        except Exception:
+            if user_id is not None:
+                self.backend.release(user_id)
+            raise
+
+        self.start()
+        metrics.gauge('job_queue_depth', self.backend.depth())
+        return job.id
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+
+            if self.executor_type == 'process':
+                # Forking would copy the eventlet hub and its running greenlets into the workers
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+
+            self._threads = []
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'job-dispatch-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+
+        for thread in self._threads:
+            thread.join()
+        # A process pool left running hangs interpreter exit under eventlet, so wait for it
+        self._executor.shutdown(wait=self.executor_type == 'process')
+
+    def _run(self):
+        while self._running:
+            job = self.backend.pop(timeout=1)
+            if job is None:
+                continue
+
+            metrics.gauge('job_queue_depth', self.backend.depth())
+            metrics.observe(f'job_wait.{job.name}', time.time() - job.enqueued_at)
+
+            fn, on_done = self._handlers[job.name]
+            result, error = None, None
+            started = time.monotonic()
+            try:
+                result = self._executor.submit(fn, job.payload).result(timeout=self.timeout)
+            except FutureTimeoutError:
+                # The call keeps running in the pool, but its result is dropped
+                error = TimeoutError(f"Job {job.name} timed out after {self.timeout}s")
+            except Exception as e:
+                error = e
+            finally:
+                metrics.observe(f'job_run.{job.name}', time.monotonic() - started)
+
+            try:
+                if on_done is not None:
+                    on_done(job, result, error)
+            except Exception as e:
+                print(f'Job {job.name} result delivery failed: {e}')
+            finally:
+                if job.user_id is not None:
+                    self.backend.release(job.user_id)
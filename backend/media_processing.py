@@ -0,0 +1,177 @@
+"""
+Previews for uploaded media: image thumbnails, video posters and audio waveforms.
+
+`process_media` runs in a process pool, so it takes and returns plain
+data. Thumbnails are written to the content store like any upload and
+described by their sha256; the caller turns those into URLs. Video
+posters and non-WAV waveforms need the ffmpeg binary and are skipped
+without it.
+"""
+import array
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import wave
+
+from PIL import Image, ImageOps, features
+
+from utils.file_upload import ContentStore
+
+THUMBNAIL_SIZES = (160, 480, 1080)
+WAVEFORM_POINTS = 64
+JPEG_QUALITY = 80
+WEBP_QUALITY = 75
+
+def media_kind(content_type):
+    """
+    'image', 'video' or 'audio' for content types that get previews, else None
+    """
+    kind = (content_type or '').split('/')[0]
+    return kind if kind in ('image', 'video', 'audio') else None
+
+def _encode(image, image_format):
+    buffer = io.BytesIO()
+    if image_format == 'jpeg':
+        image.convert('RGB').save(buffer, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(buffer, 'WEBP', quality=WEBP_QUALITY, method=4)
+    return buffer.getvalue()
+
+def make_thumbnails(image, store, sizes=THUMBNAIL_SIZES):
+    """
+    Progressive JPEG (and WebP when Pillow supports it) thumbnails bounded by each size
+    """
+    formats = ['jpeg', 'webp'] if features.check('webp') else ['jpeg']
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+    thumbnails = []
+    for size in sorted(sizes):
+        # Never upscale; the smallest size is always produced
+        if thumbnails and size > max(image.size):
+            break
+
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size), Image.LANCZOS)
+        for image_format in formats:
+            data = _encode(thumbnail, image_format)
+            sha256, length = store.write_stream(io.BytesIO(data))
+            thumbnails.append({
+                'sha256': sha256,
+                'content_type': f'image/{image_format}',
+                'width': thumbnail.width,
+                'height': thumbnail.height,
+                'size': length
+            })
+    return thumbnails
+
+def _image_preview(path, store, sizes):
+    with Image.open(path) as image:
+        width, height = image.size
+        # Let the JPEG decoder downscale while decoding, which is much cheaper
+        image.draft('RGB', (max(sizes), max(sizes)))
+        image = ImageOps.exif_transpose(image)
+        return {'width': width, 'height': height, 'thumbnails': make_thumbnails(image, store, sizes)}
+
+def _video_preview(path, store, sizes):
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        return {'thumbnails': []}
+
+    with tempfile.NamedTemporaryFile(suffix='.jpg') as poster:
+        # A frame one second in, or the first frame of shorter clips
+        for offset in ('1', '0'):
+            result = subprocess.run(
+                [ffmpeg, '-v', 'error', '-y', '-ss', offset, '-i', path, '-frames:v', '1', poster.name],
+                capture_output=True, timeout=60
+            )
+            if result.returncode == 0 and os.path.getsize(poster.name):
+                break
+        else:
+            return {'thumbnails': []}
+
+        with Image.open(poster.name) as image:
+            image.load()
+            return {'width': image.width, 'height': image.height, 'thumbnails': make_thumbnails(image, store, sizes)}
+
+def waveform_peaks(samples, peak, points=WAVEFORM_POINTS):
+    """
+    Reduce samples to `points` peak amplitudes between 0 and 1
+    """
+    if not samples:
+        return []
+    bucket = max(1, len(samples) // points)
+    peaks = []
+    for start in range(0, bucket * min(points, len(samples)), bucket):
+        chunk = samples[start:start + bucket]
+        peaks.append(round(min(max(max(chunk), -min(chunk)) / peak, 1.0), 3))
+    return peaks
+
+def _wav_samples(path):
+    typecodes = {1: 'b', 2: 'h', 4: 'i'}
+    with wave.open(path, 'rb') as audio:
+        width = audio.getsampwidth()
+        if width not in typecodes:
+            return None, None, None
+        channels, rate = audio.getnchannels(), audio.getframerate()
+        samples = array.array(typecodes[width], audio.readframes(audio.getnframes()))
+
+    if width == 1:
+        # 8-bit WAV is unsigned
+        samples = array.array('b', (sample - 128 for sample in array.array('B', samples.tobytes())))
+    return samples[::channels], rate, float(2 ** (8 * width - 1))
+
+def _decoded_samples(path):
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        return None, None, None
+
+    # Mono 8kHz is plenty for a preview
+    result = subprocess.run(
+        [ffmpeg, '-v', 'error', '-i', path, '-ac', '1', '-ar', '8000', '-f', 's16le', '-'],
+        capture_output=True, timeout=120
+    )
+    if result.returncode != 0:
+        return None, None, None
+    samples = array.array('h')
+    samples.frombytes(result.stdout[:len(result.stdout) - len(result.stdout) % 2])
+    return samples, 8000, 32768.0
+
+def _audio_preview(path, content_type):
+    samples = None
+    if content_type in ('audio/wav', 'audio/x-wav', 'audio/wave'):
+        try:
+            samples, rate, peak = _wav_samples(path)
+        except (wave.Error, EOFError):
+            samples = None
+    if samples is None:
+        samples, rate, peak = _decoded_samples(path)
+    if samples is None:
+        return {'waveform': []}
+
+    return {
+        'duration': round(len(samples) / rate, 2),
+        'waveform': waveform_peaks(samples, peak)
+    }
+
+def process_media(payload):
+    """
+    Job: build the previews for one stored file
+    """
+    store = ContentStore(payload['root'])
+    path = store.path_for(payload['sha256'])
+    kind = media_kind(payload['content_type'])
+    sizes = payload.get('sizes') or THUMBNAIL_SIZES
+
+    if kind == 'image':
+        preview = _image_preview(path, store, sizes)
+    elif kind == 'video':
+        preview = _video_preview(path, store, sizes)
+    else:
+        preview = _audio_preview(path, payload['content_type'])
+
+    preview['status'] = 'ready'
+    preview['kind'] = kind
+    return preview
@@ -0,0 +1,290 @@
+"""
+Versioned schema migrations and monthly message partitions.
+
+models.py describes the latest schema. An empty database is created from
+it and stamped with every migration; an existing one gets the migrations
+not yet recorded in schema_migrations, in order. That brings up databases
+made by the first database/init.py (INT message ids, single-column
+message indexes, credits on the users row) as well as ones made later by
+create_all(), which never alters a table that already exists. Every
+migration looks at the live schema before changing it, so it passes over
+work create_all() already did. Run them with `flask migrate`.
+
+Message ids are time ordered (utils/ids.py), so a range of ids is a range
+of time: `ensure_message_partitions` range partitions messages by month
+on the id alone, with no timestamp column in the key. Run
+`flask partition-messages` monthly (e.g. from cron) to keep partitions
+created ahead of the writes.
+"""
+import calendar
+from datetime import datetime
+
+from sqlalchemy import BigInteger, MetaData, Table, case, inspect, insert, select, text
+from sqlalchemy.schema import CreateColumn
+
+from models import db, Message, ReadReceipt, CreditBalance, CreditTransaction, SchemaMigration
+from utils.ids import max_id_before, next_id
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """
+    Register a migration; it is called with a Schema of the connection to upgrade
+    """
+    def register(upgrade):
+        MIGRATIONS.append((version, description, upgrade))
+        return upgrade
+    return register
+
+class Schema:
+    """
+    The live schema behind one connection, read afresh on every call
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.dialect = connection.dialect.name
+
+    def has_table(self, table):
+        return inspect(self.connection).has_table(table)
+
+    def columns(self, table):
+        return {column['name']: column for column in inspect(self.connection).get_columns(table)}
+
+    def indexes(self, table):
+        """
+        {name: column names} of the indexes on a table
+        """
+        return {index['name']: tuple(index['column_names']) for index in inspect(self.connection).get_indexes(table)}
+
+    def execute(self, sql, params=None):
+        return self.connection.execute(text(sql), params or {})
+
+    def add_column(self, table, column):
+        # Rendered on a throwaway table, so the model's own table is left alone
+        Table(table, MetaData(), column)
+        ddl = CreateColumn(column).compile(dialect=self.connection.dialect)
+        self.execute(f'ALTER TABLE {table} ADD COLUMN {ddl}')
+
+    def drop_column(self, table, column):
+        self.execute(f'ALTER TABLE {table} DROP COLUMN {column}')
+
+    def drop_index(self, table, index):
+        if self.dialect == 'mysql':
+            self.execute(f'DROP INDEX {index} ON {table}')
+        else:
+            self.execute(f'DROP INDEX {index}')
+
+@migration(1, 'Create tables added since the first schema')
+def create_tables(schema):
+    seed_receipts = not schema.has_table('read_receipts')
+    db.metadata.create_all(schema.connection, checkfirst=True)
+
+    if seed_receipts:
+        # Read flags become one watermark per reader and conversation
+        messages = Message.__table__
+        schema.connection.execute(insert(ReadReceipt).from_select(
+            ['user_id', 'contact_id', 'last_read_id'],
+            select(messages.c.receiver_id, messages.c.sender_id, db.func.max(messages.c.id)).where(
+                messages.c.read == True  # noqa: E712
+            ).group_by(messages.c.receiver_id, messages.c.sender_id)
+        ))
+
+@migration(2, 'Add conversation key, attachment and Stripe customer columns')
+def add_columns(schema):
+    columns = schema.columns('messages')
+    for name in ('user_low_id', 'user_high_id'):
+        if name not in columns:
+            schema.add_column('messages', db.Column(name, db.Integer, nullable=False, server_default='0'))
+    if 'file_id' not in columns:
+        schema.add_column('messages', db.Column('file_id', db.Integer))
+        if schema.dialect != 'sqlite':
+            schema.execute('ALTER TABLE messages ADD CONSTRAINT fk_messages_file FOREIGN KEY (file_id) REFERENCES user_files (id) ON DELETE SET NULL')
+    if 'media' not in columns:
+        schema.add_column('messages', db.Column('media', db.JSON))
+    if 'stripe_customer_id' not in schema.columns('users'):
+        schema.add_column('users', db.Column('stripe_customer_id', db.String(255)))
+
+    # Key the messages written before the conversation key existed
+    messages = Message.__table__
+    sender, receiver = messages.c.sender_id, messages.c.receiver_id
+    schema.connection.execute(messages.update().where(messages.c.user_low_id == 0).values(
+        user_low_id=case((sender < receiver, sender), else_=receiver),
+        user_high_id=case((sender < receiver, receiver), else_=sender)
+    ))
+
+@migration(3, 'Widen message ids to 64 bits for time-sortable ids')
+def widen_message_ids(schema):
+    # SQLite integers are 64-bit already. Rows keep their old small ids, which sort before every new one
+    if schema.dialect == 'sqlite':
+        return
+    for table in ('messages', 'room_messages'):
+        if isinstance(schema.columns(table)['id']['type'], BigInteger):
+            continue
+        if schema.dialect == 'mysql':
+            schema.execute(f'ALTER TABLE {table} MODIFY id BIGINT NOT NULL AUTO_INCREMENT')
+        else:
+            schema.execute(f'ALTER TABLE {table} ALTER COLUMN id TYPE BIGINT')
+
+@migration(4, 'Create the composite indexes of the conversation, sync, room and ledger queries')
+def create_indexes(schema):
+    for table in db.metadata.sorted_tables:
+        existing = set(schema.indexes(table.name).values())
+        for index in table.indexes:
+            # Compared by columns, as database/init.py names some indexes differently
+            if tuple(column.name for column in index.columns) not in existing:
+                index.create(schema.connection)
+
+@migration(5, 'Drop single-column message indexes the composite ones replace')
+def drop_superseded_indexes(schema):
+    # (sender_id, id) and (receiver_id, id) serve every lookup by one participant, and
+    # nothing reads messages by timestamp since ids are time ordered
+    indexes = schema.indexes('messages')
+    for name in ('idx_sender', 'idx_receiver', 'idx_timestamp'):
+        if name in indexes:
+            schema.drop_index('messages', name)
+
+@migration(6, 'Move users.credits into the credit ledger')
+def move_credits(schema):
+    if 'credits' not in schema.columns('users'):
+        return
+
+    funded = {user_id for (user_id,) in schema.connection.execute(select(CreditBalance.user_id))}
+    now = datetime.utcnow()
+    transactions, balances = [], []
+    for user_id, credits in schema.execute('SELECT id, credits FROM users WHERE credits <> 0'):
+        if user_id in funded:
+            continue
+        transaction_id = next_id()
+        transactions.append({
+            'id': transaction_id, 'user_id': user_id, 'amount': credits, 'balance_after': credits,
+            'reason': 'opening_balance', 'created_at': now
+        })
+        balances.append({'user_id': user_id, 'balance': credits, 'last_transaction_id': transaction_id, 'updated_at': now})
+    if transactions:
+        schema.connection.execute(insert(CreditTransaction), transactions)
+        schema.connection.execute(insert(CreditBalance), balances)
+
+    # SQLite drops columns from 3.35 on; older versions keep it, unused
+    if schema.dialect != 'sqlite' or schema.connection.dialect.server_version_info >= (3, 35):
+        schema.drop_column('users', 'credits')
+
+def applied_migrations(engine):
+    with engine.connect() as connection:
+        if not inspect(connection).has_table(SchemaMigration.__tablename__):
+            return {}
+        return dict(connection.execute(select(SchemaMigration.version, SchemaMigration.applied_at)).all())
+
+def migrate(engine):
+    """
+    Bring a database up to models.py; returns the (version, description) of the migrations applied.
+
+    An empty database is created at the latest version and nothing is
+    returned. Each migration commits on its own, so a failed one can be
+    fixed and the command run again.
+    """
+    with engine.begin() as connection:
+        existing = set(inspect(connection).get_table_names())
+        if not existing & (set(db.metadata.tables) - {SchemaMigration.__tablename__}):
+            db.metadata.create_all(connection)
+            connection.execute(insert(SchemaMigration), [
+                {'version': version, 'description': description} for version, description, _ in MIGRATIONS
+            ])
+            return []
+        SchemaMigration.__table__.create(connection, checkfirst=True)
+
+    applied = applied_migrations(engine)
+    done = []
+    for version, description, upgrade in sorted(MIGRATIONS, key=lambda entry: entry[0]):
+        if version in applied:
+            continue
+        with engine.begin() as connection:
+            upgrade(Schema(connection))
+            connection.execute(insert(SchemaMigration).values(version=version, description=description))
+        done.append((version, description))
+    return done
+
+def first_id_of_month(year, month):
+    """
+    The lowest message id that can be assigned in a month (UTC)
+    """
+    return max_id_before(calendar.timegm((year, month, 1, 0, 0, 0)) * 1000) + 1
+
+def message_partitions(months_ahead=3, now=None):
+    """
+    (name, first id, end id) of the monthly partitions from the current month to `months_ahead` months on
+    """
+    now = now or datetime.utcnow()
+    year, month = now.year, now.month
+    partitions = []
+    for _ in range(months_ahead + 1):
+        next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+        partitions.append((f'p{year}{month:02d}', first_id_of_month(year, month), first_id_of_month(next_year, next_month)))
+        year, month = next_year, next_month
+    return partitions
+
+def ensure_message_partitions(engine, months_ahead=3, convert=False):
+    """
+    Create the monthly message partitions up to `months_ahead` months on; returns the names created.
+
+    MySQL: a table that is not partitioned yet is only converted with
+    `convert`, which rebuilds it and drops its foreign keys (MySQL does not
+    allow them on partitioned tables). Messages before the current month
+    go to p_history; p_future takes any id beyond the last month, so writes
+    never fail when this has not run in time, and is split when it does.
+
+    PostgreSQL cannot partition a table in place: messages must have been
+    created with PARTITION BY RANGE (id), then partitions named
+    messages_pYYYYMM are attached here. SQLite has no partitioning.
+    """
+    partitions = message_partitions(months_ahead)
+    with engine.begin() as connection:
+        dialect = connection.dialect.name
+        if dialect == 'mysql':
+            return _mysql_partitions(connection, partitions, convert)
+        if dialect == 'postgresql':
+            return _postgresql_partitions(connection, partitions)
+        raise RuntimeError(f"{dialect} does not support table partitioning")
+
+def _partition_list(partitions):
+    return ', '.join(f'PARTITION {name} VALUES LESS THAN ({end})' for name, _, end in partitions)
+
+def _mysql_partitions(connection, partitions, convert):
+    existing = {name for (name,) in connection.execute(text(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'messages' AND PARTITION_NAME IS NOT NULL"
+    ))}
+
+    if not existing:
+        if not convert:
+            raise RuntimeError("messages is not partitioned; converting rebuilds the table and drops its foreign keys, pass --convert to do so")
+        for foreign_key in inspect(connection).get_foreign_keys('messages'):
+            connection.execute(text(f"ALTER TABLE messages DROP FOREIGN KEY {foreign_key['name']}"))
+        history = partitions[0][1]
+        connection.execute(text(
+            f"ALTER TABLE messages PARTITION BY RANGE (id) (PARTITION p_history VALUES LESS THAN ({history}), "
+            f"{_partition_list(partitions)}, PARTITION p_future VALUES LESS THAN MAXVALUE)"
+        ))
+        return ['p_history'] + [name for name, _, _ in partitions] + ['p_future']
+
+    # Months are only ever added after the newest one, so the missing ones are split off p_future
+    missing = [partition for partition in partitions if partition[0] not in existing]
+    if missing:
+        connection.execute(text(
+            f"ALTER TABLE messages REORGANIZE PARTITION p_future INTO "
+            f"({_partition_list(missing)}, PARTITION p_future VALUES LESS THAN MAXVALUE)"
+        ))
+    return [name for name, _, _ in missing]
+
+def _postgresql_partitions(connection, partitions):
+    kind = connection.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('messages')")).scalar()
+    if kind != 'p':
+        raise RuntimeError("messages is not a partitioned table; PostgreSQL needs it recreated with PARTITION BY RANGE (id)")
+
+    created = []
+    for name, first_id, end_id in partitions:
+        table = f'messages_{name}'
+        if connection.execute(text('SELECT to_regclass(:name)'), {'name': table}).scalar() is not None:
+            continue
+        connection.execute(text(f'CREATE TABLE {table} PARTITION OF messages FOR VALUES FROM ({first_id}) TO ({end_id})'))
+        created.append(table)
+    return created
@@ -1,7 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from utils.ids import next_id
+from utils.database import RoutingSession
 
-db = SQLAlchemy()
+# Sessions can route reads to a replica, see utils.database
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -13,7 +16,7 @@ class User(db.Model):
     phone_number = db.Column(db.String(20))
     country = db.Column(db.String(2), default='US')
     avatar = db.Column(db.String(200))
-    credits = db.Column(db.Integer, default=0)
+    stripe_customer_id = db.Column(db.String(255))  # reused for every payment
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_online = db.Column(db.Boolean, default=False)
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
@@ -26,10 +29,18 @@ class User(db.Model):
     def __repr__(self):
         return f'<User {self.username}>'
 
+def conversation_key(user_a, user_b):
+    """
+    Return the (low_id, high_id) pair identifying a 1:1 conversation
+    """
+    user_a, user_b = int(user_a), int(user_b)
+    return (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+
 class Message(db.Model):
     __tablename__ = 'messages'
     
-    id = db.Column(db.Integer, primary_key=True)
+    # Time-sortable ids are assigned before the row is written, so messages can be delivered first
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, default=next_id)
     sender_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     content = db.Column(db.Text, nullable=False)
@@ -37,10 +48,142 @@ class Message(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     read = db.Column(db.Boolean, default=False)
     is_ai_generated = db.Column(db.Boolean, default=False)
+    file_id = db.Column(db.Integer, db.ForeignKey('user_files.id', ondelete='SET NULL'))
+    media = db.Column(db.JSON)  # preview metadata of the attached file
+    
+    # Canonical conversation key: the ordered pair of participants
+    user_low_id = db.Column(db.Integer, nullable=False)
+    user_high_id = db.Column(db.Integer, nullable=False)
+    
+    __table_args__ = (
+        db.Index('idx_conversation', 'user_low_id', 'user_high_id', 'id'),
+        db.Index('idx_conversation_high', 'user_high_id', 'user_low_id', 'id'),
+        db.Index('idx_messages_file', 'file_id'),
+        # Catch-up sync reads a user's new messages by sender and by receiver
+        db.Index('idx_messages_sender', 'sender_id', 'id'),
+        db.Index('idx_messages_receiver', 'receiver_id', 'id'),
+    )
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.sender_id is not None and self.receiver_id is not None:
+            self.user_low_id, self.user_high_id = conversation_key(self.sender_id, self.receiver_id)
+    
+    @classmethod
+    def between(cls, user_a, user_b):
+        """
+        Filter criterion matching every message exchanged by two users
+        """
+        low_id, high_id = conversation_key(user_a, user_b)
+        return (cls.user_low_id == low_id) & (cls.user_high_id == high_id)
     
     def __repr__(self):
         return f'<Message {self.id} from {self.sender_id} to {self.receiver_id}>'
 
+class ReadReceipt(db.Model):
+    __tablename__ = 'read_receipts'
+    
+    # How far user_id has read the conversation with contact_id
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    contact_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    last_read_id = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ReadReceipt user_id={self.user_id} contact_id={self.contact_id} last_read_id={self.last_read_id}>'
+
+class StoredFile(db.Model):
+    __tablename__ = 'stored_files'
+    
+    # Uploaded content, stored once under its sha256 and shared by every upload of it
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    media = db.Column(db.JSON)  # previews built by media_processing, None until requested
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<StoredFile {self.sha256} refs={self.ref_count}>'
+
+class DerivedFile(db.Model):
+    __tablename__ = 'derived_files'
+    
+    # A preview (thumbnail, poster) stored in the content store, and the file it was made from
+    sha256 = db.Column(db.String(64), primary_key=True)
+    source_sha256 = db.Column(db.String(64), db.ForeignKey('stored_files.sha256'), primary_key=True, index=True)
+    content_type = db.Column(db.String(100))
+    
+    def __repr__(self):
+        return f'<DerivedFile {self.sha256} of {self.source_sha256}>'
+
+class UserFile(db.Model):
+    __tablename__ = 'user_files'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    sha256 = db.Column(db.String(64), db.ForeignKey('stored_files.sha256'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    stored_file = db.relationship('StoredFile')
+    
+    def __repr__(self):
+        return f'<UserFile {self.id} {self.filename}>'
+
+class CreditBalance(db.Model):
+    __tablename__ = 'credit_balances'
+    
+    # Kept off the users row, which presence and profile updates also write
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    balance = db.Column(db.Integer, nullable=False, default=0)
+    last_transaction_id = db.Column(db.BigInteger)  # newest ledger entry included in the balance
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CreditBalance user_id={self.user_id} balance={self.balance}>'
+
+class CreditTransaction(db.Model):
+    __tablename__ = 'credit_transactions'
+    
+    # Append-only; a user's balance is the sum of their amounts
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, default=next_id)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)  # positive for credits, negative for debits
+    balance_after = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(30), nullable=False)  # purchase, room_join, opening_balance, adjustment
+    reference = db.Column(db.String(64))  # what it paid for, e.g. payment:12 or room:3
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('idx_credit_transactions_user', 'user_id', 'id'),
+    )
+    
+    def __repr__(self):
+        return f'<CreditTransaction {self.id} {self.amount:+d} for {self.user_id}>'
+
+class Payment(db.Model):
+    __tablename__ = 'payments'
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'idempotency_key', name='unique_payment_key'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    idempotency_key = db.Column(db.String(64), nullable=False)  # chosen by the client, one per purchase
+    amount = db.Column(db.Integer, nullable=False)  # in the smallest currency unit
+    currency = db.Column(db.String(3), nullable=False)
+    credits = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), default='pending')  # pending, requires_action, succeeded, failed
+    stripe_payment_intent_id = db.Column(db.String(255), unique=True)
+    error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<Payment {self.id} {self.status}>'
+
 class ChatRoom(db.Model):
     __tablename__ = 'chat_rooms'
     
@@ -54,13 +197,36 @@ class ChatRoom(db.Model):
     
     # Relationships
     users = db.relationship('UserChatRoom', backref='chat_room', lazy='dynamic')
+    messages = db.relationship('RoomMessage', backref='chat_room', lazy='dynamic')
     
     def __repr__(self):
         return f'<ChatRoom {self.name}>'
 
+class RoomMessage(db.Model):
+    __tablename__ = 'room_messages'
+    
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, default=next_id)
+    chat_room_id = db.Column(db.Integer, db.ForeignKey('chat_rooms.id'), nullable=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    message_type = db.Column(db.String(20), default='text')  # text, image, audio, video
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    is_ai_generated = db.Column(db.Boolean, default=False)
+    
+    __table_args__ = (
+        db.Index('idx_room_messages', 'chat_room_id', 'id'),
+    )
+    
+    def __repr__(self):
+        return f'<RoomMessage {self.id} from {self.sender_id} in {self.chat_room_id}>'
+
 class UserChatRoom(db.Model):
     __tablename__ = 'user_chat_rooms'
     
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'chat_room_id', name='unique_user_chat'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     chat_room_id = db.Column(db.Integer, db.ForeignKey('chat_rooms.id'), nullable=False)
@@ -69,3 +235,14 @@ class UserChatRoom(db.Model):
     
     def __repr__(self):
         return f'<UserChatRoom user_id={self.user_id} chat_room_id={self.chat_room_id}>'
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    
+    # One row per migration applied, see migrations.py
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SchemaMigration {self.version}>'
@@ -0,0 +1,129 @@
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError
+from utils.lru_cache import TTLCache
+
+def normalize_text(text):
+    """
+    Normalize text so trivially different messages share a verdict
+    """
+    return ' '.join(text.lower().split())
+
+def text_key(text):
+    """
+    Hash of the normalized text, used as the verdict cache key
+    """
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+class ModerationPipeline:
+    """
+    Batches pending texts into single moderation calls off the request path.
+
+    `submit` returns a Future resolved with the verdict dict produced by
+    `AIChatAssistant.moderate_batch`. Cached verdicts resolve immediately,
+    and identical texts waiting in the same batch share one API input.
+    Only verdicts of the moderation API are cached: blocklist fallbacks,
+    given while it fails or is slow, are not kept past the outage.
+    """
+    def __init__(self, assistant, batch_size=32, max_wait=0.05, cache_size=10000, cache_ttl=3600, timeout=5):
+        self.assistant = assistant
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self._pending = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='moderation', daemon=True)
+                self._worker.start()
+
+    def stop(self):
+        with self._lock:
+            if self._worker is not None:
+                self._pending.put(None)
+                self._worker.join()
+                self._worker = None
+
+    def submit(self, text):
+        """
+        Queue a text for moderation and return a Future for its verdict
+        """
+        future = Future()
+        key = text_key(text)
+
+        verdict = self.cache.get(key)
+        if verdict is not None:
+            future.set_result(verdict)
+            return future
+
+        self.start()
+        self._pending.put((key, text, future))
+        return future
+
+    def moderate(self, text, timeout=None):
+        """
+        Moderate a text, waiting for the batch it lands in; the blocklist decides after `timeout` seconds
+        """
+        try:
+            return self.submit(text).result(timeout=timeout or self.timeout)
+        except TimeoutError:
+            return self.assistant.fallback_verdict(text)
+
+    def _next_batch(self):
+        item = self._pending.get()
+        if item is None:
+            return None
+
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._pending.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            # Collapse duplicate texts so each is sent upstream only once
+            waiting = OrderedDict()
+            for key, text, future in batch:
+                waiting.setdefault(key, (text, []))[1].append(future)
+
+            try:
+                verdicts = self.assistant.moderate_batch([text for text, _ in waiting.values()])
+            except Exception as e:
+                for _, futures in waiting.values():
+                    for future in futures:
+                        future.set_exception(e)
+                continue
+
+            verdicts = list(verdicts)
+            for index, (key, (text, futures)) in enumerate(waiting.items()):
+                if index < len(verdicts):
+                    verdict = verdicts[index]
+                    if not verdict.get('fallback'):
+                        self.cache.set(key, verdict)
+                else:
+                    # The API answered for fewer texts than it was sent
+                    verdict = self.assistant.fallback_verdict(text)
+                for future in futures:
+                    future.set_result(verdict)
@@ -0,0 +1,157 @@
+import re
+import sqlite3
+from html import escape
+import threading
+import unicodedata
+
+# Runs of letters and digits, which is where SQLite's unicode61 tokenizer splits too
+WORD_PATTERN = re.compile(r'[^\W_]+')
+MAX_TERMS = 16
+SNIPPET_WORDS = 16
+USER_WIDTH = 10
+
+def normalize_word(word):
+    """
+    Lowercase a word and strip its accents, so "Café" is found as "cafe"
+    """
+    decomposed = unicodedata.normalize('NFKD', word.lower())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+def query_words(query):
+    return [normalize_word(word) for word in WORD_PATTERN.findall(query)][:MAX_TERMS]
+
+def user_term(user_id, word):
+    # Fixed-width ids keep u12 + "3ab" apart from u123 + "ab"
+    return f'u{int(user_id):0{USER_WIDTH}d}{word}'
+
+def participant_token(user_id):
+    return f'p{int(user_id)}'
+
+def highlight(content, words, prefix=True):
+    """
+    A window of `content` around its first match, HTML-escaped, with matched words in <mark>
+    """
+    if not words:
+        return escape(content)
+    exact, last = set(words[:-1]), words[-1]
+    spans = [match.span() for match in WORD_PATTERN.finditer(content)]
+
+    def matches(start, end):
+        word = normalize_word(content[start:end])
+        return word in exact or (word.startswith(last) if prefix else word == last)
+
+    hits = [index for index, (start, end) in enumerate(spans) if matches(start, end)]
+    if not hits:
+        return escape(content)
+
+    # Some context before the first match, and a full window near the end
+    first = max(0, min(hits[0] - SNIPPET_WORDS // 4, len(spans) - SNIPPET_WORDS))
+    window = spans[first:first + SNIPPET_WORDS]
+    hit_set = set(hits)
+
+    parts = ['…'] if first > 0 else []
+    # A window from the first word keeps whatever text comes before it
+    position = window[0][0] if first > 0 else 0
+    for index, (start, end) in enumerate(window, start=first):
+        parts.append(escape(content[position:start]))
+        word = escape(content[start:end])
+        parts.append(f'<mark>{word}</mark>' if index in hit_set else word)
+        position = end
+    if first + SNIPPET_WORDS < len(spans):
+        parts.append('…')
+    else:
+        parts.append(escape(content[position:]))
+    return ''.join(parts)
+
+class MessageSearchIndex:
+    """
+    Full-text index of direct messages in a SQLite FTS5 table.
+
+    Each message is a row keyed by its id. Its words are indexed once per
+    participant as user-scoped terms (user id + word), so a search only
+    reads the caller's own postings however large the index grows, and a
+    prefix only expands over words the caller has seen. The index lives in
+    its own SQLite file whatever database holds the messages, and is fed by
+    the message writer after each batch commits (see `add_many`).
+
+    Results are ranked by BM25, newest first among equal ranks, or by
+    recency alone. Pages continue from a cursor: the last id for recency,
+    rank and id for relevance. Ranks shift a little as messages are added,
+    so relevance pages are approximate while recency pages are exact.
+    """
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA busy_timeout=5000')
+            try:
+                self._conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS message_index USING fts5(terms, participants)')
+            except sqlite3.OperationalError as e:
+                raise RuntimeError(f"Message search needs SQLite with FTS5: {e}")
+            self._conn.commit()
+
+    def _row(self, message_id, sender_id, receiver_id, content):
+        words = {normalize_word(word) for word in WORD_PATTERN.findall(content)}
+        users = {sender_id, receiver_id}
+        terms = ' '.join(user_term(user_id, word) for user_id in users for word in words)
+        participants = ' '.join(participant_token(user_id) for user_id in users)
+        return message_id, terms, participants
+
+    def add_many(self, messages):
+        """
+        Index (id, sender_id, receiver_id, content) tuples; re-adding an id replaces it
+        """
+        rows = [self._row(*message) for message in messages]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany('DELETE FROM message_index WHERE rowid = ?', [(row[0],) for row in rows])
+            self._conn.executemany('INSERT INTO message_index (rowid, terms, participants) VALUES (?, ?, ?)', rows)
+            self._conn.commit()
+
+    def remove(self, message_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM message_index WHERE rowid = ?', (message_id,))
+            self._conn.commit()
+
+    def search(self, query, user_id, contact_id=None, limit=20, cursor=None, order='relevance'):
+        """
+        Message ids matching every word of `query` (the last as a prefix) in
+        conversations of `user_id`; returns ([(message_id, rank)], next_cursor)
+        """
+        words = query_words(query)
+        if not words:
+            return [], None
+
+        # Quoted, so nothing the user types is read as FTS5 syntax
+        terms = [f'"{user_term(user_id, word)}"' for word in words]
+        expression = f"terms : ({' '.join(terms)}*)"
+        if contact_id is not None:
+            expression += f' AND participants : "{participant_token(contact_id)}"'
+
+        sql = 'SELECT rowid, bm25(message_index, 1.0, 0.0) AS score FROM message_index WHERE message_index MATCH ?'
+        params = [expression]
+        if order == 'recent':
+            if cursor:
+                sql += ' AND rowid < ?'
+                params.append(int(cursor))
+            sql += ' ORDER BY rowid DESC'
+        else:
+            if cursor:
+                score, last_id = cursor.split(':')
+                sql += ' AND (score > ? OR (score = ? AND rowid < ?))'
+                params += [float(score), float(score), int(last_id)]
+            sql += ' ORDER BY score, rowid DESC'
+        sql += ' LIMIT ?'
+        params.append(limit + 1)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        page = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            last_id, score = page[-1]
+            next_cursor = str(last_id) if order == 'recent' else f'{score!r}:{last_id}'
+        return page, next_cursor
@@ -0,0 +1,126 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from utils.lru_cache import TTLCache
+
+def translation_key(text, language):
+    """
+    Content hash identifying a text in a target language
+    """
+    return hashlib.sha256(f"{language.strip().lower()}\0{text}".encode('utf-8')).hexdigest()
+
+class SQLiteTranslationStore:
+    """
+    Persistent translation cache shared across restarts and worker processes
+    """
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS translations ('
+                'key TEXT PRIMARY KEY, translation TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            self._conn.commit()
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        placeholders = ','.join('?' * len(keys))
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT key, translation FROM translations WHERE key IN ({placeholders})', list(keys)
+            ).fetchall()
+        return dict(rows)
+
+    def set_many(self, items):
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO translations (key, translation, created_at) VALUES (?, ?, ?)',
+                [(key, translation, now) for key, translation in items.items()]
+            )
+            self._conn.commit()
+
+class TranslationService:
+    """
+    Cached, batched front end to the assistant's translation calls.
+
+    Translations are looked up by content hash in an in-memory LRU and
+    then, when configured, a SQLite store. Only the misses go upstream,
+    in one call per batch. A failed translation comes back as the
+    original text and is not cached.
+    """
+    def __init__(self, assistant, cache_size=50000, store=None):
+        self.assistant = assistant
+        self.cache = TTLCache(cache_size, ttl=None)
+        self.store = store
+
+    def _lookup(self, keys):
+        found = {}
+        for key in keys:
+            translation = self.cache.get(key)
+            if translation is not None:
+                found[key] = translation
+
+        missing = [key for key in keys if key not in found]
+        if self.store is not None and missing:
+            stored = self.store.get_many(missing)
+            for key, translation in stored.items():
+                self.cache.set(key, translation)
+            found.update(stored)
+        return found
+
+    def _remember(self, translations):
+        for key, translation in translations.items():
+            self.cache.set(key, translation)
+        if self.store is not None:
+            self.store.set_many(translations)
+
+    def translate(self, text, language):
+        return self.translate_to_languages(text, [language])[0]
+
+    def translate_to_languages(self, text, languages):
+        """
+        Translate one text into each language, in the order given
+        """
+        keys = [translation_key(text, language) for language in languages]
+        found = self._lookup(keys)
+
+        missing = [language for language, key in zip(languages, keys) if key not in found]
+        if missing:
+            translations = self.assistant.translate_to_languages(text, missing)
+            fresh = {}
+            for language, translation in zip(missing, translations):
+                key = translation_key(text, language)
+                found[key] = translation
+                if translation != text:
+                    fresh[key] = translation
+            self._remember(fresh)
+
+        return [found[key] for key in keys]
+
+    def translate_texts(self, texts, language):
+        """
+        Translate each text into one language, in the order given
+        """
+        keys = [translation_key(text, language) for text in texts]
+        found = self._lookup(keys)
+
+        # Identical texts are only sent once
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in found))
+        if missing:
+            translations = self.assistant.translate_texts(missing, language)
+            fresh = {}
+            for text, translation in zip(missing, translations):
+                key = translation_key(text, language)
+                found[key] = translation
+                if translation != text:
+                    fresh[key] = translation
+            self._remember(fresh)
+
+        return [found[key] for key in keys]
@@ -1,15 +1,114 @@
+import threading
+import time
+from functools import wraps
 import bcrypt
+from flask import request, session
+from flask_socketio import emit
+from flask_jwt_extended import decode_token, get_jwt, verify_jwt_in_request
+
+try:
+    from eventlet import patcher, tpool
+except ImportError:
+    patcher = tpool = None
+
+DEFAULT_BCRYPT_ROUNDS = 12
+
+class PasswordHasher:
+    """
+    bcrypt hashing that keeps the event loop responsive.
+
+    bcrypt releases the GIL, so under eventlet each hash runs on a native
+    thread through eventlet's tpool while the calling greenlet yields; at
+    most `workers` run at once and the rest wait their turn without
+    blocking other greenlets. Without eventlet the hash runs inline.
+    """
+    def __init__(self, rounds=DEFAULT_BCRYPT_ROUNDS, workers=4):
+        self.rounds = rounds
+        self._slots = threading.BoundedSemaphore(workers)
+
+    def _run(self, fn, *args):
+        with self._slots:
+            if tpool is not None and patcher.is_monkey_patched('thread'):
+                return tpool.execute(fn, *args)
+            return fn(*args)
+
+    def hash(self, password):
+        hashed = self._run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(self.rounds))
+        return hashed.decode('utf-8')
+
+    def verify(self, password, hashed_password):
+        return self._run(bcrypt.checkpw, password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+    def needs_rehash(self, hashed_password):
+        """
+        True when a hash was made with a different work factor than the current one
+        """
+        try:
+            return int(hashed_password.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+password_hasher = PasswordHasher()
+
+def configure_password_hasher(rounds=DEFAULT_BCRYPT_ROUNDS, workers=4):
+    global password_hasher
+    password_hasher = PasswordHasher(rounds, workers)
+    return password_hasher
 
 def hash_password(password):
     """
     Hash a password using bcrypt
     """
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
-    return hashed.decode('utf-8')
+    return password_hasher.hash(password)
 
 def verify_password(password, hashed_password):
     """
     Verify a password against its hash
     """
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+    return password_hasher.verify(password, hashed_password)
+
+def authenticate_socket(auth=None):
+    """
+    Verify a socket's access token once and cache its identity in the connection session
+    """
+    token = (auth or {}).get('token') or request.args.get('token')
+    if token:
+        claims = decode_token(token)
+    else:
+        # Fall back to an Authorization header on the handshake request
+        verify_jwt_in_request(optional=True)
+        claims = get_jwt() or None
+    
+    if not claims:
+        return None
+    
+    if session.get('user_id') not in (None, claims['sub']):
+        raise ValueError("Token belongs to a different user")
+    
+    session['user_id'] = claims['sub']
+    session['token_exp'] = claims.get('exp')
+    return claims['sub']
+
+def socket_identity():
+    """
+    User id of the current socket connection
+    """
+    return session.get('user_id')
+
+def socket_auth_required(fn):
+    """
+    Require an authenticated, unexpired socket connection
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if session.get('user_id') is None:
+            emit('unauthorized', {'message': 'Authentication required'})
+            return
+        
+        token_exp = session.get('token_exp')
+        if token_exp is not None and token_exp < time.time():
+            emit('token_expired', {'message': 'Access token expired, send refresh_token with a new one'})
+            return
+        
+        return fn(*args, **kwargs)
+    return wrapper
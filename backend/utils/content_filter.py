@@ -0,0 +1,162 @@
+import os
+import re
+import threading
+import time
+
+try:
+    from eventlet import patcher, tpool
+except ImportError:
+    patcher = tpool = None
+
+# Common character substitutions folded back to letters before matching
+LEETSPEAK_TABLE = str.maketrans({
+    '0': 'o',
+    '1': 'i',
+    '3': 'e',
+    '4': 'a',
+    '5': 's',
+    '7': 't',
+    '@': 'a',
+    '$': 's'
+})
+
+def normalize(text):
+    """
+    Lowercase text and undo leetspeak substitutions
+    """
+    return text.lower().translate(LEETSPEAK_TABLE)
+
+def _trie_pattern(node):
+    """
+    Render a character trie as a prefix-factored regex fragment
+    """
+    if '' in node and len(node) == 1:
+        return ''
+
+    branches = []
+    optional = False
+    for char in sorted(node):
+        if char == '':
+            optional = True
+            continue
+        branches.append(re.escape(char) + _trie_pattern(node[char]))
+
+    if len(branches) == 1 and not optional:
+        return branches[0]
+
+    pattern = '(?:' + '|'.join(branches) + ')'
+    return pattern + '?' if optional else pattern
+
+def compile_terms(terms):
+    """
+    Compile blocked terms into one whole-word regex, or None when empty
+    """
+    trie = {}
+    for term in terms:
+        term = ' '.join(normalize(term).split())
+        if not term:
+            continue
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    if not trie:
+        return None
+
+    # Spaces inside phrases match any run of whitespace
+    pattern = _trie_pattern(trie).replace('\\ ', '\\s+')
+    return re.compile(r'(?<!\w)' + pattern + r'(?!\w)')
+
+def load_terms(path):
+    """
+    Read a blocklist file with one term per line and # comments
+    """
+    terms = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                terms.append(line)
+    return terms
+
+class BlocklistMatcher:
+    """
+    Precompiled blocklist matcher, reloaded when its file changes.
+
+    The terms are folded into a single trie-shaped regex so the cost per
+    message depends on the message length rather than the number of
+    terms. When backed by a file, the modification time is checked at
+    most every `reload_interval` seconds and the pattern is rebuilt on
+    change, in the background: compiling a large list takes seconds, so
+    messages keep being checked against the old pattern until the new one
+    replaces it. Under eventlet the rebuild runs on a native thread
+    through tpool, so it does not stall the event loop.
+    """
+    def __init__(self, path=None, terms=None, reload_interval=30):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._pattern = None
+        self._mtime = None
+        self._checked_at = 0
+        self._reloading = False
+        self._lock = threading.Lock()
+
+        if terms is not None:
+            self.set_terms(terms)
+        elif path is not None:
+            self.reload()
+
+    def set_terms(self, terms):
+        self._pattern = compile_terms(terms)
+
+    def reload(self):
+        """
+        Rebuild the pattern from the blocklist file
+        """
+        mtime = os.path.getmtime(self.path)
+        # Swapped in with one assignment, so a concurrent find() sees the old pattern or the new one
+        self._pattern = compile_terms(load_terms(self.path))
+        self._mtime = mtime
+        self._checked_at = time.monotonic()
+
+    def _maybe_reload(self):
+        if self.path is None or time.monotonic() - self._checked_at < self.reload_interval:
+            return
+
+        self._checked_at = time.monotonic()
+        try:
+            changed = os.path.getmtime(self.path) != self._mtime
+        except OSError:
+            # Keep serving the last good blocklist
+            return
+
+        with self._lock:
+            if not changed or self._reloading:
+                return
+            self._reloading = True
+        threading.Thread(target=self._reload_in_background, name='blocklist-reload', daemon=True).start()
+
+    def _reload_in_background(self):
+        try:
+            if tpool is not None and patcher.is_monkey_patched('thread'):
+                tpool.execute(self.reload)
+            else:
+                self.reload()
+        except Exception as e:
+            # Keep serving the last good blocklist
+            print(f'Blocklist reload failed: {e}')
+        finally:
+            self._reloading = False
+
+    def find(self, text):
+        """
+        Return the first blocked term found in text, or None
+        """
+        self._maybe_reload()
+        pattern = self._pattern
+        if pattern is None:
+            return None
+
+        match = pattern.search(normalize(text))
+        return match.group(0) if match else None
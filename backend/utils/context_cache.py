@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from models import conversation_key
+
+def estimate_tokens(text):
+    """
+    Rough token count, about four characters per token plus message overhead
+    """
+    return len(text) // 4 + 4
+
+class ConversationContextCache:
+    """
+    Rolling per-conversation buffers of recent messages for AI replies.
+
+    Each conversation keeps at most `max_messages` entries and is updated
+    as messages are persisted, so building a prompt does not touch the
+    database. Conversations are evicted least recently used first once
+    more than `max_conversations` are cached. A conversation that is not
+    cached is loaded once through the `loader` passed to `get_context`.
+    Only this process appends, so a buffer is reloaded `ttl` seconds after
+    it was loaded to pick up messages other processes have written.
+    """
+    def __init__(self, max_conversations=10000, max_messages=50, token_budget=1000, ttl=60):
+        self.max_conversations = max_conversations
+        self.max_messages = max_messages
+        self.token_budget = token_budget
+        self.ttl = ttl
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def append(self, message):
+        """
+        Record a persisted message, if its conversation is cached
+        """
+        key = conversation_key(message.sender_id, message.receiver_id)
+        with self._lock:
+            cached = self._buffers.get(key)
+            if cached is not None:
+                cached[1].append((message.id, message.sender_id, message.content))
+                self._buffers.move_to_end(key)
+
+    def invalidate(self, user_a, user_b):
+        with self._lock:
+            self._buffers.pop(conversation_key(user_a, user_b), None)
+
+    def _buffer(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._buffers.get(key)
+            if cached is not None and cached[0] > now - self.ttl:
+                self._buffers.move_to_end(key)
+                return list(cached[1])
+
+        # Load outside the lock, oldest message first
+        rows = loader(self.max_messages)
+        buffer = deque(((msg.id, msg.sender_id, msg.content) for msg in rows), maxlen=self.max_messages)
+
+        with self._lock:
+            # A concurrent loader may have won the race; keep whichever is already fresh
+            cached = self._buffers.get(key)
+            if cached is None or cached[0] <= now - self.ttl:
+                cached = self._buffers[key] = (now, buffer)
+            self._buffers.move_to_end(key)
+            while len(self._buffers) > self.max_conversations:
+                self._buffers.popitem(last=False)
+            return list(cached[1])
+
+    def get_context(self, user_id, contact_id, loader, token_budget=None):
+        """
+        Build the AI conversation for user_id, newest messages kept within the token budget
+        """
+        budget = token_budget or self.token_budget
+        entries = self._buffer(conversation_key(user_id, contact_id), loader)
+
+        conversation = []
+        used = 0
+        for _, sender_id, content in reversed(entries):
+            cost = estimate_tokens(content)
+            if conversation and used + cost > budget:
+                break
+            used += cost
+            role = "user" if sender_id == user_id else "assistant"
+            conversation.append({"role": role, "content": content})
+
+        conversation.reverse()
+        return conversation
@@ -0,0 +1,209 @@
+from functools import lru_cache
+
+from sqlalchemy import and_, bindparam, case, func, or_, select, union_all
+from models import db, User, Message, ReadReceipt, conversation_key
+from utils.serialization import RowSerializer
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+DEFAULT_SYNC_SIZE = 500
+# Conversations read per statement; SQLite allows at most 500 compound selects
+SYNC_BRANCHES = 128
+
+def clamp_page_size(limit, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """
+    Normalize a client supplied page size
+    """
+    try:
+        limit = int(limit) if limit is not None else default
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, maximum))
+
+def get_conversation_summaries(user_id, limit=DEFAULT_PAGE_SIZE, before_id=None):
+    """
+    Summarize every conversation of a user in a single query.
+
+    Only users the current user has exchanged messages with are returned,
+    each with the last message and the number of unread messages, newest
+    conversation first. Pages are keyed on the id of the last message so
+    `before_id` can be fed back from the previous page.
+    """
+    limit = clamp_page_size(limit)
+
+    partner_id = case(
+        (Message.user_low_id == user_id, Message.user_high_id),
+        else_=Message.user_low_id
+    )
+    # Received messages above the user's read watermark are unread
+    unread = case(
+        (and_(Message.receiver_id == user_id, Message.id > func.coalesce(ReadReceipt.last_read_id, 0)), 1),
+        else_=0
+    )
+
+    # Rank messages inside each conversation and count unread ones in the same pass
+    ranked = db.session.query(
+        partner_id.label('partner_id'),
+        Message.id.label('message_id'),
+        Message.content.label('content'),
+        Message.message_type.label('message_type'),
+        Message.timestamp.label('timestamp'),
+        func.row_number().over(
+            partition_by=partner_id,
+            order_by=Message.id.desc()
+        ).label('position'),
+        func.sum(unread).over(partition_by=partner_id).label('unread_count')
+    ).outerjoin(
+        ReadReceipt,
+        and_(ReadReceipt.user_id == user_id, ReadReceipt.contact_id == partner_id)
+    ).filter(
+        or_(Message.user_low_id == user_id, Message.user_high_id == user_id)
+    ).subquery()
+
+    summary = RowSerializer({
+        "id": User.id,
+        "username": User.username,
+        "avatar": User.avatar,
+        "last_message_id": ranked.c.message_id,
+        "last_message": ranked.c.content,
+        "last_message_type": ranked.c.message_type,
+        "last_message_time": ranked.c.timestamp,
+        "unread_count": ranked.c.unread_count
+    }, transforms={"unread_count": lambda count: int(count or 0)})
+
+    query = db.session.query(*summary.columns).join(
+        ranked, User.id == ranked.c.partner_id
+    ).filter(ranked.c.position == 1)
+
+    if before_id is not None:
+        query = query.filter(ranked.c.message_id < before_id)
+
+    rows = query.order_by(ranked.c.message_id.desc()).limit(limit + 1).all()
+
+    next_cursor = rows[limit - 1].last_message_id if len(rows) > limit else None
+    summaries = summary.rows(rows[:limit])
+
+    return summaries, next_cursor
+
+def get_message_page(user_id, contact_id, limit=DEFAULT_PAGE_SIZE, before_id=None, after_id=None, columns=None):
+    """
+    Fetch one page of the history between two users, oldest message first.
+
+    Without a cursor the most recent messages are returned. `before_id`
+    walks back into older history and `after_id` fetches newer messages.
+    The returned cursor continues in the same direction, or is None when
+    there is nothing more to fetch. With `columns` (which must include the
+    id, labelled `id`) rows are tuples of those columns instead of messages.
+    """
+    limit = clamp_page_size(limit)
+
+    query = db.session.query(*columns) if columns else Message.query
+    query = query.filter(Message.between(user_id, contact_id))
+
+    if after_id is not None:
+        rows = query.filter(Message.id > after_id).order_by(Message.id.asc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        messages = rows[:limit]
+        next_cursor = messages[-1].id if has_more else None
+    else:
+        if before_id is not None:
+            query = query.filter(Message.id < before_id)
+        rows = query.order_by(Message.id.desc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        messages = list(reversed(rows[:limit]))
+        next_cursor = messages[0].id if has_more else None
+
+    return messages, next_cursor
+
+@lru_cache(maxsize=32)
+def _delta_statement(columns, branches, with_since):
+    """
+    The catch-up query for `branches` conversations, built once per shape and reused with new parameters
+    """
+    def branch(*criteria):
+        return select(*columns).where(*criteria).order_by(Message.id).limit(bindparam('limit')).subquery()
+
+    parts = [
+        branch(
+            Message.user_low_id == bindparam(f'low_{index}'),
+            Message.user_high_id == bindparam(f'high_{index}'),
+            Message.id > bindparam(f'mark_{index}')
+        )
+        for index in range(branches)
+    ]
+    if with_since:
+        # Conversations the client has not seen, by receiver and by sender so each is one index range
+        parts.append(branch(
+            Message.receiver_id == bindparam('user_id'),
+            Message.id > bindparam('since'),
+            Message.sender_id.notin_(bindparam('known', expanding=True))
+        ))
+        parts.append(branch(
+            Message.sender_id == bindparam('user_id'),
+            Message.id > bindparam('since'),
+            Message.receiver_id.notin_(bindparam('known', expanding=True))
+        ))
+
+    combined = union_all(*[select(part) for part in parts]).subquery()
+    return select(combined).order_by(combined.c.id).limit(bindparam('limit'))
+
+def get_message_delta(user_id, marks, columns, since=None, limit=DEFAULT_SYNC_SIZE):
+    """
+    Messages of all conversations of a user that a client does not have yet, oldest first.
+
+    `marks` maps contact ids to the newest message id the client holds in
+    that conversation; other conversations are caught up from `since`, the
+    newest id the client has seen anywhere (or not at all without it).
+    Every conversation is read from its own index range, so the cost is
+    one seek per conversation plus the new messages, however long the
+    histories are. Rows are tuples of `columns`, which must include the
+    id, sender_id and receiver_id under those labels. Returns (rows,
+    has_more); with has_more, every message up to the last row returned
+    is included.
+    """
+    columns = tuple(columns)
+    conversations = [conversation_key(user_id, contact_id) + (mark,) for contact_id, mark in marks.items()]
+    known = list(marks) + [user_id]
+
+    rows = []
+    chunks = [conversations[start:start + SYNC_BRANCHES] for start in range(0, len(conversations), SYNC_BRANCHES)] or [[]]
+    for number, chunk in enumerate(chunks):
+        with_since = since is not None and number == 0
+        if not chunk and not with_since:
+            continue
+        # Round up to a power of two so only a few statement shapes are ever built
+        branches = 1 << (len(chunk) - 1).bit_length() if chunk else 0
+        params = {'limit': limit + 1}
+        for index in range(branches):
+            low_id, high_id, mark = chunk[index] if index < len(chunk) else (0, 0, 0)
+            params.update({f'low_{index}': low_id, f'high_{index}': high_id, f'mark_{index}': mark})
+        if with_since:
+            params.update({'user_id': user_id, 'since': since, 'known': known})
+        rows += db.session.execute(_delta_statement(columns, branches, with_since), params).all()
+
+    rows.sort(key=lambda row: row.id)
+    return rows[:limit], len(rows) > limit
+
+def get_read_watermark(user_id, contact_id):
+    """
+    Id of the newest message user_id has read from contact_id, 0 if none
+    """
+    receipt = ReadReceipt.query.get((user_id, contact_id))
+    return receipt.last_read_id if receipt is not None else 0
+
+def get_recent_messages(user_id, contact_id, limit):
+    """
+    Last `limit` messages between two users, oldest first
+    """
+    messages = Message.query.filter(
+        Message.between(user_id, contact_id)
+    ).order_by(Message.id.desc()).limit(limit).all()
+    return list(reversed(messages))
+
+def get_conversation_partners(user_id):
+    """
+    Ids of every user the given user has exchanged messages with
+    """
+    as_low = db.session.query(Message.user_high_id).filter(Message.user_low_id == user_id)
+    as_high = db.session.query(Message.user_low_id).filter(Message.user_high_id == user_id)
+    return {partner_id for (partner_id,) in as_low.union(as_high)}
@@ -0,0 +1,166 @@
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import event, func
+from models import db, CreditBalance, CreditTransaction
+from utils.ids import next_id, max_id_before
+from utils.lru_cache import TTLCache
+
+class InsufficientCredits(Exception):
+    """
+    Raised when a debit would take a balance below zero
+    """
+    pass
+
+@event.listens_for(CreditTransaction, 'before_update')
+@event.listens_for(CreditTransaction, 'before_delete')
+def _refuse_ledger_changes(mapper, connection, target):
+    raise ValueError("Credit transactions are append-only")
+
+class CreditLedger:
+    """
+    Append-only credit ledger with a materialized, cached balance per user.
+
+    `post` appends a transaction and moves the user's balance row with one
+    conditional UPDATE in the caller's database transaction, so whatever
+    the credits pay for commits or rolls back together with them. Balances
+    are read from the balance row, never by summing the ledger, and cached
+    for `cache_ttl` seconds; committed posts in this process refresh the
+    cache right away. Every `reconcile_interval` seconds `reconcile` checks
+    the balances of users with new transactions against their ledger.
+    """
+    def __init__(self, app, cache_size=100000, cache_ttl=30, reconcile_interval=3600):
+        self.app = app
+        self.reconcile_interval = reconcile_interval
+        self._balances = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self._checked_id = 0
+        self._lock = threading.Lock()
+        self._worker = None
+        event.listen(db.session, 'after_commit', self._committed)
+        event.listen(db.session, 'after_soft_rollback', self._rolled_back)
+
+    def start(self):
+        with self._lock:
+            if self._worker is None and self.reconcile_interval:
+                self._worker = threading.Thread(target=self._run, name='credit-reconcile', daemon=True)
+                self._worker.start()
+
+    def _remember(self, user_id, balance, transaction_id):
+        # Only ever replace a cached balance with a later one
+        with self._lock:
+            cached = self._balances.get(user_id)
+            if cached is None or (transaction_id or 0) >= (cached[1] or 0):
+                self._balances.set(user_id, (balance, transaction_id))
+
+    def _committed(self, session):
+        for user_id, (balance, transaction_id) in session.info.pop('credit_balances', {}).items():
+            self._remember(user_id, balance, transaction_id)
+
+    def _rolled_back(self, session, previous_transaction):
+        session.info.pop('credit_balances', None)
+
+    def balance(self, user_id):
+        cached = self._balances.get(user_id)
+        if cached is not None:
+            return cached[0]
+
+        row = db.session.query(CreditBalance.balance, CreditBalance.last_transaction_id).filter_by(user_id=user_id).first()
+        balance, transaction_id = row if row is not None else (0, None)
+        self._remember(user_id, balance, transaction_id)
+        return balance
+
+    def post(self, user_id, amount, reason, reference=None, allow_negative=False):
+        """
+        Append a transaction and apply it to the balance; the caller commits.
+
+        Raises InsufficientCredits, leaving the session untouched, when a
+        debit is larger than the balance.
+        """
+        transaction_id = next_id()
+        values = {
+            CreditBalance.balance: CreditBalance.balance + amount,
+            CreditBalance.last_transaction_id: transaction_id,
+            CreditBalance.updated_at: datetime.utcnow()
+        }
+        query = CreditBalance.query.filter(CreditBalance.user_id == user_id)
+        if amount < 0 and not allow_negative:
+            query = query.filter(CreditBalance.balance >= -amount)
+
+        if not query.update(values, synchronize_session=False):
+            if amount < 0 and not allow_negative:
+                raise InsufficientCredits(f"Not enough credits for {-amount}")
+            # First transaction of a user without a balance row yet
+            db.session.add(CreditBalance(user_id=user_id, balance=amount, last_transaction_id=transaction_id))
+            db.session.flush()
+
+        balance = db.session.query(CreditBalance.balance).filter_by(user_id=user_id).scalar()
+        entry = CreditTransaction(
+            id=transaction_id,
+            user_id=user_id,
+            amount=amount,
+            balance_after=balance,
+            reason=reason,
+            reference=reference
+        )
+        db.session.add(entry)
+        db.session.info.setdefault('credit_balances', {})[user_id] = (balance, transaction_id)
+        return entry
+
+    def transactions(self, user_id, limit, before_id=None):
+        """
+        A page of a user's transactions, newest first; returns (transactions, next_cursor)
+        """
+        query = CreditTransaction.query.filter(CreditTransaction.user_id == user_id)
+        if before_id is not None:
+            query = query.filter(CreditTransaction.id < before_id)
+        rows = query.order_by(CreditTransaction.id.desc()).limit(limit + 1).all()
+
+        page = rows[:limit]
+        next_cursor = page[-1].id if len(rows) > limit else None
+        return page, next_cursor
+
+    def reconcile(self, full=False, fix=True):
+        """
+        Compare balances with the sum of their ledger entries.
+
+        Only users with transactions since the last run are checked unless
+        `full` is set. With `fix`, a drifted balance is moved by the
+        difference, which stays correct if posts land meanwhile. Returns
+        (user_id, balance, ledger_sum) for every mismatch.
+        """
+        latest = db.session.query(func.max(CreditTransaction.id)).scalar() or 0
+        users = db.session.query(CreditTransaction.user_id)
+        if not full:
+            users = users.filter(CreditTransaction.id > self._checked_id, CreditTransaction.id <= latest)
+
+        ledger_sum = db.session.query(func.coalesce(func.sum(CreditTransaction.amount), 0)).filter(
+            CreditTransaction.user_id == CreditBalance.user_id
+        ).scalar_subquery()
+        rows = db.session.query(CreditBalance.user_id, CreditBalance.balance, ledger_sum).filter(
+            CreditBalance.user_id.in_(users.distinct())
+        ).all()
+
+        mismatches = [(user_id, balance, total) for user_id, balance, total in rows if balance != total]
+        if fix:
+            for user_id, balance, total in mismatches:
+                CreditBalance.query.filter_by(user_id=user_id).update(
+                    {CreditBalance.balance: CreditBalance.balance + (total - balance)}, synchronize_session=False
+                )
+                self._balances.pop(user_id)
+        db.session.commit()
+
+        # Ids are taken before commit, so look at the last minute again next time
+        settled = max_id_before(int((time.time() - 60) * 1000))
+        self._checked_id = max(self._checked_id, min(latest, settled))
+        return mismatches
+
+    def _run(self):
+        while True:
+            time.sleep(self.reconcile_interval)
+            try:
+                with self.app.app_context():
+                    for user_id, balance, total in self.reconcile():
+                        print(f'Credit balance of user {user_id} was {balance}, ledger says {total}')
+            except Exception as e:
+                print(f'Credit reconciliation failed: {e}')
@@ -0,0 +1,210 @@
+"""
+Database engine profiles, read-replica routing and a startup self-check.
+
+The profile follows DATABASE_URL unless DATABASE_PROFILE names one:
+
+- sqlite: single node. Connections run with WAL, synchronous=NORMAL,
+  memory-mapped reads and a busy timeout, so readers never wait for the
+  message writer and commits skip the extra fsync of the default mode.
+- mysql / postgresql: a queue pool sized by DB_POOL_SIZE and
+  DB_MAX_OVERFLOW, with pre-ping and recycling so connections dropped by
+  the server or a proxy are replaced instead of failing a request.
+
+Every profile raises the compiled statement cache to
+DB_STATEMENT_CACHE_SIZE. Under eventlet the pool's locks are green, so
+greenlets queue for a connection for at most DB_POOL_TIMEOUT seconds, but
+the driver must not block the hub: use mysql+pymysql, and psycopg2 only
+with psycogreen installed (it is patched automatically). `check_database`
+reports drivers that would block.
+
+With DATABASE_REPLICA_URL set, views wrapped in `read_replica` send their
+SELECTs to the replica; writes, and reads inside a flush, stay on the
+primary. Replicas lag, so only views that can show slightly stale data
+use it.
+"""
+import time
+from functools import wraps
+
+from flask import current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql import Select
+
+try:
+    from eventlet import patcher
+except ImportError:
+    patcher = None
+
+PROFILES = ('sqlite', 'mysql', 'postgresql')
+REPLICA_BIND = 'replica'
+
+# Drivers that wait on sockets in C, invisible to eventlet
+BLOCKING_DRIVERS = {'mysqldb', 'mysqlconnector'}
+
+def profile_for(url, profile=None):
+    """
+    The engine profile for a database URL, or the one named explicitly
+    """
+    profile = profile or make_url(url).get_backend_name()
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown database profile {profile!r}, expected one of {PROFILES}")
+    return profile
+
+def engine_options(url, profile=None, pool_size=10, max_overflow=20, pool_timeout=10, pool_recycle=1800, statement_cache_size=1000):
+    """
+    create_engine() options for a URL under its profile
+    """
+    options = {'query_cache_size': statement_cache_size}
+    if profile_for(url, profile) == 'sqlite':
+        # Pragmas are set per connection, see sqlite_pragmas
+        options['connect_args'] = {'timeout': 30}
+        return options
+
+    options.update({
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_recycle': pool_recycle,
+        'pool_pre_ping': True,
+        # Reuse the most recent connection so idle ones age out on the server side
+        'pool_use_lifo': True
+    })
+    return options
+
+def sqlite_pragmas(mmap_size=256 * 1024 * 1024, busy_timeout=5000):
+    return {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': mmap_size,
+        'busy_timeout': busy_timeout,
+        'temp_store': 'MEMORY'
+    }
+
+def configure_database(app):
+    """
+    Fill in engine options and the replica bind from the app config; call before db.init_app
+    """
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+    settings = {
+        'pool_size': app.config.get('DB_POOL_SIZE', 10),
+        'max_overflow': app.config.get('DB_MAX_OVERFLOW', 20),
+        'pool_timeout': app.config.get('DB_POOL_TIMEOUT', 10),
+        'pool_recycle': app.config.get('DB_POOL_RECYCLE', 1800),
+        'statement_cache_size': app.config.get('DB_STATEMENT_CACHE_SIZE', 1000)
+    }
+    profile = profile_for(url, app.config.get('DATABASE_PROFILE'))
+    options = engine_options(url, profile, **settings)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    replica_url = app.config.get('DATABASE_REPLICA_URL')
+    if replica_url:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds[REPLICA_BIND] = dict(engine_options(replica_url, profile, **settings), url=replica_url)
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+    if make_url(url).get_driver_name() == 'psycopg2' and _green():
+        try:
+            from psycogreen.eventlet import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            pass
+    return profile
+
+def install_pragmas(db, pragmas):
+    """
+    Run the SQLite pragmas on every new connection of the app's SQLite engines; needs an app context
+    """
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    for engine in db.engines.values():
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', on_connect)
+
+class RoutingSession(Session):
+    """
+    Session that sends SELECTs to the replica bind while `session.info['replica']` is set
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('replica') and not self._flushing and isinstance(clause, Select):
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def read_replica(view):
+    """
+    Serve a read-only view from the replica, when one is configured
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        session = current_app.extensions['sqlalchemy'].session
+        session.info['replica'] = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            session.info.pop('replica', None)
+    return wrapper
+
+def _green():
+    return patcher is not None and patcher.is_monkey_patched('socket')
+
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+    if hasattr(pool, 'checkedout'):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()
+        })
+    return stats
+
+def check_database(db):
+    """
+    Connect to every bind and report its driver, pool, latency and settings; needs an app context.
+
+    Returns {bind: report}, each report with a list of `warnings` for
+    settings that will hurt under load.
+    """
+    reports = {}
+    for name, engine in sorted(db.engines.items(), key=lambda item: item[0] is not None):
+        name = name or 'primary'
+        report = {
+            'url': engine.url.render_as_string(hide_password=True),
+            'dialect': engine.dialect.name,
+            'driver': engine.dialect.driver,
+            'warnings': []
+        }
+        try:
+            started = time.perf_counter()
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+                report['latency_ms'] = round((time.perf_counter() - started) * 1000, 2)
+                if engine.dialect.name == 'sqlite':
+                    report['pragmas'] = {
+                        pragma: connection.execute(text(f'PRAGMA {pragma}')).scalar()
+                        for pragma in ('journal_mode', 'synchronous', 'mmap_size', 'busy_timeout')
+                    }
+        except Exception as e:
+            report['error'] = str(e)
+        report.update(pool_stats(engine))
+
+        if _green() and engine.dialect.driver in BLOCKING_DRIVERS:
+            report['warnings'].append(f"{engine.dialect.driver} blocks eventlet; use mysql+pymysql")
+        if _green() and engine.dialect.driver == 'psycopg2':
+            try:
+                import psycogreen  # noqa: F401
+            except ImportError:
+                report['warnings'].append("psycopg2 blocks eventlet without psycogreen")
+        pragmas = report.get('pragmas') or {}
+        if pragmas and str(pragmas.get('journal_mode')).lower() not in ('wal', 'memory'):
+            report['warnings'].append(f"journal_mode is {pragmas.get('journal_mode')}, expected wal")
+        reports[name] = report
+    return reports
@@ -0,0 +1,51 @@
+import threading
+from collections import OrderedDict
+
+from utils.lru_cache import TTLCache
+
+class DeliveryQueue:
+    """
+    Direct messages per receiver that none of their devices has acked yet.
+
+    Messages are queued as they are sent and dropped once a device acks
+    them (`ack`). A reconnecting client gets what is still queued along
+    with its catch-up from the database, so messages sent while it was
+    away reach it even if they are still in the write buffer. Each user
+    keeps at most `max_per_user` messages, for `ttl` seconds after the
+    last one arrived; older ones are found by the database catch-up.
+    """
+    def __init__(self, max_users=100000, max_per_user=500, ttl=3600):
+        self.max_per_user = max_per_user
+        self._queues = TTLCache(max_size=max_users, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def push(self, user_id, message):
+        with self._lock:
+            queue = self._queues.get(user_id)
+            if queue is None:
+                queue = OrderedDict()
+            queue[message['id']] = message
+            while len(queue) > self.max_per_user:
+                queue.popitem(last=False)
+            self._queues.set(user_id, queue)
+
+    def pending(self, user_id):
+        """
+        Queued messages of a user, oldest first
+        """
+        with self._lock:
+            queue = self._queues.get(user_id)
+            return sorted(queue.values(), key=lambda message: message['id']) if queue else []
+
+    def ack(self, user_id, message_ids):
+        """
+        Drop delivered messages; returns how many were still queued
+        """
+        with self._lock:
+            queue = self._queues.get(user_id)
+            if not queue:
+                return 0
+            return sum(queue.pop(message_id, None) is not None for message_id in message_ids)
+
+    def remove(self, user_id, message_id):
+        self.ack(user_id, [message_id])
@@ -1,8 +1,27 @@
+import hashlib
+import json
+import mimetypes
 import os
+import re
+import tempfile
+import threading
+import time
 import uuid
-from datetime import datetime
 from werkzeug.utils import secure_filename
 from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from models import db, Message, StoredFile, UserFile, DerivedFile
+
+BLOCK_SIZE = 64 * 1024
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+class OffsetMismatch(Exception):
+    """
+    A chunk was sent for a different offset than the upload is at
+    """
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
 
 def allowed_file(filename):
     """
@@ -11,24 +30,277 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
-def save_uploaded_file(file, user_id):
+def content_type_for(filename):
+    """
+    Content type of a file going by its extension; the one a client declares is never trusted
+    """
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+class ContentStore:
+    """
+    Files stored once under the sha256 of their content.
+
+    Content lives at objects/ab/cd/abcd... below `root`, so no directory
+    holds more than 65536 subdirectories and the same bytes uploaded twice
+    take the space of one file.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def relative_path(self, sha256):
+        return os.path.join('objects', sha256[:2], sha256[2:4], sha256)
+
+    def path_for(self, sha256):
+        return os.path.join(self.root, self.relative_path(sha256))
+
+    def temp_dir(self):
+        path = os.path.join(self.root, 'tmp')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def write_stream(self, stream, max_size=None):
+        """
+        Copy a stream to disk block by block while hashing it; returns (sha256, size)
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.temp_dir())
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for block in iter(lambda: stream.read(BLOCK_SIZE), b''):
+                    size += len(block)
+                    if max_size is not None and size > max_size:
+                        raise ValueError("File too large")
+                    hasher.update(block)
+                    out.write(block)
+            sha256 = hasher.hexdigest()
+            self.commit(temp_path, sha256)
+            return sha256, size
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def commit(self, temp_path, sha256):
+        """
+        Move a finished file into place, or drop it if the content is already stored
+        """
+        target = self.path_for(sha256)
+        if os.path.exists(target):
+            os.remove(temp_path)
+            return target
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(temp_path, target)
+        return target
+
+    def delete(self, sha256):
+        try:
+            os.remove(self.path_for(sha256))
+        except FileNotFoundError:
+            pass
+
+class ChunkedUploads:
     """
-    Save an uploaded file to the server
+    Resumable uploads, appended to a partial file one chunk at a time.
+
+    Upload state is a JSON file next to the partial file, and the offset
+    is the partial file's size, so any process sharing the upload folder
+    can take the next chunk. The running sha256 stays in memory between
+    chunks and is rebuilt from the partial file when a chunk reaches a
+    process that has not seen the upload. Finished uploads are moved into
+    the ContentStore.
+    """
+    def __init__(self, store, max_size, expiry=24 * 3600):
+        self.store = store
+        self.max_size = max_size
+        self.expiry = expiry
+        self._hashers = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._last_sweep = 0
+
+    def _paths(self, upload_id):
+        if not UPLOAD_ID_PATTERN.match(upload_id):
+            raise LookupError("Upload not found")
+        directory = os.path.join(self.store.root, 'uploads')
+        return os.path.join(directory, f'{upload_id}.json'), os.path.join(directory, f'{upload_id}.part')
+
+    def create(self, user_id, filename, size):
+        if size < 0 or size > self.max_size:
+            raise ValueError(f"File size must be between 0 and {self.max_size} bytes")
+
+        self.expire()
+        upload_id = uuid.uuid4().hex
+        meta_path, part_path = self._paths(upload_id)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+
+        state = {
+            'upload_id': upload_id,
+            'user_id': user_id,
+            'filename': secure_filename(filename),
+            'size': size
+        }
+        open(part_path, 'wb').close()
+        with open(meta_path, 'w') as meta:
+            json.dump(state, meta)
+
+        state['offset'] = 0
+        return state
+
+    def status(self, upload_id, user_id):
+        meta_path, part_path = self._paths(upload_id)
+        try:
+            with open(meta_path) as meta:
+                state = json.load(meta)
+            state['offset'] = os.path.getsize(part_path)
+        except (FileNotFoundError, ValueError):
+            raise LookupError("Upload not found")
+
+        if state['user_id'] != user_id:
+            raise LookupError("Upload not found")
+        return state
+
+    def _upload_lock(self, upload_id):
+        with self._lock:
+            return self._locks.setdefault(upload_id, threading.Lock())
+
+    def _hasher(self, upload_id, part_path, offset):
+        known = self._hashers.get(upload_id)
+        if known is not None and known[0] == offset:
+            return known[1]
+
+        # Resumed somewhere else or after a restart: rehash what is on disk
+        hasher = hashlib.sha256()
+        with open(part_path, 'rb') as part:
+            for block in iter(lambda: part.read(BLOCK_SIZE), b''):
+                hasher.update(block)
+        return hasher
+
+    def append(self, upload_id, user_id, offset, stream):
+        """
+        Write one chunk at `offset`; the returned state has 'sha256' once the upload is complete
+        """
+        with self._upload_lock(upload_id):
+            state = self.status(upload_id, user_id)
+            if offset != state['offset']:
+                raise OffsetMismatch(state['offset'])
+
+            meta_path, part_path = self._paths(upload_id)
+            hasher = self._hasher(upload_id, part_path, offset)
+            self._hashers.pop(upload_id, None)
+
+            with open(part_path, 'ab') as part:
+                try:
+                    for block in iter(lambda: stream.read(BLOCK_SIZE), b''):
+                        if offset + len(block) > state['size']:
+                            raise ValueError("Chunk goes past the declared file size")
+                        hasher.update(block)
+                        part.write(block)
+                        offset += len(block)
+                except BaseException:
+                    # Drop the partial chunk so the client can resend it
+                    part.truncate(state['offset'])
+                    raise
+
+            state['offset'] = offset
+            if offset < state['size']:
+                self._hashers[upload_id] = (offset, hasher)
+                return state
+
+            state['sha256'] = hasher.hexdigest()
+            self.store.commit(part_path, state['sha256'])
+            os.remove(meta_path)
+
+        with self._lock:
+            self._locks.pop(upload_id, None)
+        return state
+
+    def expire(self):
+        """
+        Remove uploads untouched for longer than `expiry`, at most once a minute
+        """
+        now = time.time()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+
+        directory = os.path.join(self.store.root, 'uploads')
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < now - self.expiry:
+                    os.remove(path)
+                    self._hashers.pop(name.split('.')[0], None)
+            except OSError:
+                pass
+
+def add_file_reference(user_id, sha256, size, filename, content_type=None):
+    """
+    Record a user's upload of stored content, counting one more reference to it
+    """
+    counted = StoredFile.query.filter_by(sha256=sha256).update(
+        {StoredFile.ref_count: StoredFile.ref_count + 1}, synchronize_session=False
+    )
+    if not counted:
+        db.session.add(StoredFile(sha256=sha256, size=size, ref_count=1))
+        try:
+            db.session.flush()
+        except IntegrityError:
+            # Stored concurrently by another upload of the same content
+            db.session.rollback()
+            StoredFile.query.filter_by(sha256=sha256).update(
+                {StoredFile.ref_count: StoredFile.ref_count + 1}, synchronize_session=False
+            )
+
+    user_file = UserFile(user_id=user_id, sha256=sha256, filename=filename, content_type=content_type)
+    db.session.add(user_file)
+    db.session.commit()
+    return user_file
+
+def release_file_reference(user_file, store):
+    """
+    Delete a user's upload, and the stored content once nothing references it.
+
+    Messages it was attached to keep their text and lose the attachment.
+    """
+    sha256 = user_file.sha256
+    Message.query.filter(Message.file_id == user_file.id).update(
+        {Message.file_id: None, Message.media: None}, synchronize_session=False
+    )
+    db.session.delete(user_file)
+    db.session.flush()
+    StoredFile.query.filter_by(sha256=sha256).update(
+        {StoredFile.ref_count: StoredFile.ref_count - 1}, synchronize_session=False
+    )
+    unreferenced = StoredFile.query.filter(StoredFile.sha256 == sha256, StoredFile.ref_count <= 0)
+    if unreferenced.first() is None:
+        db.session.commit()
+        return
+
+    # Previews go with their source, unless another file produced the same bytes
+    derived = [sha for (sha,) in db.session.query(DerivedFile.sha256).filter_by(source_sha256=sha256)]
+    DerivedFile.query.filter_by(source_sha256=sha256).delete(synchronize_session=False)
+    removed = unreferenced.delete(synchronize_session=False)
+    db.session.flush()
+    shared = {sha for (sha,) in db.session.query(DerivedFile.sha256).filter(DerivedFile.sha256.in_(derived))}
+    shared |= {sha for (sha,) in db.session.query(StoredFile.sha256).filter(StoredFile.sha256.in_(derived))}
+    db.session.commit()
+
+    if removed:
+        store.delete(sha256)
+        for sha in set(derived) - shared:
+            store.delete(sha)
+
+def save_uploaded_file(file, user_id, store):
+    """
+    Stream a form upload into the content store and record it for the user
     """
     if file and allowed_file(file.filename):
-        # Create user directory if it doesn't exist
-        user_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], str(user_id))
-        if not os.path.exists(user_dir):
-            os.makedirs(user_dir)
-        
-        # Generate unique filename
+        sha256, size = store.write_stream(file.stream)
         filename = secure_filename(file.filename)
-        unique_filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex}_{filename}"
-        file_path = os.path.join(user_dir, unique_filename)
-        
-        # Save file
-        file.save(file_path)
-        
-        return file_path
-    
+        return add_file_reference(user_id, sha256, size, filename, content_type_for(filename))
+
     raise ValueError("Invalid file type")
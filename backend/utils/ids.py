@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+
+# 2024-01-01T00:00:00Z in milliseconds
+EPOCH_MS = 1704067200000
+
+TIMESTAMP_BITS = 41
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+class SnowflakeGenerator:
+    """
+    Time-sortable 53-bit ids: milliseconds since EPOCH_MS, worker id, sequence.
+
+    53 bits keeps ids exact as JavaScript numbers on the clients. Each
+    worker can issue 128 ids per millisecond; ids from different workers
+    never collide as long as their worker ids differ.
+    """
+    def __init__(self, worker_id=0):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now_ms = int(time.time() * 1000) - EPOCH_MS
+            # Never go backwards if the clock does
+            now_ms = max(now_ms, self._last_ms)
+
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond, borrow the next one
+                    now_ms += 1
+            else:
+                self._sequence = 0
+
+            self._last_ms = now_ms
+            return (now_ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+def max_id_before(timestamp_ms):
+    """
+    Largest id any worker can have issued before a Unix time in milliseconds
+    """
+    return ((timestamp_ms - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)) - 1
+
+def id_timestamp_ms(snowflake_id):
+    """
+    Unix time in milliseconds at which an id was generated
+    """
+    return (snowflake_id >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH_MS
+
+# Processes sharing a database must be given distinct worker ids with configure_worker();
+# the pid is only good enough for a single process
+_generator = SnowflakeGenerator(os.getpid() & MAX_WORKER_ID)
+
+def configure_worker(worker_id):
+    global _generator
+    _generator = SnowflakeGenerator(worker_id)
+
+def next_id():
+    return _generator.next_id()
@@ -0,0 +1,81 @@
+"""
+Serving stored uploads.
+
+Content never changes under its sha256, so the hash is a strong ETag and
+responses may be cached for good. Range requests (seeking in audio and
+video) and If-None-Match are answered by Werkzeug's conditional
+responses. The body is handed to the server's `wsgi.file_wrapper`, which
+gunicorn and uWSGI implement with sendfile(2).
+
+Behind nginx, set MEDIA_ACCEL_REDIRECT to an internal location and nginx
+sends the file itself, ranges included, after this app has checked access:
+
+    location /protected-media/ {
+        internal;
+        alias /path/to/backend/uploads/;
+    }
+
+Only the image, audio and video types in INLINE_TYPES are shown inline;
+anything else is sent as an attachment, and browsers are told not to
+sniff, so an upload can never run as a page on the API origin. Players
+that cannot send the Authorization header fetch a short-lived URL signed
+by `signed_media_query` instead of putting the access token in the URL.
+"""
+import hashlib
+import hmac
+import os
+import time
+from flask import Response, request, send_file
+
+CACHE_MAX_AGE = 365 * 24 * 3600
+INLINE_TYPES = frozenset({
+    'image/png', 'image/jpeg', 'image/gif', 'image/webp',
+    'audio/mpeg', 'audio/wav', 'audio/x-wav', 'audio/wave', 'audio/ogg',
+    'video/mp4', 'video/webm', 'video/ogg'
+})
+
+def _media_signature(secret, sha256, expires):
+    return hmac.new(secret.encode(), f'{sha256}:{expires}'.encode(), hashlib.sha256).hexdigest()
+
+def signed_media_query(secret, sha256, ttl=300):
+    """
+    Query parameters letting anyone holding them fetch the content for `ttl` seconds
+    """
+    expires = int(time.time()) + ttl
+    return {'expires': expires, 'signature': _media_signature(secret, sha256, expires)}
+
+def valid_media_signature(secret, sha256, expires, signature):
+    if not expires or not signature or not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(_media_signature(secret, sha256, int(expires)), signature)
+
+def media_response(store, sha256, content_type=None, filename=None, accel_redirect=None):
+    """
+    Response for stored content, honouring Range, If-None-Match and If-Range
+    """
+    inline = content_type in INLINE_TYPES
+    if not inline:
+        content_type = 'application/octet-stream'
+
+    if accel_redirect:
+        response = Response(mimetype=content_type)
+        response.headers['X-Accel-Redirect'] = accel_redirect.rstrip('/') + '/' + store.relative_path(sha256)
+        response.set_etag(sha256)
+        response.make_conditional(request)
+    else:
+        path = store.path_for(sha256)
+        if not os.path.exists(path):
+            raise FileNotFoundError(sha256)
+        response = send_file(path, mimetype=content_type, conditional=True, etag=sha256, max_age=CACHE_MAX_AGE)
+        response.accept_ranges = 'bytes'
+
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if not inline:
+        response.headers.set('Content-Disposition', 'attachment', filename=filename or sha256)
+
+    # Shared caches must not keep content that needs a token to fetch
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
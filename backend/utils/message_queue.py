@@ -0,0 +1,264 @@
+"""
+Cross-process Socket.IO broadcasting.
+
+Running several app processes behind a load balancer needs two things:
+
+1. A message queue, so `emit(..., room=...)` in one process reaches clients
+   connected to the others. Set SOCKETIO_MESSAGE_QUEUE to a Redis URL
+   (redis://host:6379/0) to use Flask-SocketIO's Redis manager, or to
+   local://host:port to use the small relay in this module, started with
+
+       python utils/message_queue.py --port 6390
+
+2. Sticky sessions, because Socket.IO's HTTP long-polling transport sends
+   several requests per connection and they must all hit the same process.
+   With nginx, route by client address:
+
+       upstream chat_workers {
+           ip_hash;
+           server 127.0.0.1:5001;
+           server 127.0.0.1:5002;
+       }
+
+   and forward the Upgrade/Connection headers for WebSocket. Clients that
+   connect with `transports: ['websocket']` do not need stickiness.
+   Also set `proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;`
+   and TRUSTED_PROXY_HOPS=1, so the per-IP login limit sees client
+   addresses rather than nginx's.
+
+Each worker is started with its own PORT. In-process caches (rooms,
+AI context, translations) stay per process; see config.py for their TTLs.
+Changes other processes must act on at once, such as a member leaving a
+room, go out as `ClusterEvents` on the same queue.
+"""
+import argparse
+import json
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+from socketio import PubSubManager
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+DEFAULT_PORT = 6390
+
+class _RelayHandler(socketserver.StreamRequestHandler):
+    """
+    Line protocol: `SUB <channel>` subscribes the connection, `PUB <channel> <payload>` relays payload
+    """
+    def handle(self):
+        broker = self.server
+        lock = threading.Lock()
+        subscribed = []
+        try:
+            for raw in self.rfile:
+                command, _, rest = raw.decode('utf-8').rstrip('\n').partition(' ')
+                if command == 'SUB':
+                    broker.subscribe(rest, self.wfile, lock)
+                    subscribed.append(rest)
+                elif command == 'PUB':
+                    channel, _, payload = rest.partition(' ')
+                    broker.publish(channel, payload)
+        finally:
+            for channel in subscribed:
+                broker.unsubscribe(channel, self.wfile)
+
+class LocalBroker(socketserver.ThreadingTCPServer):
+    """
+    Minimal pub/sub relay standing in for Redis on a single host or in tests
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
+        super().__init__((host, port), _RelayHandler)
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, stream, lock):
+        with self._lock:
+            self._subscribers.setdefault(channel, {})[stream] = lock
+
+    def unsubscribe(self, channel, stream):
+        with self._lock:
+            self._subscribers.get(channel, {}).pop(stream, None)
+
+    def publish(self, channel, payload):
+        with self._lock:
+            targets = list(self._subscribers.get(channel, {}).items())
+
+        line = (payload + '\n').encode('utf-8')
+        for stream, lock in targets:
+            try:
+                with lock:
+                    stream.write(line)
+                    stream.flush()
+            except OSError:
+                self.unsubscribe(channel, stream)
+
+    def start(self):
+        """
+        Serve on a background thread and return the broker URL
+        """
+        thread = threading.Thread(target=self.serve_forever, name='mq-broker', daemon=True)
+        thread.start()
+        host, port = self.server_address
+        return f'local://{host}:{port}'
+
+class LocalQueueManager(PubSubManager):
+    """
+    Socket.IO client manager that shares emits through a LocalBroker
+    """
+    name = 'local'
+
+    def __init__(self, url=f'local://127.0.0.1:{DEFAULT_PORT}', channel='flask-socketio',
+                 write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or '127.0.0.1', parsed.port or DEFAULT_PORT)
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+
+    def _publish(self, data):
+        line = f'PUB {self.channel} {self.json.dumps(data)}\n'.encode('utf-8')
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = socket.create_connection(self.address)
+                    self._publisher.sendall(line)
+                    return
+                except OSError:
+                    self._publisher = None
+                    if attempt:
+                        self._get_logger().error('Cannot publish to message queue, giving up')
+
+    def _listen(self):
+        retry_sleep = 1
+        while True:
+            try:
+                with socket.create_connection(self.address) as conn:
+                    conn.sendall(f'SUB {self.channel}\n'.encode('utf-8'))
+                    retry_sleep = 1
+                    for line in conn.makefile('r', encoding='utf-8'):
+                        yield line.rstrip('\n')
+            except OSError:
+                self._get_logger().error(f'Cannot receive from message queue, retrying in {retry_sleep} secs')
+            time.sleep(retry_sleep)
+            retry_sleep = min(retry_sleep * 2, 60)
+
+class ClusterEvents:
+    """
+    Server-to-server notices over the SOCKETIO_MESSAGE_QUEUE.
+
+    `publish(kind, **data)` runs the handlers registered with `on(kind, ...)`
+    in this process right away and in every other process when the notice
+    arrives. Without a queue there are no other processes and publishing
+    only runs the local handlers.
+    """
+    def __init__(self, url=None, channel='chat-events'):
+        self.url = url
+        self.channel = channel
+        self.host_id = uuid.uuid4().hex
+        self._handlers = {}
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+        self._listener = None
+
+        if url and url.startswith('redis') and redis is None:
+            raise RuntimeError("The redis package is required for a Redis message queue")
+        if url and not url.startswith(('redis', 'local://')):
+            raise RuntimeError(f"Cluster events need a Redis or local:// message queue, not {url}")
+        parsed = urlparse(url or '')
+        self.address = (parsed.hostname or '127.0.0.1', parsed.port or DEFAULT_PORT)
+
+    def on(self, kind, handler):
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def publish(self, kind, **data):
+        self._dispatch(kind, data)
+        if self.url:
+            self._send(json.dumps({'kind': kind, 'host_id': self.host_id, 'data': data}))
+
+    def start(self):
+        if self.url and self._listener is None:
+            self._listener = threading.Thread(target=self._run, name='cluster-events', daemon=True)
+            self._listener.start()
+
+    def _dispatch(self, kind, data):
+        for handler in self._handlers.get(kind, []):
+            try:
+                handler(**data)
+            except Exception as e:
+                print(f'Cluster event {kind} failed: {e}')
+
+    def _send(self, payload):
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self.url.startswith('redis'):
+                        if self._publisher is None:
+                            self._publisher = redis.Redis.from_url(self.url)
+                        self._publisher.publish(self.channel, payload)
+                    else:
+                        if self._publisher is None:
+                            self._publisher = socket.create_connection(self.address)
+                        self._publisher.sendall(f'PUB {self.channel} {payload}\n'.encode('utf-8'))
+                    return
+                except Exception as e:
+                    self._publisher = None
+                    if attempt:
+                        print(f'Cannot publish cluster event: {e}')
+
+    def _messages(self):
+        if self.url.startswith('redis'):
+            pubsub = redis.Redis.from_url(self.url).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.channel)
+            for message in pubsub.listen():
+                yield message['data'].decode('utf-8')
+        else:
+            with socket.create_connection(self.address) as conn:
+                conn.sendall(f'SUB {self.channel}\n'.encode('utf-8'))
+                for line in conn.makefile('r', encoding='utf-8'):
+                    yield line.rstrip('\n')
+
+    def _run(self):
+        retry_sleep = 1
+        while True:
+            try:
+                for raw in self._messages():
+                    retry_sleep = 1
+                    message = json.loads(raw)
+                    if message['host_id'] != self.host_id:
+                        self._dispatch(message['kind'], message['data'])
+            except Exception as e:
+                print(f'Cannot receive cluster events, retrying in {retry_sleep} secs: {e}')
+            time.sleep(retry_sleep)
+            retry_sleep = min(retry_sleep * 2, 60)
+
+def socketio_queue_options(url):
+    """
+    SocketIO constructor options for a SOCKETIO_MESSAGE_QUEUE setting
+    """
+    if not url:
+        return {}
+    if url.startswith('local://'):
+        return {'client_manager': LocalQueueManager(url)}
+    return {'message_queue': url}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local Socket.IO message queue relay')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    broker = LocalBroker(args.host, args.port)
+    print(f'Message queue listening on local://{args.host}:{args.port}')
+    broker.serve_forever()
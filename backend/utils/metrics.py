@@ -0,0 +1,61 @@
+import threading
+from collections import deque
+
+class Timing:
+    """
+    Running count/total plus a bounded window of recent samples for percentiles
+    """
+    def __init__(self, window=1024):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=window)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+        return ordered[index]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99)
+        }
+
+class Metrics:
+    """
+    Minimal in-process metrics registry of timings and gauges
+    """
+    def __init__(self):
+        self._timings = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = Timing()
+            timing.observe(value)
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "timings": {name: timing.snapshot() for name, timing in self._timings.items()},
+                "gauges": dict(self._gauges)
+            }
+
+metrics = Metrics()
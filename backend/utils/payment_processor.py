@@ -1,76 +1,192 @@
+"""
+Stripe payments, confirmed asynchronously.
+
+A purchase is recorded as a pending Payment under the client's
+idempotency key before Stripe is called, so retrying the request never
+charges twice. The PaymentIntent is created off the request (see
+`create_payment_intent`) with an idempotency key derived from the payment
+id, and every user keeps one Stripe customer. The payment is settled by
+whichever comes first of the intent's own result and the
+payment_intent.* webhook; `settle_payment` credits the user once however
+often it is called. A payment whose intent never came back (the job timed
+out, or Stripe could not be reached) is looked up later with
+`find_payment_intent`, so none stays pending for good.
+
+To develop against a local mock instead of Stripe, run stripe-mock
+(docker run -p 12111:12111 stripe/stripe-mock), set STRIPE_API_BASE to
+http://localhost:12111 and POST events to /api/payment/webhook yourself.
+Webhooks are refused without STRIPE_WEBHOOK_SECRET; for that setup only,
+STRIPE_WEBHOOK_ALLOW_UNSIGNED accepts them unchecked.
+"""
+import json
+from datetime import datetime
+
 import stripe
-from flask import current_app
+from models import db, User, Payment
+
+FINAL_STATUSES = ('succeeded', 'failed')
+
+def configure_stripe(api_key, api_base=None, max_network_retries=2):
+    """
+    Set the Stripe credentials once at startup; payment jobs run outside any request
+    """
+    stripe.api_key = api_key
+    if api_base:
+        stripe.api_base = api_base
+    # Safe to retry: every call that creates something carries an idempotency key
+    stripe.max_network_retries = max_network_retries
 
-def process_payment(user_id, amount, currency, payment_method, card_token=None):
+def payment_error_message(e):
     """
-    Process a payment using Stripe
+    A message for the client describing a failed Stripe call
+    """
+    if isinstance(e, stripe.error.CardError):
+        return f"Card error: {e.error.message}"
+    if isinstance(e, stripe.error.RateLimitError):
+        return "Too many requests. Please try again later."
+    if isinstance(e, stripe.error.InvalidRequestError):
+        return f"Invalid request: {e.error.message}"
+    if isinstance(e, stripe.error.AuthenticationError):
+        return "Authentication error. Please contact support."
+    if isinstance(e, stripe.error.APIConnectionError):
+        return "Network error. Please check your connection and try again."
+    if isinstance(e, stripe.error.StripeError):
+        return f"Payment error: {e.user_message or str(e)}"
+    return f"Unexpected error: {str(e)}"
+
+def _customer_id(user_id):
+    # Concurrent first payments agree on one customer through the key
+    customer = stripe.Customer.create(
+        description=f"Customer for user {user_id}",
+        metadata={'user_id': user_id},
+        idempotency_key=f"customer-{user_id}"
+    )
+    return customer.id
+
+def _intent_result(customer_id, intent):
+    return {
+        'customer_id': customer_id,
+        'intent_id': intent.id,
+        'status': intent.status,
+        'amount_received': intent.amount_received,
+        'currency': intent.currency,
+        'client_secret': intent.client_secret if intent.status == 'requires_action' else None
+    }
+
+def create_payment_intent(payload):
+    """
+    Job: create and confirm the PaymentIntent for a pending payment.
+
+    Creates the user's Stripe customer first if they have none. Returns the
+    intent's id and status, the customer id, the client secret when the
+    customer has to authenticate, and an error message if Stripe refused.
+    Raises when Stripe could not be reached, as the intent may exist then.
     """
+    customer_id = payload.get('customer_id')
     try:
-        # Set Stripe API key
-        stripe.api_key = current_app.config['STRIPE_SECRET_KEY']
-        
-        # Create payment intent
-        if card_token:
-            # Create customer and charge
-            customer = stripe.Customer.create(
-                source=card_token,
-                description=f"Customer for user {user_id}"
-            )
-            
-            charge = stripe.Charge.create(
-                amount=int(amount * 100),  # Convert to cents
-                currency=currency.lower(),
-                customer=customer.id,
-                description=f"Payment from user {user_id}"
-            )
-        else:
-            # Use payment method
-            intent = stripe.PaymentIntent.create(
-                amount=int(amount * 100),
-                currency=currency.lower(),
-                payment_method=payment_method,
-                confirmation_method='manual',
-                confirm=True
-            )
-        
-        return {
-            "success": True,
-            "message": "Payment processed successfully",
-            "transaction_id": charge.id if card_token else intent.id
-        }
-        
-    except stripe.error.CardError as e:
-        return {
-            "success": False,
-            "message": f"Card error: {e.error.message}"
-        }
-    except stripe.error.RateLimitError as e:
-        return {
-            "success": False,
-            "message": "Too many requests. Please try again later."
-        }
-    except stripe.error.InvalidRequestError as e:
-        return {
-            "success": False,
-            "message": f"Invalid request: {e.error.message}"
-        }
-    except stripe.error.AuthenticationError as e:
-        return {
-            "success": False,
-            "message": "Authentication error. Please contact support."
-        }
-    except stripe.error.APIConnectionError as e:
-        return {
-            "success": False,
-            "message": "Network error. Please check your connection and try again."
+        if not customer_id:
+            customer_id = _customer_id(payload['user_id'])
+
+        params = {
+            'amount': payload['amount'],
+            'currency': payload['currency'].lower(),
+            'customer': customer_id,
+            'confirm': True,
+            'description': f"Payment from user {payload['user_id']}",
+            'metadata': {'payment_id': payload['payment_id'], 'user_id': payload['user_id']}
         }
+        if payload.get('card_token'):
+            params['payment_method_data'] = {'type': 'card', 'card': {'token': payload['card_token']}}
+        else:
+            params['payment_method'] = payload['payment_method']
+
+        intent = stripe.PaymentIntent.create(idempotency_key=f"payment-{payload['payment_id']}", **params)
+        return _intent_result(customer_id, intent)
+    except stripe.error.APIConnectionError:
+        raise
     except stripe.error.StripeError as e:
+        intent = getattr(e.error, 'payment_intent', None) if e.error else None
         return {
-            "success": False,
-            "message": f"Payment error: {e.error.message}"
-        }
-    except Exception as e:
-        return {
-            "success": False,
-            "message": f"Unexpected error: {str(e)}"
+            'customer_id': customer_id,
+            'intent_id': intent['id'] if intent else None,
+            'status': 'failed',
+            'error': payment_error_message(e)
         }
+
+def find_payment_intent(payload):
+    """
+    Job: find the PaymentIntent of a payment whose creation was never confirmed.
+
+    Looks for the intent by its id when one was recorded, else among the
+    customer's intents since the payment was made, by the payment id in
+    their metadata. Returns what `create_payment_intent` does; a payment
+    Stripe has no intent for is failed.
+    """
+    customer_id = payload.get('customer_id') or _customer_id(payload['user_id'])
+    if payload.get('intent_id'):
+        return _intent_result(customer_id, stripe.PaymentIntent.retrieve(payload['intent_id']))
+
+    intents = stripe.PaymentIntent.list(customer=customer_id, created={'gte': payload['created'] - 60}, limit=100)
+    for intent in intents.auto_paging_iter():
+        if intent.metadata.get('payment_id') == str(payload['payment_id']):
+            return _intent_result(customer_id, intent)
+    return {'customer_id': customer_id, 'intent_id': None, 'status': 'failed', 'error': "The payment never reached Stripe"}
+
+def record_customer(user_id, customer_id):
+    """
+    Remember the user's Stripe customer, keeping the first one if two were recorded
+    """
+    User.query.filter(User.id == user_id, User.stripe_customer_id.is_(None)).update(
+        {User.stripe_customer_id: customer_id}, synchronize_session=False
+    )
+
+def settle_payment(ledger, payment_id, status, intent_id=None, error=None, amount_received=None, currency=None):
+    """
+    Move an unsettled payment to `status`, crediting the user if it succeeded.
+
+    The status change is conditional on the payment not being final yet and
+    the credit is posted to the ledger in the same transaction, so duplicate
+    webhooks or a webhook racing the job credit exactly once. A success
+    only credits when `amount_received` and `currency`, as reported by
+    Stripe for the intent, match the payment; otherwise the payment fails.
+    Returns True if this call settled the payment.
+    """
+    if status == 'succeeded':
+        amount, expected_currency = db.session.query(Payment.amount, Payment.currency).filter_by(id=payment_id).one()
+        if amount_received != amount or (currency or '').upper() != expected_currency:
+            status = 'failed'
+            error = f"Stripe received {amount_received} {(currency or '').upper()}, expected {amount} {expected_currency}"
+
+    values = {Payment.status: status, Payment.updated_at: datetime.utcnow()}
+    if intent_id:
+        values[Payment.stripe_payment_intent_id] = intent_id
+    if error:
+        values[Payment.error] = error[:255]
+
+    settled = Payment.query.filter(
+        Payment.id == payment_id,
+        Payment.status.notin_(FINAL_STATUSES)
+    ).update(values, synchronize_session=False)
+
+    if settled and status == 'succeeded':
+        user_id, credits = db.session.query(Payment.user_id, Payment.credits).filter_by(id=payment_id).one()
+        ledger.post(user_id, credits, 'purchase', f'payment:{payment_id}')
+    db.session.commit()
+    return bool(settled)
+
+def parse_webhook(payload, signature, secret=None, allow_unsigned=False):
+    """
+    Verify and decode a webhook body; raises ValueError for a bad payload or signature.
+
+    Without a secret every webhook is refused, unless `allow_unsigned` is
+    set for local development against stripe-mock.
+    """
+    if not secret:
+        if not allow_unsigned:
+            raise ValueError("no webhook secret is configured")
+        return stripe.Event.construct_from(json.loads(payload), stripe.api_key)
+
+    try:
+        return stripe.Webhook.construct_event(payload, signature, secret)
+    except stripe.error.SignatureVerificationError as e:
+        raise ValueError(str(e))
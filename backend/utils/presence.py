@@ -0,0 +1,175 @@
+import threading
+import time
+from datetime import datetime
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+class MemoryPresenceStore:
+    """
+    Connections and heartbeats of the users connected to this process
+    """
+    def __init__(self):
+        self._connections = {}
+        self._heartbeats = {}
+        self._lock = threading.Lock()
+
+    def add(self, user_id, sid, now):
+        with self._lock:
+            sids = self._connections.setdefault(user_id, set())
+            sids.add(sid)
+            self._heartbeats[sid] = (user_id, now)
+            return len(sids)
+
+    def remove(self, user_id, sid):
+        with self._lock:
+            self._heartbeats.pop(sid, None)
+            sids = self._connections.get(user_id)
+            if sids is None:
+                return 0
+            sids.discard(sid)
+            if not sids:
+                del self._connections[user_id]
+            return len(sids)
+
+    def touch(self, user_id, sid, now):
+        with self._lock:
+            if sid in self._heartbeats:
+                self._heartbeats[sid] = (user_id, now)
+
+    def expired(self, deadline):
+        with self._lock:
+            return [(user_id, sid) for sid, (user_id, seen) in self._heartbeats.items() if seen < deadline]
+
+    def online(self, user_ids):
+        with self._lock:
+            return {user_id for user_id in user_ids if user_id in self._connections}
+
+class RedisPresenceStore:
+    """
+    Presence shared by every worker process through Redis
+    """
+    def __init__(self, url, prefix='presence'):
+        if redis is None:
+            raise RuntimeError("The redis package is required for the Redis presence store")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, user_id):
+        return f'{self.prefix}:user:{user_id}'
+
+    def add(self, user_id, sid, now):
+        pipe = self.client.pipeline()
+        pipe.sadd(self._key(user_id), sid)
+        pipe.zadd(f'{self.prefix}:heartbeats', {f'{user_id}:{sid}': now})
+        pipe.scard(self._key(user_id))
+        return pipe.execute()[-1]
+
+    def remove(self, user_id, sid):
+        pipe = self.client.pipeline()
+        pipe.srem(self._key(user_id), sid)
+        pipe.zrem(f'{self.prefix}:heartbeats', f'{user_id}:{sid}')
+        pipe.scard(self._key(user_id))
+        return pipe.execute()[-1]
+
+    def touch(self, user_id, sid, now):
+        self.client.zadd(f'{self.prefix}:heartbeats', {f'{user_id}:{sid}': now}, xx=True)
+
+    def expired(self, deadline):
+        members = self.client.zrangebyscore(f'{self.prefix}:heartbeats', '-inf', deadline)
+        result = []
+        for member in members:
+            user_id, _, sid = member.decode('utf-8').partition(':')
+            result.append((int(user_id), sid))
+        return result
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline()
+        for user_id in user_ids:
+            pipe.exists(self._key(user_id))
+        return {user_id for user_id, exists in zip(user_ids, pipe.execute()) if exists}
+
+class PresenceTracker:
+    """
+    Tracks which users are connected and batches the side effects.
+
+    Connects, disconnects and heartbeats only touch the store. Every
+    `flush_interval` seconds a background worker drops connections whose
+    last heartbeat is older than `ttl`, hands the net online/offline
+    changes to `broadcast(changes)` (a user who reconnects within the
+    interval produces no change at all), and writes `is_online` and
+    `last_seen` for every user seen in the interval in one
+    `persist(changes)` call.
+    """
+    def __init__(self, store=None, ttl=90, flush_interval=5, broadcast=None, persist=None):
+        self.store = store or MemoryPresenceStore()
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.broadcast = broadcast
+        self.persist = persist
+        self._pending = {}
+        self._reported = set()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def start(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='presence', daemon=True)
+                self._worker.start()
+
+    def _mark(self, user_id, online):
+        with self._lock:
+            self._pending[user_id] = (online, datetime.utcnow())
+
+    def connect(self, user_id, sid):
+        self.start()
+        if self.store.add(user_id, sid, time.time()) == 1:
+            self._mark(user_id, True)
+
+    def disconnect(self, user_id, sid):
+        if self.store.remove(user_id, sid) == 0:
+            self._mark(user_id, False)
+
+    def heartbeat(self, user_id, sid):
+        self.store.touch(user_id, sid, time.time())
+
+    def online(self, user_ids):
+        return self.store.online(user_ids)
+
+    def flush(self):
+        """
+        Expire stale connections, then broadcast and persist coalesced changes
+        """
+        for user_id, sid in self.store.expired(time.time() - self.ttl):
+            self.disconnect(user_id, sid)
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+            # Only report transitions from what contacts were last told
+            changes = {}
+            for user_id, (online, at) in pending.items():
+                if online != (user_id in self._reported):
+                    changes[user_id] = (online, at)
+                    if online:
+                        self._reported.add(user_id)
+                    else:
+                        self._reported.discard(user_id)
+
+        if changes and self.broadcast is not None:
+            self.broadcast(changes)
+        if pending and self.persist is not None:
+            self.persist(pending)
+        return changes
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'Presence flush failed: {e}')
@@ -0,0 +1,71 @@
+"""
+Checks that queries read their tables through an index.
+
+`capture_selects` records the SELECTs the app sends while a function
+runs, as the driver received them, so the check covers the statements
+the real code builds. `full_scans` asks the database for the plan of one
+and returns the tables it would read row by row. MySQL and PostgreSQL
+may rightly prefer a scan on tables with a handful of rows, so check them
+against a database with realistic data; PostgreSQL is asked to avoid
+sequential scans wherever an index can serve instead.
+"""
+import re
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+SQLITE_SCAN = re.compile(r'^SCAN (\w+)')
+# A rowid range alone walks the table from the cursor on, whatever the other filters
+SQLITE_ROWID_RANGE = re.compile(r'^SEARCH (\w+) USING INTEGER PRIMARY KEY \(rowid[<>]')
+POSTGRESQL_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+@contextmanager
+def capture_selects(engine):
+    """
+    Collect (statement, parameters) of every SELECT run on the engine inside the block
+    """
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+def explain(connection, statement, parameters):
+    """
+    Plan rows of a statement: SQLite detail strings, MySQL row mappings, PostgreSQL lines of text
+    """
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        return [row.detail for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+    if dialect == 'postgresql':
+        connection.exec_driver_sql('SET enable_seqscan = off')
+        return [row[0] for row in connection.exec_driver_sql('EXPLAIN ' + statement, parameters)]
+    return [dict(row._mapping) for row in connection.exec_driver_sql('EXPLAIN ' + statement, parameters)]
+
+def full_scans(connection, statement, parameters, tables):
+    """
+    Names among `tables` that the plan reads without an index; returns (scans, plan)
+    """
+    plan = explain(connection, statement, parameters)
+    dialect = connection.dialect.name
+    scans = set()
+    if dialect == 'sqlite':
+        for line in plan:
+            match = SQLITE_SCAN.match(line)
+            # "SCAN t USING COVERING INDEX" walks an index, a bare "SCAN t" the table
+            if match and ' USING ' not in line:
+                scans.add(match.group(1))
+            match = SQLITE_ROWID_RANGE.match(line)
+            if match:
+                scans.add(match.group(1))
+    elif dialect == 'postgresql':
+        scans.update(match.group(1) for line in plan for match in POSTGRESQL_SCAN.finditer(line))
+    else:
+        scans.update(row['table'] for row in plan if row['type'] == 'ALL')
+    return sorted(scans & set(tables)), plan
@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import deque
+
+from utils.lru_cache import TTLCache
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+class RateLimiter:
+    """
+    Allows at most `limit` hits per key in any `window` seconds.
+
+    Counters live in this process, or in Redis when `redis_url` is set so
+    every worker shares them (Redis uses fixed windows). `hit` records an
+    attempt and returns 0 when it is allowed, or the number of seconds to
+    wait before the key may try again.
+    """
+    def __init__(self, limit, window, redis_url=None, prefix='ratelimit', max_keys=100000):
+        self.limit = limit
+        self.window = window
+        self.prefix = prefix
+        self._hits = TTLCache(max_size=max_keys, ttl=window)
+        self._lock = threading.Lock()
+        self.client = None
+        if redis_url:
+            if redis is None:
+                raise RuntimeError("The redis package is required for the Redis rate limiter")
+            self.client = redis.Redis.from_url(redis_url)
+
+    def hit(self, key):
+        now = time.time()
+        if self.client is not None:
+            return self._hit_redis(key, now)
+
+        with self._lock:
+            hits = self._hits.get(key)
+            if hits is None:
+                hits = deque(maxlen=self.limit)
+            while hits and hits[0] <= now - self.window:
+                hits.popleft()
+
+            if len(hits) >= self.limit:
+                return hits[0] + self.window - now
+
+            hits.append(now)
+            self._hits.set(key, hits)
+            return 0
+
+    def _hit_redis(self, key, now):
+        bucket = int(now // self.window)
+        redis_key = f'{self.prefix}:{key}:{bucket}'
+        pipe = self.client.pipeline()
+        pipe.incr(redis_key)
+        pipe.expire(redis_key, int(self.window) + 1)
+        count = pipe.execute()[0]
+        if count > self.limit:
+            return (bucket + 1) * self.window - now
+        return 0
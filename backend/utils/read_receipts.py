@@ -0,0 +1,86 @@
+import threading
+import time
+
+from utils.lru_cache import TTLCache
+
+class ReadReceiptTracker:
+    """
+    Per-conversation read watermarks, advanced in memory and flushed in batches.
+
+    A watermark is the id of the newest message a reader has read from a
+    contact; everything at or below it counts as read. `mark_read` only
+    ever moves a watermark forward. Every `flush_interval` seconds the
+    advanced watermarks are written with one `persist(watermarks)` call and
+    handed to `notify(watermarks)`, so a reader scrolling through a chat
+    produces one write and one receipt per conversation and interval. A
+    batch that fails to persist is kept for the next flush.
+    Watermarks not in memory are fetched with `load(user_id, contact_id)`.
+    """
+    def __init__(self, load, flush_interval=1, cache_size=100000, cache_ttl=300, persist=None, notify=None):
+        self.load = load
+        self.flush_interval = flush_interval
+        self.persist = persist
+        self.notify = notify
+        self._watermarks = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def start(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='read-receipts', daemon=True)
+                self._worker.start()
+
+    def watermark(self, user_id, contact_id):
+        key = (user_id, contact_id)
+        value = self._watermarks.get(key)
+        if value is None:
+            value = self.load(user_id, contact_id) or 0
+            with self._lock:
+                # Never replace an advance that happened while loading
+                value = max(value, self._pending.get(key, 0))
+                self._watermarks.set(key, value)
+        return value
+
+    def mark_read(self, user_id, contact_id, message_id):
+        """
+        Advance the watermark of user_id in the conversation with contact_id
+        """
+        current = self.watermark(user_id, contact_id)
+        if message_id <= current:
+            return False
+
+        self.start()
+        key = (user_id, contact_id)
+        with self._lock:
+            if message_id <= self._pending.get(key, 0):
+                return False
+            self._pending[key] = message_id
+            self._watermarks.set(key, message_id)
+        return True
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if pending and self.persist is not None:
+            try:
+                self.persist(pending)
+            except Exception:
+                # Kept for the next flush, unless the reader has moved further meanwhile
+                with self._lock:
+                    for key, message_id in pending.items():
+                        self._pending[key] = max(message_id, self._pending.get(key, 0))
+                raise
+        if pending and self.notify is not None:
+            self.notify(pending)
+        return pending
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'Read receipt flush failed: {e}')
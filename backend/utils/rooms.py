@@ -0,0 +1,70 @@
+from models import db, ChatRoom, UserChatRoom
+from utils.lru_cache import TTLCache
+
+def room_channel(room_id):
+    """
+    Socket.IO room every member of a chat room joins
+    """
+    return f"room_{room_id}"
+
+class RoomInfo:
+    def __init__(self, room_id, credit_cost, is_private, members):
+        self.id = room_id
+        self.credit_cost = credit_cost or 0
+        self.is_private = is_private
+        self.members = members
+
+class RoomMembershipCache:
+    """
+    Cached chat room settings and member sets.
+
+    Loaded with one query per room and kept for `ttl` seconds, so sending
+    a room message checks membership without touching the database.
+    Joins and leaves update the cached set of every process through
+    cluster events; a user missing from the set is still looked up, so a
+    join another process has not heard of yet is never refused.
+    """
+    def __init__(self, max_rooms=1000, ttl=300):
+        self.cache = TTLCache(max_rooms, ttl)
+
+    def get(self, room_id):
+        info = self.cache.get(room_id)
+        if info is not None:
+            return info
+
+        room = db.session.get(ChatRoom, room_id)
+        if room is None:
+            return None
+
+        members = {
+            user_id for (user_id,) in
+            db.session.query(UserChatRoom.user_id).filter(UserChatRoom.chat_room_id == room_id)
+        }
+        info = RoomInfo(room.id, room.credit_cost, room.is_private, members)
+        self.cache.set(room_id, info)
+        return info
+
+    def is_member(self, room_id, user_id):
+        info = self.get(room_id)
+        if info is None:
+            return False
+        if user_id in info.members:
+            return True
+
+        joined = db.session.query(UserChatRoom.user_id).filter_by(chat_room_id=room_id, user_id=user_id).first()
+        if joined is not None:
+            info.members.add(user_id)
+        return joined is not None
+
+    def add_member(self, room_id, user_id):
+        info = self.cache.get(room_id)
+        if info is not None:
+            info.members.add(user_id)
+
+    def remove_member(self, room_id, user_id):
+        info = self.cache.get(room_id)
+        if info is not None:
+            info.members.discard(user_id)
+
+    def invalidate(self, room_id):
+        self.cache.pop(room_id)
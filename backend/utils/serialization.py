@@ -0,0 +1,119 @@
+"""
+Response encoding for the HTTP API and Socket.IO.
+
+Payloads are plain dicts built by a RowSerializer straight from query
+tuples, with datetimes left in place. They are encoded by orjson when it
+is installed, which writes datetimes as ISO 8601 itself, or by the
+standard library otherwise. The same encoder backs `jsonify` (install
+JSONResponseProvider on the app) and Socket.IO events (see
+`socketio_options`), which may use MessagePack instead when the msgpack
+package is installed and clients load socket.io-msgpack-parser.
+"""
+import json
+import sys
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+    from socketio.msgpack_packet import MsgPackPacket
+except ImportError:
+    msgpack = MsgPackPacket = None
+
+SOCKETIO_SERIALIZERS = ('json', 'msgpack')
+
+def _default(value):
+    # Types neither backend encodes natively
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dump_bytes(obj):
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj, default=_default, option=_OPTIONS).decode()
+
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+else:
+    def dump_bytes(obj):
+        return dumps(obj).encode()
+
+    def dumps(obj, **kwargs):
+        return json.dumps(obj, default=_default, separators=(',', ':'))
+
+    def loads(s, **kwargs):
+        return json.loads(s)
+
+class JSONResponseProvider(JSONProvider):
+    """
+    Flask JSON provider on the encoder above; `jsonify` writes bytes straight into the response
+    """
+    def dumps(self, obj, **kwargs):
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dump_bytes(obj), mimetype='application/json')
+
+def socketio_options(serializer='json'):
+    """
+    Socket.IO server options for encoding events as JSON or MessagePack
+    """
+    if serializer not in SOCKETIO_SERIALIZERS:
+        raise ValueError(f"Socket.IO serializer must be one of {SOCKETIO_SERIALIZERS}")
+    options = {'json': sys.modules[__name__]}
+    if serializer == 'msgpack':
+        if msgpack is None:
+            raise RuntimeError("The msgpack package is required for MessagePack Socket.IO payloads")
+        options['serializer'] = MsgPackPacket.configure(dumps_default=_default)
+    return options
+
+class RowSerializer:
+    """
+    Builds response dicts for one fixed schema of columns.
+
+    The schema maps output keys to the columns they come from. Select
+    `columns` to get plain tuples in key order instead of ORM objects (each
+    labelled with its key, so rows still read as `row.id`), then `rows`
+    zips them with the keys. `obj` reads the same columns from a model
+    instance already in hand, such as a message just sent. `transforms`
+    rewrite single values, like media metadata into URLs.
+    """
+    def __init__(self, schema, transforms=None):
+        self.keys = tuple(schema)
+        self.columns = [column.label(key) for key, column in schema.items()]
+        self._attributes = [column.key for column in schema.values()]
+        self._transforms = [(self.keys.index(key), fn) for key, fn in (transforms or {}).items()]
+
+    def row(self, values):
+        if self._transforms:
+            values = list(values)
+            for index, fn in self._transforms:
+                values[index] = fn(values[index])
+        return dict(zip(self.keys, values))
+
+    def rows(self, rows):
+        row = self.row
+        return [row(values) for values in rows]
+
+    def obj(self, obj):
+        return self.row([getattr(obj, attribute) for attribute in self._attributes])
@@ -0,0 +1,196 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import insert
+
+from utils.metrics import metrics
+
+DURABILITY_MODES = ('write_behind', 'group_commit')
+
+def row_for(obj):
+    """
+    Column values of a model instance, with column defaults filled in
+    """
+    row = {}
+    for column in obj.__table__.columns:
+        value = getattr(obj, column.key)
+        if value is None and column.default is not None:
+            value = column.default.arg(None) if column.default.is_callable else column.default.arg
+        row[column.key] = value
+    return row
+
+class MessageWriter:
+    """
+    Buffers inserts and writes them in bulk transactions.
+
+    Rows are written when `batch_size` of them are waiting or `flush_interval`
+    seconds after the first one arrived, whichever comes first. Rows must
+    carry their primary key (see utils.ids) so they can be delivered before
+    they are written.
+
+    `submit` returns a Future resolved once the row is committed. With
+    'group_commit' durability callers wait on it before telling anyone about
+    the row, so concurrent messages share one commit instead of each paying
+    for its own. With 'write_behind' they don't, and rows still in the
+    buffer are lost if the process dies. Rows that cannot be written are
+    passed to `on_failure(model, row, error)`; committed rows are passed to
+    `on_written(model, rows)` before their futures resolve.
+    """
+    def __init__(self, app, db, batch_size=200, flush_interval=0.02, durability='write_behind', on_failure=None, on_written=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"durability must be one of {DURABILITY_MODES}")
+        self.app = app
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.on_failure = on_failure
+        self.on_written = on_written
+        self._pending = []
+        self._writing = []  # batches taken from _pending and not committed yet
+        self._cond = threading.Condition()
+        self._worker = None
+
+    @property
+    def waits_for_commit(self):
+        return self.durability == 'group_commit'
+
+    def start(self):
+        with self._cond:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='message-writer', daemon=True)
+                self._worker.start()
+
+    def submit(self, model, row):
+        self.start()
+        future = Future()
+        with self._cond:
+            self._pending.append((model, row, future))
+            # Wake the worker to start the flush timer, or to flush a full batch now
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._cond.notify()
+        return future
+
+    def discard(self, model, row_id):
+        """
+        Drop a row that has not been written yet; returns True if it was pending
+        """
+        with self._cond:
+            for index, (pending_model, row, future) in enumerate(self._pending):
+                if pending_model is model and row['id'] == row_id:
+                    del self._pending[index]
+                    future.set_result(False)
+                    return True
+        return False
+
+    def pending(self, model, match):
+        """
+        Rows of `model` not committed yet, buffered or being written, for which `match(row)` is true
+        """
+        with self._cond:
+            entries = self._pending + [entry for batch in self._writing for entry in batch]
+        return [row for pending_model, row, _ in entries if pending_model is model and match(row)]
+
+    def flush(self):
+        """
+        Write everything buffered right now, on the calling thread
+        """
+        with self._cond:
+            batch, self._pending = self._pending, []
+            self._writing.append(batch)
+        try:
+            for start in range(0, len(batch), self.batch_size):
+                self._write(batch[start:start + self.batch_size])
+        except Exception as e:
+            self._fail(batch, e)
+            raise
+        finally:
+            self._done(batch)
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            if len(self._pending) < self.batch_size:
+                self._cond.wait(timeout=self.flush_interval)
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            self._writing.append(batch)
+            return batch
+
+    def _done(self, batch):
+        with self._cond:
+            self._writing = [writing for writing in self._writing if writing is not batch]
+
+    def _fail(self, batch, error):
+        """
+        Fail the futures a broken write left unresolved, so group_commit callers stop waiting
+        """
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f'Message write failed: {e}')
+                self._fail(batch, e)
+            finally:
+                self._done(batch)
+
+    def _write(self, batch):
+        if not batch:
+            return
+
+        started = time.monotonic()
+        by_model = {}
+        for model, row, future in batch:
+            by_model.setdefault(model, []).append((row, future))
+
+        with self.app.app_context():
+            session = self.db.session
+            try:
+                for model, entries in by_model.items():
+                    session.execute(insert(model), [row for row, _ in entries])
+                session.commit()
+            except Exception:
+                session.rollback()
+                # Write rows one by one so a single bad row doesn't lose the batch
+                for model, entries in by_model.items():
+                    for row, future in entries:
+                        self._write_one(session, model, row, future)
+                return
+            finally:
+                metrics.observe('message_write_batch', time.monotonic() - started)
+                metrics.gauge('message_write_pending', len(self._pending))
+
+        for model, entries in by_model.items():
+            self._written(model, [row for row, _ in entries])
+            for _, future in entries:
+                future.set_result(True)
+
+    def _written(self, model, rows):
+        if self.on_written is None:
+            return
+        try:
+            self.on_written(model, rows)
+        except Exception as e:
+            print(f'Handling written {model.__tablename__} failed: {e}')
+
+    def _write_one(self, session, model, row, future):
+        try:
+            session.execute(insert(model), [row])
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            future.set_exception(e)
+            if self.on_failure is not None:
+                self.on_failure(model, row, e)
+            return
+
+        self._written(model, [row])
+        future.set_result(True)
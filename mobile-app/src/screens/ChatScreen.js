@@ -32,11 +32,15 @@ const ChatScreen = ({ route }) => {
       // Join the chat room
       socket.emit('join_chat', { contact_id: contactId });
       
-      // Listen for new messages
+      // Listen for new messages, live or caught up after a reconnect
       socket.on('new_message', handleNewMessage);
+      socket.on('sync', handleSync);
+      socket.on('message_media', handleMessageMedia);
       
       return () => {
         socket.off('new_message', handleNewMessage);
+        socket.off('sync', handleSync);
+        socket.off('message_media', handleMessageMedia);
       };
     }
   }, [socket, contactId]);
@@ -52,11 +56,41 @@ const ChatScreen = ({ route }) => {
     }
   };
 
-  const handleNewMessage = (newMessage) => {
-    setMessages(prev => [...prev, newMessage]);
+  const inThisChat = (msg) => msg.sender_id === contactId || msg.receiver_id === contactId;
+
+  // Messages of every chat arrive on the socket; keep this one's, once each, in id order
+  const addMessages = (incoming) => {
+    const mine = incoming.filter(inThisChat);
+    if (!mine.length) return;
+    
+    setMessages(prev => {
+      const known = new Set(prev.map(msg => msg.id));
+      const added = mine.filter(msg => !known.has(msg.id));
+      return added.length ? [...prev, ...added].sort((a, b) => a.id - b.id) : prev;
+    });
+    
+    const received = mine.filter(msg => msg.sender_id === contactId);
+    if (received.length) {
+      // The chat is open, so the contact's messages have been read
+      socket.emit('mark_read', { contact_id: contactId, message_id: received[received.length - 1].id });
+    }
     scrollToBottom();
   };
 
+  const handleNewMessage = (newMessage) => addMessages([newMessage]);
+
+  const handleSync = ({ messages }) => addMessages(messages);
+
+  // Previews are built after upload and arrive separately
+  const handleMessageMedia = ({ id, media }) => {
+    setMessages(prev => prev.map(msg => (msg.id === id ? { ...msg, media } : msg)));
+  };
+
+  const previewFor = (media) => {
+    const thumbnails = (media?.thumbnails || []).filter(t => t.content_type === 'image/jpeg');
+    return thumbnails.find(t => t.width >= 320) || thumbnails[thumbnails.length - 1];
+  };
+
   const sendMessage = () => {
     if (!message.trim()) return;
 
@@ -79,6 +113,7 @@ const ChatScreen = ({ route }) => {
 
   const renderMessage = ({ item }) => {
     const isMyMessage = item.sender_id === user.id;
+    const preview = previewFor(item.media);
     
     return (
       <View style={[
@@ -89,6 +124,15 @@ const ChatScreen = ({ route }) => {
           styles.messageBubble,
           isMyMessage ? styles.myMessageBubble : styles.theirMessageBubble
         ]}>
+          {preview && (
+            <Image
+              style={[styles.preview, { aspectRatio: preview.width / preview.height }]}
+              source={{
+                uri: `${api.defaults.baseURL}${preview.url}`,
+                headers: { Authorization: api.defaults.headers.common['Authorization'] },
+              }}
+            />
+          )}
           <Text style={isMyMessage ? styles.myMessageText : styles.theirMessageText}>
             {item.content}
           </Text>
@@ -174,6 +218,11 @@ const styles = StyleSheet.create({
     color: '#000',
     fontSize: 16,
   },
+  preview: {
+    width: 240,
+    borderRadius: 6,
+    marginBottom: 5,
+  },
   messageTime: {
     fontSize: 12,
     color: '#667781',
@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useRef, useState } from 'react';
 import {
   View,
   Text,
@@ -12,6 +12,8 @@ import { api } from '../services/api';
 const ProfileScreen = () => {
   const { user, logout } = useAuth();
   const [loading, setLoading] = useState(false);
+  // Kept until the server answers, so a retried purchase is never charged twice
+  const purchaseKey = useRef(null);
 
   const handleLogout = async () => {
     Alert.alert(
@@ -36,19 +38,29 @@ const ProfileScreen = () => {
 
   const handleBuyCredits = async () => {
     setLoading(true);
+    if (!purchaseKey.current) {
+      purchaseKey.current = `${user?.id}-${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    }
     try {
-      // In a real app, you would integrate with a payment gateway
-      // For now, we'll simulate a successful payment
+      // The payment is confirmed in the background; credits arrive with payment_updated
       const response = await api.post('/api/payment/process', {
-        amount: 4.99,
-        currency: 'USD',
-        payment_method: 'card',
-        credits: 5
+        package_id: 'credits_5',
+        payment_method: 'card'
+      }, {
+        headers: { 'Idempotency-Key': purchaseKey.current }
       });
+      purchaseKey.current = null;
       
-      Alert.alert('Success', 'Credits added to your account!');
+      if (response.data.status === 'failed') {
+        Alert.alert('Error', response.data.error || 'Failed to process payment');
+      } else {
+        Alert.alert('Success', 'Payment received, credits will be added shortly!');
+      }
     } catch (error) {
       console.error('Payment error:', error);
+      if (error.response) {
+        purchaseKey.current = null;
+      }
       Alert.alert('Error', 'Failed to process payment');
     } finally {
       setLoading(false);
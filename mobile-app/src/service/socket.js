@@ -1,10 +1,23 @@
-import React, { createContext, useContext, useEffect, useState } from 'react';
+import React, { createContext, useContext, useEffect, useRef, useState } from 'react';
 import io from 'socket.io-client';
 import { useAuth } from './auth';
 import { api } from './api';
 
 const SocketContext = createContext();
 
+const HEARTBEAT_INTERVAL = 30000;
+const SYNC_STATE_KEY = 'syncState';
+
+// Newest message id held per conversation, plus the `since` of the last complete sync
+const loadSyncState = async () => {
+  const saved = await AsyncStorage.getItem(SYNC_STATE_KEY);
+  return saved ? JSON.parse(saved) : { conversations: {}, since: null };
+};
+
+const partnerOf = (message, userId) => (
+  message.sender_id === userId ? message.receiver_id : message.sender_id
+);
+
 export const useSocket = () => {
   return useContext(SocketContext);
 };
@@ -12,6 +25,16 @@ export const useSocket = () => {
 export const SocketProvider = ({ children }) => {
   const [socket, setSocket] = useState(null);
   const { user } = useAuth();
+  const syncState = useRef(null);
+
+  const remember = (messages) => {
+    const { conversations } = syncState.current;
+    messages.forEach(message => {
+      const contactId = partnerOf(message, user.id);
+      conversations[contactId] = Math.max(conversations[contactId] || 0, message.id);
+    });
+    AsyncStorage.setItem(SYNC_STATE_KEY, JSON.stringify(syncState.current));
+  };
 
   useEffect(() => {
     if (user) {
@@ -19,6 +42,7 @@ export const SocketProvider = ({ children }) => {
       const connectSocket = async () => {
         try {
           const token = await AsyncStorage.getItem('authToken');
+          syncState.current = await loadSyncState();
           
           const newSocket = io(api.defaults.baseURL, {
             auth: {
@@ -26,17 +50,46 @@ export const SocketProvider = ({ children }) => {
             }
           });
 
+          // Keep presence alive; the server expires connections without heartbeats
+          let heartbeat = null;
+
           newSocket.on('connect', () => {
             console.log('Connected to server');
+            heartbeat = setInterval(() => newSocket.emit('heartbeat'), HEARTBEAT_INTERVAL);
+            // Catch up on every conversation at once instead of re-reading each history
+            newSocket.emit('sync', syncState.current);
+          });
+
+          // Screens listen to 'sync' and 'new_message' too; here we only track marks and ack
+          newSocket.on('sync', ({ messages, has_more, since }) => {
+            remember(messages);
+            if (messages.length) {
+              newSocket.emit('ack_messages', { ids: messages.map(message => message.id) });
+            }
+            if (has_more) {
+              newSocket.emit('sync', { conversations: syncState.current.conversations, since });
+            } else {
+              syncState.current.since = since;
+              AsyncStorage.setItem(SYNC_STATE_KEY, JSON.stringify(syncState.current));
+            }
+          });
+
+          newSocket.on('new_message', (message) => {
+            remember([message]);
+            newSocket.emit('ack_messages', { ids: [message.id] });
           });
 
           newSocket.on('disconnect', () => {
             console.log('Disconnected from server');
+            clearInterval(heartbeat);
           });
 
           setSocket(newSocket);
 
-          return () => newSocket.close();
+          return () => {
+            clearInterval(heartbeat);
+            newSocket.close();
+          };
         } catch (error) {
           console.error('Socket connection error:', error);
         }